@@ -1,4 +1,9 @@
 from django.contrib import admin
-from .models import Message
+from .models import Message, ArchivedMessages, Conversation, Membership, GroupMessage, Task
 
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
+admin.site.register(ArchivedMessages)
+admin.site.register(Conversation)
+admin.site.register(Membership)
+admin.site.register(GroupMessage)
+admin.site.register(Task)
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import re
+from django.conf import settings
+
+FILE_READ_SIZE = 64 * 1024
+
+
+def get_upload_dir():
+    return os.path.join(settings.ATTACHMENT_ROOT, 'uploads')
+
+
+def get_upload_path(upload_uuid):
+    return os.path.join(get_upload_dir(), str(upload_uuid))
+
+
+def get_file_dir():
+    return os.path.join(settings.ATTACHMENT_ROOT, 'files')
+
+
+def get_file_relative_path(file_hash):
+    return os.path.join(file_hash[:2], file_hash[2:4], file_hash)
+
+
+def get_file_path(file_hash):
+    return os.path.join(get_file_dir(), get_file_relative_path(file_hash))
+
+
+def iter_file_names(directory):
+    '''Yields the (name, path) of every file under a directory'''
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            yield filename, os.path.join(dirpath, filename)
+
+
+def remove_file(path):
+    '''Removes a file, and returns whether it was there to remove'''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def remove_if_unmodified(path, before):
+    '''Removes a file unless it has been modified since a time, and returns whether it was removed'''
+    try:
+        if os.path.getmtime(path) >= before.timestamp():
+            return False
+    except FileNotFoundError:
+        return False
+    return remove_file(path)
+
+
+def write_chunk(upload_path, offset, stream, max_size):
+    '''
+    Appends the data read from a stream to a partial upload, without reading it all into memory, and returns the new size of the upload
+    - offset: the size the upload must be at, so a retried chunk is never written twice
+    - max_size: the number of bytes which may be read from the stream
+    '''
+    os.makedirs(os.path.dirname(upload_path), exist_ok=True)
+    with open(upload_path, 'ab') as upload_file:
+        # If the partial upload is shorter than expected, nothing is written and the client resumes from its actual size
+        if upload_file.seek(0, os.SEEK_END) < offset:
+            return upload_file.tell()
+        upload_file.truncate(offset)
+
+        remaining_size = max_size
+        while remaining_size > 0:
+            data = stream.read(min(FILE_READ_SIZE, remaining_size))
+            if not data:
+                break
+            upload_file.write(data)
+            remaining_size -= len(data)
+
+        return upload_file.tell()
+
+
+def store_upload(upload_path):
+    '''Moves a completed upload to the path given by the hash of its content, unless the same content is already stored, and returns the hash'''
+    file_hash = hashlib.sha256()
+    with open(upload_path, 'rb') as upload_file:
+        while data := upload_file.read(FILE_READ_SIZE):
+            file_hash.update(data)
+    file_hash = file_hash.hexdigest()
+
+    file_path = get_file_path(file_hash)
+    if os.path.exists(file_path):
+        os.remove(upload_path)
+        # The stored file is in use again, so it isn't removed as unreferenced before the attachment using it is saved
+        os.utime(file_path)
+    else:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(upload_path, file_path)
+
+    return file_hash
+
+
+def parse_range(range_header, size):
+    '''
+    Returns the (start, end) byte positions, inclusive, of a single range requested in a Range header.
+    Returns None if the whole file should be sent, or raises ValueError if the range cannot be satisfied.
+    '''
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if match is None or match.group(1) == match.group(2) == '':
+        return None
+
+    start, end = match.groups()
+    if start == '':
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+
+    if start > end or start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+
+def read_file_range(file_path, start, end):
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        remaining_size = end - start + 1
+        while remaining_size > 0:
+            data = file.read(min(FILE_READ_SIZE, remaining_size))
+            if not data:
+                break
+            remaining_size -= len(data)
+            yield data
@@ -1,26 +1,47 @@
+import asyncio
 import json
+from contextlib import nullcontext
+from datetime import datetime
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.template.loader import render_to_string
 from django.contrib.auth import get_user_model
 from django.urls import resolve, Resolver404
 from users.urls import MANAGE_FRIENDS_URLS
+from users.user_cache import aget_user_by_uuid, user_cache
 from .urls import CHAT_URLS
-from .models import Message
-from .utils import get_session_group, get_user_group, send_both_users_ws_message_async
+from .fragments import (
+    fragment_cache, render_recent_chat, render_friend, render_incoming_request, render_outgoing_request,
+    FRIEND_TEMPLATE, INCOMING_REQUEST_TEMPLATE, OUTGOING_REQUEST_TEMPLATE
+)
+from .models import Message, Membership, GroupMessage
+from .metrics import websocket_connections, consumer_handler_seconds, throttling_actions
+from .profiling import profile_consumer_handler
+from .replicas import ReplicaRouting, apin_to_primary
+from .throttling import TokenBucket, OutboundQueue
+from .utils import get_session_group, get_user_group, get_conversation_group, send_both_users_ws_message_async, send_conversation_ws_message_async
 
 User = get_user_model()
 
+# Events caused by another user, which aren't handled when either user has blocked the other
+BLOCKABLE_EVENTS = ('chat_message', 'group_message', 'friend_request_sent', 'friend_request_accepted', 'update_account')
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        if self.scope['session'].session_key is None:
-            await self.accept() # Accept before closing so automatic reconnection is not attempted by the HTMX WS extension
-            await self.close()
-            return
+        # The session group is provided directly when the connection is authenticated using a WebSocket token
+        session_group = self.scope.get('session_group')
+        if session_group is None:
+            if self.scope['session'].session_key is None:
+                await self.accept() # Accept before closing so automatic reconnection is not attempted by the HTMX WS extension
+                await self.close()
+                return
+
+            session_group = get_session_group(self.scope['session'])
 
-        self.session = self.scope['session']
-        await self._add_to_session_group()
+        await self._add_to_session_group(session_group)
         self.user = self.scope['user']
         await self._add_to_user_group()
         self.csrf_token = self.scope['cookies'].get('csrftoken')
@@ -28,13 +49,35 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.url_name = None
         self.current_other_user = None
         self.are_friends = None
+        self.current_membership = None
+        self.conversation_groups = set()
+
+        # Clients which can apply structured deltas to the sidebar ask for them when connecting
+        query_string = parse_qs(self.scope.get('query_string', b'').decode())
+        self.delta_events = settings.WS_DELTA_EVENTS and 'delta' in query_string.get('events', [])
+        self.sidebar_entries = set()
+        self.blocked_uuids = set()
+
+        self.rate_limits = {
+            message_type: TokenBucket(rate, capacity)
+            for message_type, (rate, capacity) in settings.WS_RATE_LIMITS.items()
+        }
+        self.outbound_queue = OutboundQueue(settings.WS_OUTBOUND_QUEUE_SIZE)
+        self.outbound_dropped = False
 
         await self.accept()
         
         self.connection_open = True
+        self.outbound_task = asyncio.create_task(self._send_outbound_messages())
+        websocket_connections.inc()
+
+        # Loaded after accepting, so the handshake doesn't wait for the database. No events are handled until connect returns, so none
+        # are handled without the set.
+        await self._load_blocked_uuids()
+        await self._add_to_conversation_groups()
 
-    async def _add_to_session_group(self):
-        self.session_group = get_session_group(self.session)
+    async def _add_to_session_group(self, session_group):
+        self.session_group = session_group
 
         await self.channel_layer.group_add(
             self.session_group, self.channel_name
@@ -47,10 +90,42 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.user_group, self.channel_name
         )
 
+    async def _add_to_conversation_group(self, conversation_uuid):
+        group_name = get_conversation_group(conversation_uuid)
+        self.conversation_groups.add(group_name)
+
+        await self.channel_layer.group_add(
+            group_name, self.channel_name
+        )
+
+    async def _discard_from_conversation_group(self, conversation_uuid):
+        group_name = get_conversation_group(conversation_uuid)
+        self.conversation_groups.discard(group_name)
+
+        await self.channel_layer.group_discard(
+            group_name, self.channel_name
+        )
+
+    async def _load_blocked_uuids(self):
+        # Loaded once, and kept up to date by block_updated events, so checking whether a user is blocked needs no query
+        if self.user.is_authenticated:
+            self.blocked_uuids = await self.user.aget_blocked_uuids()
+
+    async def _add_to_conversation_groups(self):
+        if not self.user.is_authenticated:
+            return
+
+        async for conversation_uuid in Membership.objects.filter(user_id=self.user.id).values_list('conversation_id', flat=True):
+            await self._add_to_conversation_group(conversation_uuid)
+
     async def disconnect(self, close_code):
-        if not hasattr(self, 'session'):
+        if not hasattr(self, 'session_group'):
             return
         
+        if hasattr(self, 'outbound_task'):
+            self.outbound_task.cancel()
+            websocket_connections.dec()
+
         await self.channel_layer.group_discard(
             self.session_group, self.channel_name
         )
@@ -59,6 +134,43 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.user_group, self.channel_name
         )
 
+        for group_name in self.conversation_groups:
+            await self.channel_layer.group_discard(
+                group_name, self.channel_name
+            )
+
+    @profile_consumer_handler
+    async def dispatch(self, message):
+        if self._is_from_blocked_user(message):
+            return
+
+        routing = self._get_replica_routing()
+        with consumer_handler_seconds.time(message['type']), routing or nullcontext():
+            await super().dispatch(message)
+
+        if routing is not None and routing.wrote:
+            await apin_to_primary(self.session_group)
+
+    def _is_from_blocked_user(self, event):
+        '''
+        Events between blocked users aren't sent to each other's groups, but group messages are sent once to the conversation's group,
+        so they are filtered by each member. Events sent before a block_updated event is handled are also filtered.
+        '''
+        if event['type'] not in BLOCKABLE_EVENTS or not getattr(self, 'blocked_uuids', None):
+            return False
+
+        if event['type'] == 'group_message':
+            other_user_uuid = event['serialized_message']['sender']['uuid']
+        else:
+            other_user_uuid = event['other_user']['uuid']
+        return other_user_uuid in self.blocked_uuids
+
+    def _get_replica_routing(self):
+        # Messages handled before the connection is accepted read from the primary database
+        if not settings.DATABASE_REPLICAS or not hasattr(self, 'session_group'):
+            return None
+        return ReplicaRouting(self.session_group)
+
     async def receive(self, text_data):
         try:
             json_data = json.loads(text_data)
@@ -66,15 +178,57 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         
         message_type = json_data.get('type')
+        if not self._consume_rate_limit_token(message_type):
+            throttling_actions.inc(f'inbound_throttled_{message_type}')
+            if message_type in ('chat_send', 'group_send'):
+                # The client clears the input once a message is sent, so the content is sent back to be restored
+                await self._send_json({
+                    'type': 'send_rate_limited',
+                    'content': json_data.get('content')
+                })
+            return
+
         if message_type == 'chat_send':
             content = json_data.get('content')
             await self._handle_chat_send(content)
+        elif message_type == 'group_send':
+            content = json_data.get('content')
+            await self._handle_group_send(content)
         elif message_type == 'page_load':
             path = json_data.get('path')
-            await self._handle_page_load(path)
+            sidebar_entries = json_data.get('sidebarEntries')
+            await self._handle_page_load(path, sidebar_entries)
 
-    async def _handle_page_load(self, path):
+    def _consume_rate_limit_token(self, message_type):
+        rate_limit = self.rate_limits.get(message_type)
+        return rate_limit is None or rate_limit.consume()
+
+    async def _send_json(self, data):
+        if self.outbound_dropped:
+            return
+
+        if not self.outbound_queue.put(data):
+            # The client is too far behind, so drop the connection. On reconnecting, the client requests a full page load to catch up
+            throttling_actions.inc('outbound_connections_dropped')
+            self.outbound_dropped = True
+            self.connection_open = False
+            await self.close()
+
+    async def _send_outbound_messages(self):
+        while True:
+            data = await self.outbound_queue.get()
+            try:
+                await self.send(text_data=json.dumps(data))
+            finally:
+                self.outbound_queue.task_done()
+
+    async def _close_after_sending(self):
+        await self.outbound_queue.join()
+        await self.close()
+
+    async def _handle_page_load(self, path, sidebar_entries=None):
         self._handle_page_unload()
+        self._add_rendered_sidebar_entries(sidebar_entries)
 
         try:
             resolved = resolve(path)
@@ -82,21 +236,31 @@ class ChatConsumer(AsyncWebsocketConsumer):
             if self.url_name == 'direct_message':
                 uuid = resolved.kwargs['uuid']
                 await self._handle_chat_load(uuid)
+            elif self.url_name == 'group_chat':
+                uuid = resolved.kwargs['uuid']
+                await self._handle_group_chat_load(uuid)
         except Resolver404:
             return
 
     async def _handle_chat_load(self, uuid):
-        try:
-            self.current_other_user = await User.objects.aget(uuid=uuid)
-        except User.DoesNotExist:
+        self.current_other_user = await aget_user_by_uuid(uuid)
+        if self.current_other_user is None:
             return
 
         self.are_friends = await database_sync_to_async(self.user.has_friend_mutual)(self.current_other_user)
 
+    async def _handle_group_chat_load(self, uuid):
+        try:
+            self.current_membership = await Membership.objects.select_related('conversation').aget(conversation_id=uuid, user_id=self.user.id)
+        except Membership.DoesNotExist:
+            return
+
     def _handle_page_unload(self):
         self.url_name = None
         self.current_other_user = None
         self.are_friends = None
+        self.current_membership = None
+        self.sidebar_entries = set()
 
     async def _create_message(self, content):
         return await Message.objects.acreate(
@@ -105,18 +269,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
             content=content
         )
 
-    @staticmethod
-    def _get_chat_message_event(serialized_message):
-        return {
-            'type': 'chat_message',
-            'serialized_message': serialized_message
-        }
-
     async def _handle_chat_send(self, content):
         if not self.user.is_authenticated:
             return
 
-        if not self.are_friends:
+        if not self.are_friends or str(self.current_other_user.uuid) in self.blocked_uuids:
             return
         
         if not isinstance(content, str):
@@ -129,9 +286,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message = await self._create_message(content)
         serialized_message = message.serialize()
 
-        event = self._get_chat_message_event(serialized_message)
+        event = Message._get_chat_message_event(serialized_message)
         await send_both_users_ws_message_async(self.user, self.current_other_user, event=event)
     
+    async def _handle_group_send(self, content):
+        if self.current_membership is None:
+            return
+
+        if not isinstance(content, str):
+            return
+
+        content = content.strip()
+        if not content:
+            return
+
+        conversation = self.current_membership.conversation
+        message = await database_sync_to_async(GroupMessage.create_message)(self.user, conversation, content)
+
+        event = GroupMessage._get_group_message_event(message.serialize(), conversation)
+        await send_conversation_ws_message_async(conversation.uuid, event=event)
+
     def _is_recipient(self, data):
         return data['recipient']['uuid'] == str(self.user.uuid)
     
@@ -145,18 +319,60 @@ class ChatConsumer(AsyncWebsocketConsumer):
         return self.url_name in MANAGE_FRIENDS_URLS
     
     def _create_recent_chat_html(self, serialized_message, other_user, unread_count):
-        return render_to_string('chat/partials/recent_chat.html', {
-            'last_message': serialized_message,
-            'user': self.user,
-            'other_user': other_user,
-            'unread_count': unread_count
-        })
+        return render_recent_chat(self.user, other_user, serialized_message, unread_count)
     
     async def _send_recent_chat_html(self, recent_chat_html):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'recent_chat_html',
             'html': recent_chat_html
-        }))
+        })
+
+    def _add_rendered_sidebar_entries(self, entry_ids):
+        '''
+        Adds the ids of the sidebar entries the loaded page was rendered with, so updates to them are sent as deltas from the first
+        one. The client ignores deltas for entries it doesn't have, so the ids are only limited in number.
+        '''
+        if not self.delta_events or not isinstance(entry_ids, list):
+            return
+        entry_ids = [entry_id for entry_id in entry_ids[:settings.WS_MAX_SIDEBAR_ENTRIES] if isinstance(entry_id, str)]
+        self.sidebar_entries.update(entry_ids)
+
+    def _has_sidebar_entry(self, entry_id):
+        '''
+        Returns whether the client has already been sent a sidebar entry since the page was loaded, or the page was rendered with it,
+        so only the fields which changed need to be sent. Without delta events, the whole entry is always sent.
+        '''
+        if not self.delta_events:
+            return False
+        if entry_id in self.sidebar_entries:
+            return True
+        self.sidebar_entries.add(entry_id)
+        return False
+
+    async def _send_sidebar_entry_delta(self, entry_id, serialized_message, unread_count, show_read_status):
+        '''Sends the fields of a sidebar entry changed by a new message, after which the entry is moved to the top of the sidebar'''
+        attachment = serialized_message.get('attachment')
+        await self._send_json({
+            'type': 'sidebar_entry_delta',
+            'id': entry_id,
+            'timestamp': serialized_message['timestamp'],
+            'unreadCount': unread_count,
+            'lastMessage': {
+                'senderUsername': serialized_message['sender']['username'],
+                'text': attachment['filename'] if attachment else serialized_message['content']['limited'],
+                'read': serialized_message['read'] if show_read_status else None
+            }
+        })
+
+    async def _send_recent_chat(self, serialized_message, other_user, unread_count):
+        entry_id = f'chat-{other_user["uuid"]}'
+        if self._has_sidebar_entry(entry_id):
+            is_sender = not self._is_recipient(serialized_message)
+            await self._send_sidebar_entry_delta(entry_id, serialized_message, unread_count, show_read_status=is_sender)
+            return
+
+        recent_chat_html = self._create_recent_chat_html(serialized_message, other_user, unread_count)
+        await self._send_recent_chat_html(recent_chat_html)
 
     def _create_message_html(self, serialized_message):
         return render_to_string('chat/partials/message.html', {
@@ -165,10 +381,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         })
 
     async def _send_message_html(self, message_html):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'message_html',
             'html': message_html
-        }))
+        })
 
     async def chat_message(self, event):
         serialized_message = event['serialized_message']
@@ -189,8 +405,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             else:
                 unread_count = 'increment' # Increment unread count value on the client side
 
-        recent_chat_html = self._create_recent_chat_html(serialized_message, other_user, unread_count)
-        await self._send_recent_chat_html(recent_chat_html)
+        await self._send_recent_chat(serialized_message, other_user, unread_count)
 
         if not is_on_relevant_chat:
             return
@@ -214,29 +429,29 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await send_both_users_ws_message_async(self.user, self.current_other_user, event=event)
 
     async def _send_decrement_unread_count(self, other_user, count):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'decrement_unread_count',
             'otherUserUuid': other_user['uuid'],
             'count': count
-        }))
+        })
 
     async def _send_update_recent_chat_read_status(self, other_user):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'update_recent_chat_read_status',
             'otherUserUuid': other_user['uuid']
-        }))
+        })
 
     async def _send_update_message_read_status(self, serialized_message):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'update_message_read_status',
             'messageUuid': serialized_message['uuid']
-        }))
+        })
 
     async def _send_update_all_messages_read_status(self, chat):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'update_all_messages_read_status',
             'senderUuid': chat['sender']['uuid']
-        }))
+        })
 
     async def _handle_read_event(self, event, is_all_messages_read):
         other_user = event['other_user']
@@ -270,53 +485,85 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def all_messages_read(self, event):
         await self._handle_read_event(event, is_all_messages_read=True)
 
-    async def _send_update_section_count(self, page, section, action):
+    async def _send_chat_deletion_progress(self, other_user, deleted, total):
+        await self._send_json({
+            'type': 'chat_deletion_progress',
+            'otherUserUuid': other_user['uuid'],
+            'deleted': deleted,
+            'total': total
+        })
+
+    async def chat_deletion_progress(self, event):
+        if not self._in_chat_area():
+            return
+
+        await self._send_chat_deletion_progress(event['other_user'], event['deleted'], event['total'])
+
+    async def _send_clear_messages(self):
+        await self._send_json({
+            'type': 'clear_messages'
+        })
+
+    async def _send_remove_recent_chat(self, other_user):
+        await self._send_json({
+            'type': 'remove_recent_chat',
+            'otherUserUuid': other_user['uuid']
+        })
+
+    async def chat_deleted(self, event):
+        other_user = event['other_user']
+        # The client no longer has the entry, so it is sent in full if a new message is sent
+        self.sidebar_entries.discard(f'chat-{other_user["uuid"]}')
+
+        if self._is_current_other_user(other_user):
+            await self._send_clear_messages()
+
+        if self._in_chat_area():
+            await self._send_remove_recent_chat(other_user)
+
+    async def _send_update_section_count(self, page, section, action, count=1):
         '''
         Sends a message to update the count for a specific section on a specific page
         - page: "home" or "manage_friends"
         - section: "incoming", "outgoing", or "friends"
         - action "increment" or "decrement"
+        - count: the amount to increment or decrement by
         '''
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'update_section_count',
             'page': page,
             'section': section,
-            'action': action
-        }))
+            'action': action,
+            'count': count
+        })
 
     async def _send_remove_user_from_section(self, section, other_user):
         '''
         Sends a message to remove a user from a specific section on the manage friends page
         - section: "incoming", "outgoing", or "friends"
         '''
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'remove_user_from_section',
             'section': section,
             'otherUserUuid': other_user['uuid']
-        }))
+        })
 
     def _create_incoming_request_html(self, sender):
-        return render_to_string('users/partials/incoming_request.html', {
-            'sender': sender,
-            'csrf_token': self.csrf_token
-        })
+        return render_incoming_request(sender, self.csrf_token)
 
     def _create_outgoing_request_html(self, recipient):
-        return render_to_string('users/partials/outgoing_request.html', {
-            'recipient': recipient,
-            'csrf_token': self.csrf_token
-        })
+        return render_outgoing_request(recipient, self.csrf_token)
 
     async def _send_add_user_html_to_section(self, section, user_html):
         '''
         Sends a message to add a new user to a specific section on the manage friends page
         - section: "incoming", "outgoing", or "friends"
         '''
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'add_user_html_to_section',
             'section': section,
             'html': user_html
-        }))
+        })
 
     async def _handle_friend_request_event(self, event, is_friend_request_removed):
         other_user = event['other_user']
@@ -326,6 +573,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
         section = 'incoming' if is_recipient else 'outgoing'
         count_action = 'decrement' if is_friend_request_removed else 'increment'
 
+        if is_friend_request_removed:
+            fragment_cache.evict(other_user['uuid'], [INCOMING_REQUEST_TEMPLATE if is_recipient else OUTGOING_REQUEST_TEMPLATE])
+
         if not in_chat_area:
             return
 
@@ -351,16 +601,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self._send_add_user_html_to_section(section, outgoing_request_html)
     
     def _create_friend_html(self, friend):
-        return render_to_string('users/partials/friend.html', {
-            'friend': friend,
-            'csrf_token': self.csrf_token
-        })
+        return render_friend(friend, self.csrf_token)
     
     async def _send_update_friendship(self, are_friends):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'update_friendship',
             'areFriends': are_friends
-        }))
+        })
 
     async def _handle_friendship_change_event(self, event, are_friends):
         other_user = event['other_user']
@@ -368,6 +615,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
         section = 'friends'
         count_action = 'increment' if are_friends else 'decrement'
 
+        if not are_friends:
+            fragment_cache.evict(other_user['uuid'], [FRIEND_TEMPLATE])
+
         if in_friends_area:
             await self._send_update_section_count('manage_friends', section, count_action)
 
@@ -399,40 +649,127 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def friend_request_cancelled(self, event):
         await self._handle_friend_request_event(event, is_friend_request_removed=True)
 
+    async def block_updated(self, event):
+        other_user = event['other_user']
+        if event['blocked']:
+            self.blocked_uuids.add(other_user['uuid'])
+        else:
+            self.blocked_uuids.discard(other_user['uuid'])
+
     async def _send_account_deleted(self):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'account_deleted'
-        }))
+        })
 
     async def account_deleted(self, event):
         if not self.connection_open:
             return
         
         await self._send_account_deleted()
-        await self.close()
+        await self._close_after_sending()
 
     async def _send_session_logged_out(self):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'session_logged_out'
-        }))
+        })
 
     async def session_logged_out(self, event):
         self.connection_open = False
 
         await self._send_session_logged_out()
-        await self.close()
+        await self._close_after_sending()
 
     async def _send_update_account(self, other_user):
-        await self.send(text_data=json.dumps({
+        await self._send_json({
             'type': 'update_account',
             'otherUser': other_user
-        })) 
+        })
 
     async def update_account(self, event):
         other_user = event['other_user']
         in_chat_area = self._in_chat_area()
 
+        # The user may have been changed by another process, which only removed it from its own memory
+        user_cache.evict(other_user['uuid'])
+
+        if other_user['uuid'] == str(self.user.uuid):
+            # Keep the user's own details up to date, since they are included in the events this connection sends. All the fields
+            # loaded from a WebSocket token are refreshed, the others are deferred.
+            self.user.username = other_user['username']
+            self.user.avatar_hash = other_user['avatar']['version'] if other_user['avatar'] else ''
+            return
+
+        # Fragments rendered with the user's old account details are no longer going to be used
+        fragment_cache.evict(other_user['uuid'])
+
         if not in_chat_area:
             return
         
-        await self._send_update_account(other_user)
\ No newline at end of file
+        await self._send_update_account(other_user)
+
+    def _is_current_conversation(self, conversation):
+        return self.current_membership is not None and conversation['uuid'] == str(self.current_membership.conversation_id)
+
+    def _create_group_html(self, conversation, last_message, unread_count):
+        return render_to_string('chat/partials/group.html', {
+            'conversation': conversation,
+            'last_message': last_message,
+            'unread_count': unread_count
+        })
+
+    async def _send_group_html(self, group_html):
+        await self._send_json({
+            'type': 'group_html',
+            'html': group_html
+        })
+
+    def _create_group_message_html(self, serialized_message):
+        return render_to_string('chat/partials/group_message.html', {
+            'message': serialized_message,
+            'user': self.user
+        })
+
+    async def group_message(self, event):
+        serialized_message = event['serialized_message']
+        conversation = event['conversation']
+        is_sender = serialized_message['sender']['uuid'] == str(self.user.uuid)
+
+        if self._is_current_conversation(conversation):
+            if not is_sender:
+                await self.current_membership.amark_as_read(datetime.fromisoformat(serialized_message['timestamp']))
+
+            message_html = self._create_group_message_html(serialized_message)
+            await self._send_message_html(message_html)
+        elif self.url_name == 'groups_list':
+            unread_count = 0 if is_sender else 'increment' # Increment unread count value on the client side
+            entry_id = f'group-{conversation["uuid"]}'
+            if self._has_sidebar_entry(entry_id):
+                await self._send_sidebar_entry_delta(entry_id, serialized_message, unread_count, show_read_status=False)
+                return
+
+            group_html = self._create_group_html(conversation, serialized_message, unread_count)
+            await self._send_group_html(group_html)
+
+    async def _send_remove_group(self, conversation):
+        await self._send_json({
+            'type': 'remove_group',
+            'conversationUuid': conversation['uuid']
+        })
+
+    async def conversation_joined(self, event):
+        conversation = event['conversation']
+        await self._add_to_conversation_group(conversation['uuid'])
+
+        if self.url_name == 'groups_list':
+            group_html = self._create_group_html(conversation, None, 0)
+            await self._send_group_html(group_html)
+
+    async def conversation_left(self, event):
+        conversation = event['conversation']
+        await self._discard_from_conversation_group(conversation['uuid'])
+
+        if self._is_current_conversation(conversation):
+            self.current_membership = None
+
+        if self.url_name == 'groups_list':
+            await self._send_remove_group(conversation)
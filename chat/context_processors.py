@@ -0,0 +1,12 @@
+from django.utils.functional import lazy
+from .utils import create_ws_token
+
+
+def ws_token(request):
+    '''Adds a token for authenticating the WebSocket connection to the context, only created if used by the template'''
+    if not request.user.is_authenticated:
+        return {}
+
+    return {
+        'ws_token': lazy(create_ws_token, str)(request.session, request.user)
+    }
@@ -0,0 +1,108 @@
+import csv
+import heapq
+import io
+import json
+import zlib
+from datetime import datetime
+from itertools import islice
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .fields import get_stored_text
+from .models import Message, ArchivedMessages
+
+EXPORT_CONTENT_TYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+EXPORT_FIELDS = ['uuid', 'timestamp', 'sender', 'recipient', 'content', 'attachment', 'read']
+
+
+def _iter_archived_rows(user, other_user):
+    user_1_id, user_2_id = ArchivedMessages.get_user_ids(user.id, other_user.id)
+    archives = ArchivedMessages.objects.filter(user_1_id=user_1_id, user_2_id=user_2_id).order_by('period_start')
+
+    # Only one archive is decompressed at a time, so at most one period of messages is held in memory
+    for archive in archives.iterator(chunk_size=1):
+        for uuid, sender_id, timestamp, content, read in archive.get_rows():
+            recipient_id = user_2_id if sender_id == user_1_id else user_1_id
+            yield datetime.fromisoformat(timestamp), uuid, sender_id, recipient_id, content, None, read
+
+
+def _iter_message_rows(user, other_user, chunk_size):
+    messages = Message.objects.filter(Message.get_chat_filter(user, other_user)).order_by('timestamp', 'uuid').values_list(
+        'timestamp', 'uuid', 'sender_id', 'recipient_id', 'content', 'compressed_content', 'attachment__filename', 'read'
+    )
+    for timestamp, uuid, sender_id, recipient_id, content, compressed_content, attachment, read in messages.iterator(chunk_size=chunk_size):
+        yield timestamp, str(uuid), sender_id, recipient_id, get_stored_text(content, compressed_content), attachment, read
+
+
+def _get_record(row, usernames):
+    timestamp, uuid, sender_id, recipient_id, content, attachment, read = row
+    return {
+        'uuid': uuid,
+        'timestamp': timestamp.isoformat(),
+        'sender': usernames[sender_id],
+        'recipient': usernames[recipient_id],
+        'content': content,
+        'attachment': attachment,
+        'read': read
+    }
+
+
+def _encode_jsonl(records):
+    return ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode()
+
+
+def _encode_csv(records, include_header=False):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    if include_header:
+        writer.writeheader()
+    writer.writerows(records)
+    return buffer.getvalue().encode()
+
+
+def iter_chat_export(user, other_user, export_format, compress=False):
+    '''
+    Yields the messages sent between two users, including archived messages, oldest first as chunks of JSON Lines or CSV.
+    The messages are read from a server-side cursor a chunk at a time, so memory use doesn't grow with the size of the chat.
+    Nothing is written, so unlike loading the chat, no messages are marked as read.
+    - compress: whether the chunks are gzip compressed
+    '''
+    chunk_size = settings.CHAT_EXPORT_CHUNK_SIZE
+    usernames = {user.id: user.username, other_user.id: other_user.username}
+    # 16 is added to the window size so a gzip header and trailer are written
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+
+    def encode(data):
+        return compressor.compress(data) if compressor else data
+
+    if export_format == 'csv':
+        yield encode(_encode_csv([], include_header=True))
+
+    # The archived messages are not all older than the messages still in the Message table, so both are merged in order
+    rows = heapq.merge(_iter_archived_rows(user, other_user), _iter_message_rows(user, other_user, chunk_size))
+    while chunk := list(islice(rows, chunk_size)):
+        records = [_get_record(row, usernames) for row in chunk]
+        data = encode(_encode_csv(records) if export_format == 'csv' else _encode_jsonl(records))
+        if data:
+            yield data
+
+    if compressor:
+        yield compressor.flush()
+
+
+async def aiter_chat_export(user, other_user, export_format, compress=False):
+    '''
+    Yields the chunks of iter_chat_export() one at a time from a thread. A streaming response served under ASGI would otherwise
+    read a synchronous iterator to the end before sending any of it.
+    '''
+    chunks = iter_chat_export(user, other_user, export_format, compress)
+    get_next_chunk = sync_to_async(next)
+    try:
+        while (chunk := await get_next_chunk(chunks, None)) is not None:
+            yield chunk
+    finally:
+        # Closes the database cursor if the client disconnects before the export is complete
+        await sync_to_async(chunks.close)()
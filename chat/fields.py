@@ -0,0 +1,100 @@
+import zlib
+from django.conf import settings
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+
+def compress_text(text):
+    '''Returns the text zlib compressed if it is long enough for compression to save space, otherwise None'''
+    data = text.encode()
+    if len(data) >= settings.MESSAGE_COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return compressed
+    return None
+
+
+def get_stored_text(text, compressed):
+    '''Returns the value of a CompressedTextField from its stored columns, e.g. when they are read with values_list()'''
+    if compressed is None:
+        return text
+    return zlib.decompress(compressed).decode()
+
+
+class CompressedTextDescriptor(DeferredAttribute):
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        # A deferred value is loaded together with its compressed value, which is decompressed when the instance is created
+        if self.field.attname not in instance.__dict__:
+            instance.refresh_from_db(fields=[self.field.attname, self.field.compressed_field])
+        return instance.__dict__[self.field.attname]
+
+
+class CompressedTextField(models.TextField):
+    '''
+    A TextField whose long values are stored zlib compressed in a separate BinaryField, leaving this column empty.
+    The compressed bytes are stored as they are, rather than encoded as text, which would make them a third larger.
+    Values which are not compressed are stored unchanged, so the field can replace an existing TextField without rewriting its rows.
+    Lookups other than exact matches on short values do not work on compressed values.
+    - compressed_field: the name of the BinaryField, which has to be declared after this field so it is saved after being filled in
+    '''
+    descriptor_class = CompressedTextDescriptor
+
+    def __init__(self, *args, compressed_field, **kwargs):
+        self.compressed_field = compressed_field
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['compressed_field'] = self.compressed_field
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super().contribute_to_class(cls, name, **kwargs)
+        # Abstract models are never instantiated, so only their concrete subclasses need decompressing
+        if not cls._meta.abstract:
+            models.signals.post_init.connect(self.decompress_value, sender=cls)
+
+    def decompress_value(self, instance, **kwargs):
+        compressed = instance.__dict__.get(self.compressed_field)
+        if compressed is not None and instance.__dict__.get(self.attname) == '':
+            instance.__dict__[self.attname] = get_stored_text('', compressed)
+
+    def pre_save(self, model_instance, add):
+        text = super().pre_save(model_instance, add)
+        compressed = compress_text(text)
+        setattr(model_instance, self.compressed_field, compressed)
+        return '' if compressed is not None else text
+
+
+def get_preview(text, visible_characters):
+    return (text[:visible_characters] + '...' if len(text) > visible_characters else text).replace('\n', ' ')
+
+
+class PreviewField(models.CharField):
+    '''
+    A CharField holding the start of another text field, which is filled in whenever its model instance is saved or bulk created.
+    - source: the name of the text field
+    - visible_characters: the number of characters of the text field to keep
+    '''
+
+    def __init__(self, *args, source, visible_characters, **kwargs):
+        self.source = source
+        self.visible_characters = visible_characters
+        kwargs.setdefault('max_length', visible_characters + len('...'))
+        kwargs.setdefault('default', '')
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        kwargs['visible_characters'] = self.visible_characters
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        text = getattr(model_instance, self.source)
+        value = get_preview(text, self.visible_characters)
+        setattr(model_instance, self.attname, value)
+        return value
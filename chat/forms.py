@@ -1,5 +1,7 @@
+import os
 from django import forms
-from .models import Message
+from django.conf import settings
+from .models import Message, Attachment, Conversation, GroupMessage
 
 
 class MessageForm(forms.ModelForm):
@@ -20,6 +22,9 @@ class MessageForm(forms.ModelForm):
         content = entered_content.strip()
         are_friends = self.initial.get('are_friends')
 
+        if self.initial.get('is_blocked'):
+            raise forms.ValidationError('You cannot send messages to this user')
+
         if not are_friends:
             raise forms.ValidationError('You are not friends with this user')
         
@@ -27,4 +32,68 @@ class MessageForm(forms.ModelForm):
         # if not content:
         #     raise forms.ValidationError('You cannot send empty messages')
 
-        return content
\ No newline at end of file
+        return content
+
+
+class AttachmentUploadForm(forms.ModelForm):
+    class Meta:
+        model = Attachment
+        fields = ['filename', 'content_type', 'size']
+
+    def clean_filename(self):
+        # Only keep the name of the file, in case the browser included its path
+        filename = os.path.basename(self.cleaned_data['filename'].replace('\\', '/'))
+        if not filename:
+            raise forms.ValidationError('This file does not have a name')
+        return filename
+
+    def clean_size(self):
+        size = self.cleaned_data['size']
+
+        if not self.initial.get('are_friends'):
+            raise forms.ValidationError('You are not friends with this user')
+
+        if size == 0:
+            raise forms.ValidationError('You cannot send empty files')
+
+        if size > settings.ATTACHMENT_MAX_SIZE:
+            raise forms.ValidationError('This file is too large to send')
+
+        return size
+
+    def clean_content_type(self):
+        return self.cleaned_data['content_type'] or 'application/octet-stream'
+
+
+class ConversationForm(forms.ModelForm):
+    members = forms.ModelMultipleChoiceField(queryset=None, widget=forms.CheckboxSelectMultiple)
+
+
+    class Meta:
+        model = Conversation
+        fields = ['name']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['members'].queryset = self.initial['user'].friends_mutual
+
+
+class AddMembersForm(forms.Form):
+    members = forms.ModelMultipleChoiceField(queryset=None, widget=forms.CheckboxSelectMultiple)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Members can only add their own friends who are not already in the conversation
+        self.fields['members'].queryset = self.initial['user'].friends_mutual.exclude(memberships__conversation=self.initial['conversation'])
+
+
+class GroupMessageForm(forms.ModelForm):
+    content = forms.CharField()
+
+
+    class Meta:
+        model = GroupMessage
+        fields = ['content']
+
+    def clean_content(self):
+        return self.cleaned_data['content'].strip()
@@ -0,0 +1,151 @@
+import threading
+from collections import OrderedDict, defaultdict
+from hashlib import md5
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.html import escape
+
+RECENT_CHAT_TEMPLATE = 'chat/partials/recent_chat.html'
+FRIEND_TEMPLATE = 'users/partials/friend.html'
+INCOMING_REQUEST_TEMPLATE = 'users/partials/incoming_request.html'
+OUTGOING_REQUEST_TEMPLATE = 'users/partials/outgoing_request.html'
+
+# Rendered in place of the CSRF token, which is filled in after the fragment is taken from the cache, so fragments are shared between
+# sessions
+CSRF_TOKEN_PLACEHOLDER = '__csrf_token__'
+
+
+class FragmentCache:
+    '''
+    Caches rendered template fragments, keyed by (template, entity id, entity version).
+    Fragments are kept in a local memory LRU tier, and optionally in a shared cache tier.
+    '''
+
+    def __init__(self, maxsize, shared_cache_alias=None):
+        self.maxsize = maxsize
+        self.shared_cache_alias = shared_cache_alias
+        self._fragments = OrderedDict()
+        # Entity id -> keys of the entity's fragments in the local tier, so they can be evicted without scanning every fragment
+        self._keys_by_entity = defaultdict(set)
+        self._lock = threading.Lock()
+
+    @property
+    def shared_cache(self):
+        return caches[self.shared_cache_alias] if self.shared_cache_alias else None
+
+    @staticmethod
+    def _get_shared_key(key):
+        return f'fragment_{md5(repr(key).encode(), usedforsecurity=False).hexdigest()}'
+
+    def get(self, key):
+        with self._lock:
+            if key in self._fragments:
+                self._fragments.move_to_end(key)
+                return self._fragments[key]
+
+        if self.shared_cache is None:
+            return None
+
+        html = self.shared_cache.get(self._get_shared_key(key))
+        if html is not None:
+            self._set_local(key, html)
+        return html
+
+    def _set_local(self, key, html):
+        with self._lock:
+            self._fragments[key] = html
+            self._fragments.move_to_end(key)
+            self._keys_by_entity[key[1]].add(key)
+            if len(self._fragments) > self.maxsize:
+                oldest_key, _ = self._fragments.popitem(last=False)
+                self._discard_entity_key(oldest_key)
+
+    def _discard_entity_key(self, key):
+        entity_keys = self._keys_by_entity.get(key[1])
+        if entity_keys is not None:
+            entity_keys.discard(key)
+            if not entity_keys:
+                del self._keys_by_entity[key[1]]
+
+    def set(self, key, html):
+        self._set_local(key, html)
+
+        if self.shared_cache is not None:
+            self.shared_cache.set(self._get_shared_key(key), html)
+
+    def evict(self, entity_id, template_names=None):
+        '''Removes an entity's fragments from the local tier, which are no longer going to be used'''
+        with self._lock:
+            for key in list(self._keys_by_entity.get(entity_id, ())):
+                template_name, _, _ = key
+                if template_names is None or template_name in template_names:
+                    del self._fragments[key]
+                    self._discard_entity_key(key)
+
+
+fragment_cache = FragmentCache(settings.FRAGMENT_CACHE_SIZE, settings.FRAGMENT_CACHE_SHARED_ALIAS)
+
+
+def render_fragment(template_name, entity_id, entity_version, context):
+    '''
+    Returns a rendered template fragment, only rendering the template if the fragment is not cached.
+    The entity version must contain every value in the context which the fragment depends on, other than the entity id.
+    '''
+    key = (template_name, entity_id, entity_version)
+    html = fragment_cache.get(key)
+
+    if html is None:
+        html = render_to_string(template_name, context)
+        fragment_cache.set(key, html)
+
+    return html
+
+
+def _serialize_user(user):
+    return user if isinstance(user, dict) else user.serialize()
+
+
+def render_recent_chat(user, other_user, last_message, unread_count, path=None):
+    other_user = _serialize_user(other_user)
+    is_active = path is not None and path == reverse('direct_message', args=[other_user['uuid']])
+    entity_version = (
+        other_user['username'],
+        other_user['avatar'] and other_user['avatar']['version'],
+        last_message['uuid'],
+        last_message['read'],
+        last_message['sender']['username'],
+        unread_count,
+        str(user.uuid),
+        is_active
+    )
+    return render_fragment(RECENT_CHAT_TEMPLATE, other_user['uuid'], entity_version, {
+        'last_message': last_message,
+        'user': _serialize_user(user),
+        'other_user': other_user,
+        'unread_count': unread_count,
+        'request': {'path': path if is_active else None}
+    })
+
+
+def _render_user_fragment(template_name, context_name, other_user, csrf_token):
+    other_user = _serialize_user(other_user)
+    entity_version = (other_user['username'], other_user['avatar'] and other_user['avatar']['version'])
+    html = render_fragment(template_name, other_user['uuid'], entity_version, {
+        context_name: other_user,
+        'csrf_token': CSRF_TOKEN_PLACEHOLDER
+    })
+    return html.replace(CSRF_TOKEN_PLACEHOLDER, escape(csrf_token or ''))
+
+
+def render_friend(friend, csrf_token):
+    return _render_user_fragment(FRIEND_TEMPLATE, 'friend', friend, csrf_token)
+
+
+def render_incoming_request(sender, csrf_token):
+    return _render_user_fragment(INCOMING_REQUEST_TEMPLATE, 'sender', sender, csrf_token)
+
+
+def render_outgoing_request(recipient, csrf_token):
+    return _render_user_fragment(OUTGOING_REQUEST_TEMPLATE, 'recipient', recipient, csrf_token)
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from copy import deepcopy
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+logger = logging.getLogger(__name__)
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    '''
+    A Redis channel layer which delivers messages to channels in this process directly, without going through Redis.
+    Group membership is still stored in Redis, so messages sent from other processes reach this process's channels as normal.
+    The capacity of a local channel applies to its receive buffer, which holds the messages that would otherwise be waiting in Redis.
+    Messages a local channel has received from Redis but not yet consumed also count towards it. Buffered messages expire after the
+    layer's expiry, as they would in Redis.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Group name -> {name of a channel in this process: time it was added to the group}
+        self.local_groups = defaultdict(dict)
+        # Channel name -> groups in local_groups, so a channel's memberships can be removed once it stops receiving
+        self.local_channel_groups = defaultdict(set)
+        # Channels created in this process whose receiving hasn't been cancelled. Messages for other channels are dropped, rather than
+        # being buffered for a consumer which has stopped.
+        self.receiving_channels = set()
+        # Non-local channel name -> task receiving messages from Redis for this process's channels
+        self.remote_receivers = {}
+        self.local_event_loop = None
+
+    def is_local_channel(self, channel):
+        return '!' in channel and self.non_local_name(channel).endswith(self.client_prefix + '!')
+
+    async def new_channel(self, prefix='specific'):
+        channel = await super().new_channel(prefix)
+        self.receiving_channels.add(channel)
+        return channel
+
+    def _buffer_message(self, channel, message):
+        # Stored with the time it expires at, which is checked when the message is received
+        self.receive_buffer[channel].put_nowait((time.time() + self.expiry, message))
+
+    def _deliver_locally(self, channel, message):
+        '''
+        Puts a message in a local channel's receive buffer, and returns False without delivering it if the channel is full.
+        Messages for channels which are no longer receiving are dropped.
+        '''
+        if channel not in self.receiving_channels:
+            return True
+        if self.receive_buffer[channel].qsize() >= self.get_capacity(channel):
+            return False
+
+        # Each channel is given its own copy of the message, as if it had been deserialized from Redis
+        message = deepcopy(message)
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if self.local_event_loop is None or running_loop is self.local_event_loop:
+            self._buffer_message(channel, message)
+        else:
+            self.local_event_loop.call_soon_threadsafe(self._buffer_message, channel, message)
+        return True
+
+    async def send(self, channel, message):
+        if not self.is_local_channel(channel):
+            return await super().send(channel, message)
+
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        if not self._deliver_locally(channel, message):
+            raise ChannelFull()
+
+    async def _receive_remote_messages(self, real_channel):
+        while True:
+            try:
+                message_channel, message = await self.receive_single(real_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Error receiving messages from Redis for %s', real_channel)
+                await asyncio.sleep(1)
+                continue
+
+            message_channels = message_channel if isinstance(message_channel, list) else [message_channel]
+            for channel in message_channels:
+                if channel in self.receiving_channels:
+                    self._buffer_message(channel, message)
+
+    def _ensure_remote_receiver(self, real_channel):
+        loop = asyncio.get_running_loop()
+        if self.local_event_loop is not loop:
+            self.local_event_loop = loop
+            self.remote_receivers.clear()
+
+        remote_receiver = self.remote_receivers.get(real_channel)
+        if remote_receiver is None or remote_receiver.done():
+            self.remote_receivers[real_channel] = asyncio.create_task(self._receive_remote_messages(real_channel))
+
+    async def receive(self, channel):
+        if not self.is_local_channel(channel):
+            return await super().receive(channel)
+
+        assert self.valid_channel_name(channel)
+        # A single task per process receives messages from Redis and buffers them, so local deliveries never wait behind it
+        self._ensure_remote_receiver(self.non_local_name(channel))
+
+        try:
+            while True:
+                expires_at, message = await self.receive_buffer[channel].get()
+                if expires_at > time.time():
+                    return message
+        except asyncio.CancelledError:
+            self._remove_channel(channel)
+            raise
+
+    def _remove_channel(self, channel):
+        '''Drops a channel which has stopped receiving, along with its buffered messages and any memberships which weren't discarded'''
+        self.receiving_channels.discard(channel)
+        self.receive_buffer.pop(channel, None)
+        for group in self.local_channel_groups.pop(channel, ()):
+            self._discard_local_membership(group, channel)
+
+    def _discard_local_membership(self, group, channel):
+        local_channels = self.local_groups.get(group)
+        if local_channels is not None:
+            local_channels.pop(channel, None)
+            if not local_channels:
+                del self.local_groups[group]
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+
+        if self.is_local_channel(channel):
+            self.local_groups[group][channel] = time.time()
+            self.local_channel_groups[channel].add(group)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+
+        self._discard_local_membership(group, channel)
+        channel_groups = self.local_channel_groups.get(channel)
+        if channel_groups is not None:
+            channel_groups.discard(group)
+            if not channel_groups:
+                del self.local_channel_groups[channel]
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), 'Group name not valid'
+
+        # Memberships expire locally the same way as they do in Redis
+        min_added_time = time.time() - self.group_expiry
+        local_channels = [channel for channel, added_time in self.local_groups.get(group, {}).items() if added_time > min_added_time]
+        # As with Redis, channels which are full are skipped rather than failing the whole send
+        channels_over_capacity = sum(not self._deliver_locally(channel, message) for channel in local_channels)
+        if channels_over_capacity > 0:
+            logger.info('%s of %s local channels over capacity in group %s', channels_over_capacity, len(local_channels), group)
+
+        # Only channels in other processes are sent the message through Redis
+        await super().group_send(group, message)
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        remote_channel_names = [channel for channel in channel_names if not self.is_local_channel(channel)]
+        return super()._map_channel_keys_to_connection(remote_channel_names, message)
+
+    async def flush(self):
+        self.local_groups.clear()
+        self.local_channel_groups.clear()
+        for remote_receiver in self.remote_receivers.values():
+            remote_receiver.cancel()
+        self.remote_receivers.clear()
+
+        await super().flush()
@@ -0,0 +1,54 @@
+import base64
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from .task_queue import task
+
+
+def serialize_email(message):
+    return {
+        'subject': message.subject,
+        'body': message.body,
+        'from_email': message.from_email,
+        'to': message.to,
+        'cc': message.cc,
+        'bcc': message.bcc,
+        'reply_to': message.reply_to,
+        'headers': message.extra_headers,
+        'alternatives': [list(alternative) for alternative in getattr(message, 'alternatives', [])],
+        'attachments': [
+            [filename, base64.b64encode(content.encode() if isinstance(content, str) else content).decode(), mimetype]
+            for filename, content, mimetype in message.attachments
+        ],
+        'content_subtype': message.content_subtype
+    }
+
+
+@task
+def send_email(data):
+    '''Sends a queued email with QUEUED_EMAIL_BACKEND'''
+    message = EmailMultiAlternatives(
+        subject=data['subject'],
+        body=data['body'],
+        from_email=data['from_email'],
+        to=data['to'],
+        cc=data['cc'],
+        bcc=data['bcc'],
+        reply_to=data['reply_to'],
+        headers=data['headers'],
+        alternatives=[tuple(alternative) for alternative in data['alternatives']],
+        connection=get_connection(settings.QUEUED_EMAIL_BACKEND, fail_silently=False)
+    )
+    message.content_subtype = data['content_subtype']
+    for filename, content, mimetype in data['attachments']:
+        message.attach(filename, base64.b64decode(content), mimetype)
+    message.send()
+
+
+class QueuedEmailBackend(BaseEmailBackend):
+    '''Queues each email as a task, so it is sent by the task worker and retried if sending fails'''
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            send_email.enqueue(serialize_email(message))
+        return len(email_messages)
@@ -0,0 +1,21 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.models import ArchivedMessages
+
+
+class Command(BaseCommand):
+    help = 'Moves read messages from whole months older than a threshold into the compressed message archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days', type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS,
+            help='Archive the months which ended at least this many days ago'
+        )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['older_than_days'])
+        archived_count = ArchivedMessages.archive_messages(before)
+        cutoff = ArchivedMessages.get_period_start(before)
+        self.stdout.write(f'Archived {archived_count} messages sent before {cutoff:%Y-%m-%d}')
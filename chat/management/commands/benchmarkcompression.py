@@ -0,0 +1,89 @@
+import random
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from chat.models import Message
+
+User = get_user_model()
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+
+def get_log_text(rng, size):
+    '''Returns text resembling a pasted log, which is what most long messages are'''
+    lines = []
+    length = 0
+    while length < size:
+        line = f'2024-05-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} {rng.choice(LOG_LEVELS)} worker-{rng.randint(1, 8)} request {rng.getrandbits(32):08x} took {rng.randint(1, 900)}ms'
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+
+class Command(BaseCommand):
+    help = 'Compares the storage size and read latency of long messages with and without compression. Nothing is kept in the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help='Number of messages to create')
+        parser.add_argument('--size', type=int, default=8000, help='Number of characters in each message')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for generating the message content')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        contents = [get_log_text(rng, options['size']) for _ in range(options['messages'])]
+
+        uncompressed_results = self._run(contents, compression_threshold=float('inf'))
+        compressed_results = self._run(contents, compression_threshold=settings.MESSAGE_COMPRESSION_THRESHOLD)
+
+        self.stdout.write(f'{options["messages"]} messages of {options["size"]} characters')
+        self.stdout.write(f'{"":<28}{"uncompressed":>16}{"compressed":>16}')
+        for label, key in [
+            ('Stored content (bytes)', 'stored_bytes'),
+            ('Table size (bytes)', 'table_bytes'),
+            ('Read full content (ms)', 'read_full_ms'),
+            ('Read previews (ms)', 'read_preview_ms'),
+        ]:
+            self.stdout.write(f'{label:<28}{uncompressed_results[key]:>16}{compressed_results[key]:>16}')
+
+    def _get_table_size(self):
+        if connection.vendor != 'postgresql':
+            return 'n/a'
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_total_relation_size(%s)', [Message._meta.db_table])
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def _time_ms(func):
+        start = time.perf_counter()
+        func()
+        return round((time.perf_counter() - start) * 1000, 1)
+
+    def _run(self, contents, compression_threshold):
+        with override_settings(MESSAGE_COMPRESSION_THRESHOLD=compression_threshold), transaction.atomic():
+            sender = User.objects.create(username='benchmark_sender', email='benchmark_sender@example.com')
+            recipient = User.objects.create(username='benchmark_recipient', email='benchmark_recipient@example.com')
+
+            table_size_before = self._get_table_size()
+            Message.objects.bulk_create([
+                Message(sender=sender, recipient=recipient, content=content)
+                for content in contents
+            ], batch_size=500)
+            table_size_after = self._get_table_size()
+
+            messages = Message.objects.filter(sender=sender)
+            # values_list() returns the stored columns without decompressing them
+            stored_values = messages.values_list('content', 'compressed_content')
+
+            results = {
+                'stored_bytes': sum(len(text.encode()) + len(compressed or b'') for text, compressed in stored_values),
+                'table_bytes': table_size_after - table_size_before if connection.vendor == 'postgresql' else table_size_after,
+                'read_full_ms': self._time_ms(lambda: [message.content for message in messages]),
+                'read_preview_ms': self._time_ms(lambda: [message.preview for message in messages.defer('content', 'compressed_content')]),
+            }
+
+            transaction.set_rollback(True)
+
+        return results
@@ -0,0 +1,99 @@
+import statistics
+import time
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+from django.db.backends.signals import connection_created
+from chat.consumers import ChatConsumer
+from chat.models import Message
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the latency of the page_load and chat_send WebSocket paths with and without the connection pool. '
+        'Each iteration ends like a handler does, by releasing the connection. Nothing is kept in the database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=500, help='Number of times each path is run in each mode')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('The connection pool is only supported on PostgreSQL')
+        if 'pool' not in connection.settings_dict['OPTIONS']:
+            raise CommandError('DB_POOL_ENABLED is not enabled')
+
+        pool_options = connection.settings_dict['OPTIONS']
+        sender = User.objects.create(username='benchmark_sender', email='benchmark_sender@example.com')
+        recipient = User.objects.create(username='benchmark_recipient', email='benchmark_recipient@example.com')
+        try:
+            sender.add_friend(recipient)
+            recipient.add_friend(sender)
+            unpooled_results = self._run(sender, recipient, options['iterations'], {key: value for key, value in pool_options.items() if key != 'pool'})
+            pooled_results = self._run(sender, recipient, options['iterations'], pool_options)
+        finally:
+            connection.settings_dict['OPTIONS'] = pool_options
+            Message.objects.filter(sender=sender).delete()
+            sender.delete()
+            recipient.delete()
+
+        self.stdout.write(f'{options["iterations"]} iterations of each path')
+        self.stdout.write(f'{"":<28}{"unpooled":>16}{"pooled":>16}')
+        for label, key in [
+            ('page_load mean (ms)', 'page_load_mean_ms'),
+            ('page_load p95 (ms)', 'page_load_p95_ms'),
+            ('chat_send mean (ms)', 'chat_send_mean_ms'),
+            ('chat_send p95 (ms)', 'chat_send_p95_ms'),
+            ('Connections opened', 'connections_opened'),
+        ]:
+            self.stdout.write(f'{label:<28}{unpooled_results[key]:>16}{pooled_results[key]:>16}')
+
+    @staticmethod
+    def _time_ms(func, iterations):
+        durations = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            async_to_sync(func)()
+            durations.append((time.perf_counter() - start) * 1000)
+            # Release the connection as at the end of a handler, which closes it or returns it to the pool
+            close_old_connections()
+        return round(statistics.mean(durations), 2), round(statistics.quantiles(durations, n=20)[-1], 2)
+
+    def _run(self, sender, recipient, iterations, database_options):
+        connection.close()
+        connection.close_pool()
+        connection.settings_dict['OPTIONS'] = database_options
+
+        connections_opened = 0
+
+        def count_connection(**kwargs):
+            nonlocal connections_opened
+            connections_opened += 1
+
+        consumer = ChatConsumer()
+        consumer.user = sender
+        consumer._handle_page_unload()
+
+        connection_created.connect(count_connection)
+        try:
+            page_load_mean, page_load_p95 = self._time_ms(lambda: consumer._handle_page_load(f'/{recipient.uuid}/'), iterations)
+            chat_send_mean, chat_send_p95 = self._time_ms(lambda: consumer._create_message('benchmark message'), iterations)
+        finally:
+            connection_created.disconnect(count_connection)
+
+        if connection.pool is not None:
+            # Taking a connection from the pool also sends connection_created, so the pool's count is used instead
+            connections_opened = connection.pool.get_stats().get('connections_num', 0)
+
+        connection.close()
+        connection.close_pool()
+        return {
+            'page_load_mean_ms': page_load_mean,
+            'page_load_p95_ms': page_load_p95,
+            'chat_send_mean_ms': chat_send_mean,
+            'chat_send_p95_ms': chat_send_p95,
+            'connections_opened': connections_opened,
+        }
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.tasks import clean_up_attachments
+
+
+class Command(BaseCommand):
+    help = 'Deletes attachment uploads which were never completed, and removes stored files which no attachment refers to any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-hours', type=int, default=settings.ATTACHMENT_UPLOAD_EXPIRY_HOURS,
+            help='Delete the uploads started, and remove the files stored, at least this many hours ago'
+        )
+
+    def handle(self, *args, **options):
+        upload_count, file_count = clean_up_attachments(options['older_than_hours'])
+        self.stdout.write(f'Removed {upload_count} partial uploads and {file_count} unreferenced files')
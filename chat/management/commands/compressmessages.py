@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from chat.models import Message, PREVIEW_CHARACTERS
+from chat.fields import compress_text, get_preview
+
+
+class Command(BaseCommand):
+    help = 'Compresses the content and fills in the preview of messages saved before message compression was added'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of messages updated per query')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        updated_count = 0
+        last_pk = None
+
+        # Paged through by primary key, since messages with no content, such as attachments, still have an empty preview once updated
+        while True:
+            messages = Message.objects.filter(preview='').order_by('pk')
+            if last_pk is not None:
+                messages = messages.filter(pk__gt=last_pk)
+            messages = list(messages[:batch_size])
+            if not messages:
+                break
+            last_pk = messages[-1].pk
+
+            # bulk_update() doesn't call pre_save(), so the content is moved to the compressed column here when it is long enough
+            for message in messages:
+                message.preview = get_preview(message.content, PREVIEW_CHARACTERS)
+                message.compressed_content = compress_text(message.content)
+                if message.compressed_content is not None:
+                    message.content = ''
+
+            Message.objects.bulk_update(messages, ['content', 'compressed_content', 'preview'])
+            updated_count += len(messages)
+            if len(messages) < batch_size:
+                break
+
+        self.stdout.write(f'Updated {updated_count} messages')
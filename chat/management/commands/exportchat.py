@@ -0,0 +1,45 @@
+import sys
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from chat.exports import EXPORT_CONTENT_TYPES, iter_chat_export
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Exports the messages sent between two users, including archived messages, oldest first as JSON Lines or CSV. '
+        'The export is streamed from the database, and no messages are marked as read.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='Username of one of the users')
+        parser.add_argument('other_username', help='Username of the other user')
+        parser.add_argument('--format', choices=EXPORT_CONTENT_TYPES, default='jsonl', help='Format of the export')
+        parser.add_argument('--compress', action='store_true', help='Compress the export with gzip')
+        parser.add_argument('--output', default='-', help='File the export is written to, or - for standard output')
+
+    @staticmethod
+    def _get_user(username):
+        try:
+            return User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError(f'User {username!r} does not exist')
+
+    def handle(self, *args, **options):
+        user = self._get_user(options['username'])
+        other_user = self._get_user(options['other_username'])
+        chunks = iter_chat_export(user, other_user, options['format'], options['compress'])
+
+        if options['output'] == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+
+        size = 0
+        with open(options['output'], 'wb') as output_file:
+            for chunk in chunks:
+                output_file.write(chunk)
+                size += len(chunk)
+        self.stdout.write(f'Wrote {size} bytes to {options["output"]}')
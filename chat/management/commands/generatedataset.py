@@ -0,0 +1,162 @@
+import random
+import time
+from datetime import timedelta
+from itertools import accumulate, islice
+from uuid import UUID
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from chat.models import Message
+
+User = get_user_model()
+
+WORDS = (
+    'hey hi hello yes no maybe ok okay sure thanks lol haha what when where why how who the a an and or but so because '
+    'i you we they it this that is are was were be have has had do did will would can could should not just really very '
+    'good great nice cool fine bad late early today tomorrow tonight yesterday now later soon time meeting lunch dinner '
+    'coffee work home call message send check look see know think want need like love going come back sorry done'
+).split()
+
+
+def get_uuid(rng):
+    return UUID(int=rng.getrandbits(128), version=4)
+
+
+def get_message_text(rng):
+    '''Returns text of a skewed length, where most messages are a few words and a few are much longer'''
+    word_count = min(300, int(rng.paretovariate(1.2) * 3))
+    return ' '.join(rng.choices(WORDS, k=word_count))
+
+
+def get_weights(rng, count, alpha):
+    '''Returns count power-law distributed weights, each at least 1'''
+    return [rng.paretovariate(alpha) for _ in range(count)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates users, a power-law friendship graph including pending friend requests, and messages between friends, '
+        'for benchmarking. The data is deterministic for a seed, with timestamps relative to the current time. '
+        'Run with BENCH_MODE=True so that the generated users can log in quickly.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Number of users to create')
+        parser.add_argument('--messages', type=int, default=100000, help='Number of messages to create')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for generating the data')
+        parser.add_argument('--prefix', default='bench_', help='Prefix of the generated usernames')
+        parser.add_argument('--password', default='password', help='Password of every generated user')
+        parser.add_argument('--min-friends', type=int, default=2, help='Minimum number of friendships started by each user')
+        parser.add_argument('--max-friends', type=int, default=500, help='Maximum number of friendships started by each user')
+        parser.add_argument('--alpha', type=float, default=1.5, help='Exponent of the power-law distributions, where lower values are more skewed')
+        parser.add_argument('--pending-ratio', type=float, default=0.1, help='Fraction of friendships which are pending friend requests')
+        parser.add_argument('--read-ratio', type=float, default=0.95, help='Fraction of messages which have been read')
+        parser.add_argument('--days', type=int, default=365, help='Number of days the messages are spread over')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Number of rows inserted by each query')
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError(f'Users with the prefix {options["prefix"]!r} already exist, use a different --prefix')
+
+        rng = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+
+        user_ids = self._create_users(rng, options)
+        mutual_pairs = self._create_friendships(rng, user_ids, options)
+        self._create_messages(rng, mutual_pairs, options)
+
+    def _bulk_create(self, model, objects, label):
+        '''Inserts the objects in chunks, each in its own transaction'''
+        start = time.perf_counter()
+        total = 0
+        objects = iter(objects)
+        while chunk := list(islice(objects, self.chunk_size)):
+            with transaction.atomic():
+                model.objects.bulk_create(chunk, batch_size=self.chunk_size)
+            total += len(chunk)
+            self.stdout.write(f'\r{label}: {total}', ending='')
+            self.stdout.flush()
+        self.stdout.write(f'\r{label}: {total} in {time.perf_counter() - start:.1f}s')
+
+    def _create_users(self, rng, options):
+        if not settings.BENCH_MODE:
+            self.stdout.write(self.style.WARNING('BENCH_MODE is not enabled, so logging in as a generated user will be slow'))
+
+        # Every user has the same password, so it is only hashed once
+        password = make_password(options['password'])
+        prefix = options['prefix']
+        self._bulk_create(User, (
+            User(uuid=get_uuid(rng), username=f'{prefix}{i}', email=f'{prefix}{i}@example.com', password=password)
+            for i in range(options['users'])
+        ), 'Users')
+
+        # Not every database returns the ids of bulk created rows, so they are read back in the order the users were created
+        return list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+
+    def _create_friendships(self, rng, user_ids, options):
+        '''
+        Creates friendships where the number of friends of each user follows a power law, with popular users more
+        likely to be chosen as friends. Returns the pairs of users who are mutual friends.
+        '''
+        user_count = len(user_ids)
+        max_friends = min(options['max_friends'], user_count - 1)
+        degrees = [min(max_friends, int(options['min_friends'] * weight)) for weight in get_weights(rng, user_count, options['alpha'])]
+        cumulative_degrees = list(accumulate(degrees))
+
+        pairs = set()
+        for index, degree in enumerate(degrees):
+            for other_index in rng.choices(range(user_count), cum_weights=cumulative_degrees, k=degree):
+                if other_index != index:
+                    pairs.add((min(index, other_index), max(index, other_index)))
+
+        mutual_pairs = []
+        rows = []
+        Friendship = User.friends.through
+        for index, other_index in sorted(pairs):
+            user_id, other_user_id = user_ids[index], user_ids[other_index]
+            if rng.random() < options['pending_ratio']:
+                # A friend request from either of the users
+                if rng.random() < 0.5:
+                    user_id, other_user_id = other_user_id, user_id
+                rows.append(Friendship(from_user_id=user_id, to_user_id=other_user_id))
+            else:
+                rows.append(Friendship(from_user_id=user_id, to_user_id=other_user_id))
+                rows.append(Friendship(from_user_id=other_user_id, to_user_id=user_id))
+                mutual_pairs.append((user_id, other_user_id))
+
+        self._bulk_create(Friendship, rows, 'Friendships')
+        self.stdout.write(f'{len(mutual_pairs)} mutual friendships, {len(pairs) - len(mutual_pairs)} pending friend requests')
+        return mutual_pairs
+
+    def _create_messages(self, rng, mutual_pairs, options):
+        '''
+        Creates messages between mutual friends, where the number of messages in each chat follows a power law.
+        The oldest messages have been read, and the most recent ones are unread.
+        '''
+        if not mutual_pairs:
+            return
+
+        end = timezone.now()
+        duration = timedelta(days=options['days'])
+        read_before = end - duration * (1 - options['read_ratio'])
+        cumulative_weights = list(accumulate(get_weights(rng, len(mutual_pairs), options['alpha'])))
+
+        def generate_messages():
+            for pair_index in rng.choices(range(len(mutual_pairs)), cum_weights=cumulative_weights, k=options['messages']):
+                sender_id, recipient_id = mutual_pairs[pair_index]
+                if rng.random() < 0.5:
+                    sender_id, recipient_id = recipient_id, sender_id
+                timestamp = end - duration * rng.random()
+                yield Message(
+                    uuid=get_uuid(rng),
+                    sender_id=sender_id,
+                    recipient_id=recipient_id,
+                    content=get_message_text(rng),
+                    timestamp=timestamp,
+                    read=timestamp < read_before
+                )
+
+        self._bulk_create(Message, generate_messages(), 'Messages')
@@ -0,0 +1,87 @@
+import logging
+import signal
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from chat.task_queue import claim_tasks, renew_lease, run_due_tasks, run_task
+
+logger = logging.getLogger(__name__)
+
+
+def renew_lease_until(claimed_task, finished):
+    '''Renews the lease of a running task until it has finished, so a task running for longer than the lease isn't run twice'''
+    try:
+        while not finished.wait(settings.TASK_LEASE_RENEWAL_INTERVAL):
+            try:
+                renewed = renew_lease(claimed_task)
+            except Exception:
+                # Retried at the next interval, which is well within the lease
+                logger.exception('Failed to renew the lease of task %s', claimed_task)
+                continue
+
+            if not renewed:
+                logger.warning('Lease of task %s ended while it was running', claimed_task)
+                return
+    finally:
+        connection.close()
+
+
+def run_task_in_thread(claimed_task):
+    finished = threading.Event()
+    heartbeat = threading.Thread(target=renew_lease_until, args=(claimed_task, finished), daemon=True)
+    heartbeat.start()
+    try:
+        run_task(claimed_task)
+    finally:
+        finished.set()
+        heartbeat.join()
+        # The thread's connection is released between tasks, which returns it to the pool
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs queued background tasks, such as sending emails, with at most --concurrency running at a time. '
+        'On SIGTERM, no more tasks are claimed and the running tasks are finished before stopping.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.TASK_CONCURRENCY, help='Number of tasks run at a time')
+        parser.add_argument('--once', action='store_true', help='Run the tasks which are due one at a time, then stop')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(levelname)-8s %(message)s')
+
+        if options['once']:
+            count = run_due_tasks()
+            self.stdout.write(f'Ran {count} tasks')
+            return
+
+        stopping = threading.Event()
+
+        def handle_stop_signal(signum, frame):
+            stopping.set()
+
+        signal.signal(signal.SIGTERM, handle_stop_signal)
+        signal.signal(signal.SIGINT, handle_stop_signal)
+
+        concurrency = options['concurrency']
+        self.stdout.write(f'Running tasks, {concurrency} at a time')
+        running = set()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while not stopping.is_set():
+                # Only as many tasks are claimed as can start now, so other workers can run the rest
+                claimed_tasks = claim_tasks(concurrency - len(running)) if len(running) < concurrency else []
+                close_old_connections()
+                running |= {executor.submit(run_task_in_thread, claimed_task) for claimed_task in claimed_tasks}
+
+                if claimed_tasks and len(running) < concurrency:
+                    continue
+                if running:
+                    _, running = wait(running, timeout=settings.TASK_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                else:
+                    stopping.wait(settings.TASK_POLL_INTERVAL)
+
+            self.stdout.write(f'Finishing {len(running)} running tasks')
@@ -0,0 +1,232 @@
+import argparse
+import logging
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+from daphne.server import Server # Imported first, since it installs the asyncio Twisted reactor
+from daphne.access import AccessLogGenerator
+from daphne.ws_protocol import WebSocketProtocol
+from channels.routing import get_default_application
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from twisted.internet import reactor, task, threads
+
+# Seconds to wait after the drain window before stopping a worker, so the last closed connections can finish
+DRAIN_GRACE_PERIOD = 5
+
+# Seconds before restarting a worker which exited, doubled each time it exits again soon after being started, up to the maximum
+RESTART_DELAY = 1
+RESTART_MAX_DELAY = 60
+# Seconds a worker has to run for before it exiting is no longer counted as failing soon after being started
+RESTART_RESET_SECONDS = 60
+
+
+def get_worker_connections_key(index):
+    return f'asgi_worker_connections_{index}'
+
+
+def get_restart_delay(failures):
+    '''Returns the delay before restarting a worker which has exited soon after being started a number of times in a row'''
+    return min(RESTART_MAX_DELAY, RESTART_DELAY * 2 ** failures)
+
+
+def get_worker_drain_window(options):
+    # Workers are drained one after another, each over its share of the drain window
+    return options['drain_window'] / options['workers']
+
+
+class DrainingServer(Server):
+    '''A Daphne server which can be drained, by closing its WebSocket connections gradually before stopping'''
+
+    def __init__(self, *args, worker_index, drain_window, status_interval, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker_index = worker_index
+        self.drain_window = drain_window
+        self.status_interval = status_interval
+        self.ports = []
+        self.draining = False
+
+    def run(self):
+        task.LoopingCall(self.publish_connection_count).start(self.status_interval, now=False)
+        super().run()
+
+    def listen_success(self, port):
+        super().listen_success(port)
+        self.ports.append(port)
+
+    def get_open_websockets(self):
+        return [
+            protocol for protocol, details in self.connections.items()
+            if isinstance(protocol, WebSocketProtocol) and 'disconnected' not in details
+        ]
+
+    def publish_connection_count(self):
+        connection_count = len(self.get_open_websockets())
+        threads.deferToThread(cache.set, get_worker_connections_key(self.worker_index), connection_count, timeout=self.status_interval * 3)
+
+    def drain(self):
+        '''Stop accepting connections, then close the open WebSocket connections spread over the drain window'''
+        if self.draining:
+            return
+        self.draining = True
+
+        for port in self.ports:
+            port.stopListening()
+
+        for protocol in self.get_open_websockets():
+            reactor.callLater(random.uniform(0, self.drain_window), self._close_websocket, protocol)
+
+        reactor.callLater(self.drain_window + DRAIN_GRACE_PERIOD, self.stop)
+
+    @staticmethod
+    def _close_websocket(protocol):
+        # Close code 1012 (Service Restart) tells the HTMX WS extension to reconnect, which will be to another worker.
+        # The close frame is sent directly, since serverClose() only allows application defined close codes.
+        if protocol.state == protocol.STATE_OPEN:
+            protocol.sendCloseFrame(code=1012)
+
+
+class Command(BaseCommand):
+    help = 'Runs multiple ASGI worker processes sharing one socket, and drains them gracefully on SIGTERM'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+        parser.add_argument('--bind', default='0.0.0.0', help='Address to listen on')
+        parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+        parser.add_argument(
+            '--drain-window', type=float, default=30,
+            help='Seconds over which the workers are drained one after another, closing their WebSocket connections'
+        )
+        parser.add_argument('--status-interval', type=float, default=10, help='Seconds between reports of per-worker connection counts')
+        parser.add_argument(
+            '--metrics-port', type=int,
+            help='If given, each worker also listens on its own port, counting up from this one, so its metrics can be scraped directly'
+        )
+        parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+        parser.add_argument('--worker-index', type=int, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['worker_fd'] is not None:
+            self.run_worker(options)
+        else:
+            self.run_supervisor(options)
+
+    def run_worker(self, options):
+        logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(levelname)-8s %(message)s')
+
+        endpoints = [f'fd:fileno={options["worker_fd"]}']
+        if options['metrics_port'] is not None:
+            endpoints.append(f'tcp:port={options["metrics_port"]}:interface={options["bind"]}')
+
+        server = DrainingServer(
+            application=get_default_application(),
+            endpoints=endpoints,
+            signal_handlers=False,
+            action_logger=AccessLogGenerator(sys.stdout),
+            worker_index=options['worker_index'],
+            drain_window=options['drain_window'],
+            status_interval=options['status_interval']
+        )
+
+        def handle_stop_signal(signum, frame):
+            reactor.callFromThread(server.drain)
+
+        signal.signal(signal.SIGTERM, handle_stop_signal)
+        # Interrupting the launcher in a terminal also interrupts every worker, which are drained one at a time by the supervisor instead
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        server.run()
+
+    def _spawn_worker(self, index, listen_socket, options):
+        fd = listen_socket.fileno()
+        args = [
+            sys.executable, sys.argv[0], 'runworkers',
+            '--worker-fd', str(fd),
+            '--worker-index', str(index),
+            '--bind', options['bind'],
+            '--drain-window', str(get_worker_drain_window(options)),
+            '--status-interval', str(options['status_interval'])
+        ]
+        if options['metrics_port'] is not None:
+            args += ['--metrics-port', str(options['metrics_port'] + index)]
+        return subprocess.Popen(args, pass_fds=[fd], env=os.environ | {'ASGI_WORKER_COUNT': str(options['workers'])})
+
+    def _write_connection_counts(self, workers):
+        keys = [get_worker_connections_key(index) for index in workers]
+        counts = cache.get_many(keys)
+        for index, worker in workers.items():
+            count = counts.get(get_worker_connections_key(index), 'unknown')
+            self.stdout.write(f'Worker {index} (pid {worker.pid}): {count} open WebSocket connections')
+
+    def run_supervisor(self, options):
+        listen_socket = socket.create_server((options['bind'], options['port']), backlog=1024)
+        listen_socket.set_inheritable(True)
+
+        workers = {
+            index: self._spawn_worker(index, listen_socket, options)
+            for index in range(options['workers'])
+        }
+        started_at = dict.fromkeys(workers, time.monotonic())
+        restart_failures = dict.fromkeys(workers, 0)
+        restart_at = {}
+        self.stdout.write(f'Started {len(workers)} workers on {options["bind"]}:{options["port"]}')
+
+        stopping = False
+
+        def handle_stop_signal(signum, frame):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, handle_stop_signal)
+        signal.signal(signal.SIGINT, handle_stop_signal)
+
+        last_status_time = time.monotonic()
+        while not stopping:
+            time.sleep(1)
+            now = time.monotonic()
+
+            for index, worker in workers.items():
+                if index in restart_at:
+                    if now >= restart_at[index]:
+                        del restart_at[index]
+                        workers[index] = self._spawn_worker(index, listen_socket, options)
+                        started_at[index] = now
+                    continue
+
+                if worker.poll() is not None:
+                    # A worker which keeps exiting soon after being started, e.g. as it can't connect to the database, is restarted less
+                    # and less often
+                    if now - started_at[index] >= RESTART_RESET_SECONDS:
+                        restart_failures[index] = 0
+                    delay = get_restart_delay(restart_failures[index])
+                    restart_failures[index] += 1
+                    restart_at[index] = now + delay
+                    self.stderr.write(f'Worker {index} (pid {worker.pid}) exited with code {worker.returncode}, restarting in {delay} seconds')
+
+            if time.monotonic() - last_status_time >= options['status_interval']:
+                last_status_time = time.monotonic()
+                self._write_connection_counts(workers)
+
+        self.stdout.write(f'Draining workers one at a time over {options["drain_window"]} seconds')
+        # Only closes the supervisor's copy, so the workers which haven't been drained yet keep accepting connections
+        listen_socket.close()
+
+        # The connections closed by each worker reconnect to the workers which are still running, until the last one is drained
+        worker_drain_window = get_worker_drain_window(options)
+        running = [worker for worker in workers.values() if worker.poll() is None]
+        for position, worker in enumerate(running):
+            worker.send_signal(signal.SIGTERM)
+            if position < len(running) - 1:
+                time.sleep(worker_drain_window)
+
+        deadline = time.monotonic() + worker_drain_window + DRAIN_GRACE_PERIOD * 2
+        for index, worker in workers.items():
+            try:
+                worker.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                self.stderr.write(f'Worker {index} (pid {worker.pid}) did not stop in time, killing')
+                worker.kill()
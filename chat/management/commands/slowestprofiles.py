@@ -0,0 +1,40 @@
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.profiling import load_captures
+
+
+class Command(BaseCommand):
+    help = 'Lists the slowest requests and WebSocket handlers captured by the profiler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=10, help='Number of captures to list')
+        parser.add_argument('--hours', type=float, help='Only list captures from the last number of hours')
+        parser.add_argument('--kind', choices=['request', 'consumer'], help='Only list captures of requests or of WebSocket handlers')
+        parser.add_argument('--stats', action='store_true', help='Include the profile and the slowest queries of each capture')
+
+    def handle(self, *args, **options):
+        captures = load_captures()
+        if options['hours'] is not None:
+            captures = [capture for capture in captures if capture['timestamp'] >= time.time() - options['hours'] * 3600]
+        if options['kind'] is not None:
+            captures = [capture for capture in captures if capture['kind'] == options['kind']]
+
+        captures.sort(key=lambda capture: capture['duration'], reverse=True)
+        if not captures:
+            self.stdout.write('No captures found')
+            return
+
+        for capture in captures[:options['limit']]:
+            query_duration = sum(query['duration'] for query in capture['queries'])
+            self.stdout.write(
+                f'{capture["duration"] * 1000:8.1f}ms  {len(capture["queries"]):4d} queries ({query_duration * 1000:.1f}ms)  '
+                f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(capture["timestamp"]))}  {capture["kind"]:8}  {capture["name"]}'
+            )
+            self.stdout.write(f'    {os.path.join(settings.PROFILING_DIR, capture["id"] + ".prof")}')
+
+            if options['stats']:
+                for query in sorted(capture['queries'], key=lambda query: query['duration'], reverse=True)[:5]:
+                    self.stdout.write(f'    {query["duration"] * 1000:.1f}ms  {query["sql"]}')
+                self.stdout.write(capture['stats'])
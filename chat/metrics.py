@@ -0,0 +1,242 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template
+
+# Metrics are recorded from the event loop and from the threads running synchronous code, of which there can be one per request, so
+# each metric has a lock. Metrics are per process, and are labelled with the process id. runworkers --metrics-port gives each worker
+# its own port, so each process is scraped separately rather than whichever one accepts the connection.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_registry = []
+
+
+def _format_labels(label_names, label_values, extra=''):
+    labels = [f'{name}="{str(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        '''
+        - function: if given, the value is computed by calling it when the metrics are exposed. It returns the value, or a dict of
+          label values -> value for a metric with labels.
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.label_names = ('worker', *labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.function = function
+        _registry.append(self)
+
+    def _key(self, label_values):
+        return (os.getpid(), *label_values)
+
+    def samples(self):
+        '''Yields (name suffix, label values, extra label, value) for every sample of the metric'''
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for label_values, value in values.items():
+                yield '', self._key(label_values), '', value
+            return
+
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield '', label_values, '', value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.label_names, label_values, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        key = self._key(label_values)
+        bucket_index = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # The count of each bucket, with one more for values above the largest bucket, followed by the sum
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+            state[bucket_index] += 1
+            state[-1] += value
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def samples(self):
+        with self.lock:
+            values = [(label_values, list(state)) for label_values, state in self.values.items()]
+        for label_values, state in values:
+            cumulative_count = 0
+            for bucket, count in zip(self.buckets, state):
+                cumulative_count += count
+                yield '_bucket', label_values, f'le="{bucket}"', cumulative_count
+            cumulative_count += state[-2]
+            yield '_bucket', label_values, 'le="+Inf"', cumulative_count
+            yield '_sum', label_values, '', state[-1]
+            yield '_count', label_values, '', cumulative_count
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+def expose_metrics():
+    '''Returns every metric in the Prometheus text exposition format'''
+    return '\n'.join(metric.expose() for metric in _registry) + '\n'
+
+
+websocket_connections = Gauge(
+    'chat_websocket_connections', 'Number of open WebSocket connections'
+)
+consumer_handler_seconds = Histogram(
+    'chat_consumer_handler_seconds', 'Time taken by ChatConsumer to handle each type of event', labels=('event',)
+)
+group_send_seconds = Histogram(
+    'chat_group_send_seconds', 'Time taken to send an event to a channel layer group'
+)
+template_render_seconds = Histogram(
+    'chat_template_render_seconds', 'Time taken to render each template', labels=('template',)
+)
+view_db_queries = Histogram(
+    'chat_view_db_queries', 'Number of database queries made by each view', labels=('view',), buckets=COUNT_BUCKETS
+)
+view_db_seconds = Histogram(
+    'chat_view_db_seconds', 'Time spent on database queries by each view', labels=('view',)
+)
+throttling_actions = Counter(
+    'chat_throttling_actions_total', 'Number of throttling actions taken on WebSocket connections', labels=('action',)
+)
+
+
+def _get_pools():
+    '''Yields the alias and connection pool of each database which uses one'''
+    for alias in connections:
+        pool = getattr(connections[alias], 'pool', None)
+        if pool is not None:
+            yield alias, pool
+
+
+def _get_pool_stat(key, scale=1):
+    return lambda: {(alias,): pool.get_stats().get(key, 0) * scale for alias, pool in _get_pools()}
+
+
+def _get_pool_saturation():
+    values = {}
+    for alias, pool in _get_pools():
+        stats = pool.get_stats()
+        values[(alias,)] = (stats.get('pool_size', 0) - stats.get('pool_available', 0)) / max(stats.get('pool_max', 1), 1)
+    return values
+
+
+Gauge('chat_db_pool_max_connections', 'Maximum number of connections in the pool', labels=('database',), function=_get_pool_stat('pool_max'))
+Gauge('chat_db_pool_connections', 'Number of connections in the pool, in use or available', labels=('database',), function=_get_pool_stat('pool_size'))
+Gauge('chat_db_pool_available_connections', 'Number of idle connections in the pool', labels=('database',), function=_get_pool_stat('pool_available'))
+Gauge('chat_db_pool_saturation', 'Fraction of the maximum number of connections which are in use', labels=('database',), function=_get_pool_saturation)
+Gauge('chat_db_pool_waiting', 'Number of requests waiting for a connection from the pool', labels=('database',), function=_get_pool_stat('requests_waiting'))
+Counter('chat_db_pool_checkouts_total', 'Number of connections taken from the pool', labels=('database',), function=_get_pool_stat('requests_num'))
+Counter('chat_db_pool_wait_seconds_total', 'Time spent waiting for a connection from the pool', labels=('database',), function=_get_pool_stat('requests_wait_ms', 0.001))
+Counter('chat_db_pool_timeouts_total', 'Number of requests which timed out waiting for a connection', labels=('database',), function=_get_pool_stat('requests_errors'))
+Counter('chat_db_pool_opened_connections_total', 'Number of connections opened by the pool', labels=('database',), function=_get_pool_stat('connections_num'))
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+
+# The database query stats of the request currently being handled. The stats are shared with the thread running a synchronous view.
+current_query_stats = ContextVar('current_query_stats', default=None)
+# A list which the SQL and duration of each query is added to, while a request or handler is being profiled
+current_query_log = ContextVar('current_query_log', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    query_stats = current_query_stats.get()
+    query_log = current_query_log.get()
+    if query_stats is None and query_log is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        if query_stats is not None:
+            query_stats.count += 1
+            query_stats.duration += duration
+        if query_log is not None:
+            query_log.append({'sql': sql, 'duration': duration})
+
+
+class InstrumentedTemplate(Template):
+    def render(self, context=None, request=None):
+        with template_render_seconds.time(self.origin.template_name or '<string>'):
+            return super().render(context, request)
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    '''The Django template backend, recording the time taken to render each template'''
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return InstrumentedTemplate(template.template, self)
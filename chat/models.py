@@ -1,8 +1,126 @@
-from django.db import models
+import json
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.db import models, router, transaction
+from django.db.models.functions import Coalesce, Greatest, Least, RowNumber
 from django.conf import settings
+from django.urls import reverse
 from django.utils import timezone
-from uuid import uuid4
-from .utils import send_both_users_ws_message
+from itertools import islice
+from uuid import UUID, uuid4
+from .attachments import get_file_dir, get_upload_dir, iter_file_names, remove_file, remove_if_unmodified
+from .fields import CompressedTextField, PreviewField, get_preview, get_stored_text
+from .utils import send_both_users_ws_message, send_both_users_ws_message_async, send_user_ws_message, send_conversation_ws_message, get_conversation_group
+
+PREVIEW_CHARACTERS = 50
+
+
+def delete_in_batches(queryset, batch_size):
+    '''
+    Deletes the rows of a queryset in batches ordered by primary key, without loading the rows or sending signals, and yields the
+    number of rows deleted by each batch. Each batch is deleted in its own transaction, so locks are only held briefly.
+    '''
+    model = queryset.model
+    using = router.db_for_write(model)
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(batch.using(using).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+
+        with transaction.atomic(using=using):
+            deleted = model.objects.filter(pk__in=pks)._raw_delete(using)
+        yield deleted
+
+        if len(pks) < batch_size:
+            return
+        last_pk = pks[-1]
+
+
+class Attachment(models.Model):
+    '''
+    A file sent in a message, uploaded in chunks.
+    Once the upload is complete, the file is stored under the hash of its content, so files with the same content are only stored once.
+    '''
+    uuid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    sender = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='sent_attachments'
+    )
+    recipient = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='received_attachments'
+    )
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=255, blank=True)
+    size = models.PositiveBigIntegerField()
+    uploaded_size = models.PositiveBigIntegerField(default=0)
+    file_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.filename
+
+    def is_complete(self):
+        return bool(self.file_hash)
+
+    def can_access(self, user):
+        return user.id in (self.sender_id, self.recipient_id)
+
+    def serialize(self):
+        return {
+            'uuid': str(self.uuid),
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'url': reverse('download_attachment', args=[self.uuid])
+        }
+
+    @classmethod
+    def remove_stale_uploads(cls, before):
+        '''
+        Deletes the uploads started before a time which were never completed, with their partial files, and removes any partial file
+        left behind by an upload which has been deleted, e.g. along with its chat. Returns the number of files removed.
+        '''
+        cls.objects.filter(file_hash='', created__lt=before).delete()
+
+        # An upload's row is saved before any of its file is written, so a partial file without an upload in progress is never needed
+        removed_count = 0
+        uploads = iter_file_names(get_upload_dir())
+        while batch := dict(islice(uploads, settings.ATTACHMENT_CLEANUP_BATCH_SIZE)):
+            in_progress = {str(uuid) for uuid in cls.objects.filter(uuid__in=cls._get_valid_uuids(batch), file_hash='').values_list('uuid', flat=True)}
+            for name, path in batch.items():
+                if name not in in_progress:
+                    removed_count += remove_file(path)
+        return removed_count
+
+    @staticmethod
+    def _get_valid_uuids(names):
+        uuids = []
+        for name in names:
+            try:
+                uuids.append(UUID(name))
+            except ValueError:
+                pass
+        return uuids
+
+    @classmethod
+    def remove_unreferenced_files(cls, before):
+        '''
+        Removes the stored files which no attachment refers to any more, e.g. after their chat was deleted. Files modified after a time
+        are kept, since an upload which has just been stored may not have been saved to its attachment yet. Returns the number removed.
+        '''
+        removed_count = 0
+        files = iter_file_names(get_file_dir())
+        while batch := dict(islice(files, settings.ATTACHMENT_CLEANUP_BATCH_SIZE)):
+            referenced = set(cls.objects.filter(file_hash__in=list(batch)).values_list('file_hash', flat=True))
+            for file_hash, path in batch.items():
+                if file_hash not in referenced:
+                    removed_count += remove_if_unmodified(path, before)
+        return removed_count
 
 
 class Message(models.Model):
@@ -17,14 +135,24 @@ class Message(models.Model):
         on_delete=models.CASCADE,
         related_name='received_messages'
     )
-    content = models.TextField()
+    content = CompressedTextField(compressed_field='compressed_content')
+    compressed_content = models.BinaryField(null=True, editable=False)
+    preview = PreviewField(source='content', visible_characters=PREVIEW_CHARACTERS)
     timestamp = models.DateTimeField(default=timezone.now)
     read = models.BooleanField(default=False)
+    attachment = models.OneToOneField(
+        Attachment,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name='message'
+    )
 
 
     class Meta:
         indexes = [
-            models.Index(fields=['sender', 'recipient'], name='sender_recipient_idx'),
+            # Includes the primary key, so a chat can be deleted in batches ordered by it
+            models.Index(fields=['sender', 'recipient', 'uuid'], name='sender_recipient_idx'),
             models.Index(fields=['sender'], name='sender_idx'),
             models.Index(fields=['recipient'], name='recipient_idx')
         ]
@@ -35,21 +163,52 @@ class Message(models.Model):
     def get_date(self):
         return self.timestamp.strftime("%Y-%m-%d")
     
-    def serialize(self):
-        visible_characters = 50
-        limited_content = (self.content[:visible_characters] + '...' if len(self.content) > visible_characters else self.content).replace('\n', ' ')
+    def get_preview(self):
+        # The preview is filled in when a message is saved, so only unsaved messages need to compute it from the content.
+        # An empty preview of a saved message (e.g. an attachment) is kept, rather than loading the deferred content.
+        if self._state.adding:
+            return get_preview(self.content, PREVIEW_CHARACTERS)
+        return self.preview
+
+    def serialize(self, include_full_content=True):
+        '''
+        - include_full_content: whether to include the full content, which can be left deferred when only the preview is needed
+        '''
+        content = {'limited': self.get_preview()}
+        if include_full_content:
+            content['full'] = self.content
+
         return {
             'uuid': str(self.uuid),
             'sender': self.sender.serialize(),
             'recipient': self.recipient.serialize(),
-            'content': {
-                'full': self.content,
-                'limited': limited_content,
-            },
+            'content': content,
             'timestamp': self.timestamp.isoformat(),
-            'read': str(self.read)
+            'read': str(self.read),
+            'attachment': self.attachment.serialize() if self.attachment_id else None
+        }
+
+    @staticmethod
+    def _get_chat_message_event(serialized_message):
+        return {
+            'type': 'chat_message',
+            'serialized_message': serialized_message
         }
 
+    @classmethod
+    def create_attachment_message(cls, attachment):
+        '''Creates the message for a completed attachment upload, and sends it to both users'''
+        message = cls.objects.create(
+            sender=attachment.sender,
+            recipient=attachment.recipient,
+            content='',
+            attachment=attachment
+        )
+
+        event = cls._get_chat_message_event(message.serialize())
+        send_both_users_ws_message(attachment.sender, attachment.recipient, event=event)
+        return message
+
     @staticmethod
     def _get_all_messages_read_event(sender, recipient, unread_count):
         return {
@@ -61,65 +220,647 @@ class Message(models.Model):
             }
         }
 
+    @staticmethod
+    def get_chat_filter(user, other_user):
+        return (
+            models.Q(sender=user, recipient=other_user) |
+            models.Q(sender=other_user, recipient=user)
+        )
+
+    @staticmethod
+    def get_before_filter(before):
+        timestamp, uuid = before
+        return models.Q(timestamp__lt=timestamp) | models.Q(timestamp=timestamp, uuid__lt=uuid)
+
     @classmethod
-    def get_messages(cls, request_user, request_other_user):
-        '''Returns the messages sent directly between two users'''
-        messages = cls.objects.filter(
-            models.Q(sender=request_user, recipient=request_other_user) |
-            models.Q(sender=request_other_user, recipient=request_user)
-        ).order_by('timestamp')
+    def _get_page_messages(cls, request_user, request_other_user, before):
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        messages = cls.objects.filter(cls.get_chat_filter(request_user, request_other_user))
 
-        messages_list = []
-        for message in messages:
-            messages_list.append(message.serialize())
+        older_messages = messages if before is None else messages.filter(cls.get_before_filter(before))
+        return older_messages.select_related('sender', 'recipient', 'attachment').order_by('-timestamp', '-uuid')[:page_size + 1]
 
-        new_messages = messages.filter(read=False, sender=request_other_user)
-        unread_count = new_messages.update(read=True)
-        if unread_count > 0:
-            event = cls._get_all_messages_read_event(sender=request_other_user, recipient=request_user, unread_count=unread_count)
-            send_both_users_ws_message(request_user, request_other_user, event=event)
+    @staticmethod
+    def _get_newer_than(page):
+        # Archived messages are only read once the page reaches back past the oldest message still in this table
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        return page[page_size] if len(page) > page_size else None
+
+    @staticmethod
+    def _serialize_page(page):
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        page.sort(key=lambda message: (message.timestamp, message.uuid), reverse=True)
+
+        has_older_messages = len(page) > page_size
+        messages_list = [message.serialize() for message in reversed(page[:page_size])]
+        return messages_list, has_older_messages
 
-        return messages_list
-    
     @classmethod
-    def get_recent_chats(cls, user):
-        '''Returns chat info for each of a user's chats, ordered by most recent activity'''
-        user_messages = cls.objects.filter(
+    def _get_new_messages(cls, request_user, request_other_user):
+        return cls.objects.filter(sender=request_other_user, recipient=request_user, read=False)
+
+    @classmethod
+    def get_messages(cls, request_user, request_other_user, before=None):
+        '''
+        Returns a page of the messages sent directly between two users, ordered oldest first, and whether there are older messages.
+        Only the most recent page marks the other user's messages as read.
+        - before: (timestamp, uuid) of the oldest message already loaded, or None for the most recent page
+        '''
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        page = list(cls._get_page_messages(request_user, request_other_user, before))
+        page += ArchivedMessages.get_messages(request_user, request_other_user, before, page_size + 1, cls._get_newer_than(page))
+        messages_list, has_older_messages = cls._serialize_page(page)
+
+        if before is None:
+            unread_count = cls._get_new_messages(request_user, request_other_user).update(read=True)
+            if unread_count > 0:
+                event = cls._get_all_messages_read_event(sender=request_other_user, recipient=request_user, unread_count=unread_count)
+                send_both_users_ws_message(request_user, request_other_user, event=event)
+
+        return messages_list, has_older_messages
+
+    @classmethod
+    async def aget_messages(cls, request_user, request_other_user, before=None):
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        page = [message async for message in cls._get_page_messages(request_user, request_other_user, before)]
+        page += await ArchivedMessages.aget_messages(request_user, request_other_user, before, page_size + 1, cls._get_newer_than(page))
+        messages_list, has_older_messages = cls._serialize_page(page)
+
+        if before is None:
+            unread_count = await cls._get_new_messages(request_user, request_other_user).aupdate(read=True)
+            if unread_count > 0:
+                event = cls._get_all_messages_read_event(sender=request_other_user, recipient=request_user, unread_count=unread_count)
+                await send_both_users_ws_message_async(request_user, request_other_user, event=event)
+
+        return messages_list, has_older_messages
+
+    @classmethod
+    def _get_last_messages(cls, user):
+        other_user_id = models.Case(
+            models.When(sender=user, then=models.F('recipient_id')),
+            default=models.F('sender_id')
+        )
+
+        # Only the last message of each chat is fetched, with the chat's unread count computed by the database
+        return cls.objects.filter(
             models.Q(sender=user) |
             models.Q(recipient=user)
-        ).select_related('sender', 'recipient')
+        ).annotate(
+            chat_position=models.Window(
+                RowNumber(),
+                partition_by=[other_user_id],
+                order_by=[models.F('timestamp').desc(), models.F('uuid').desc()]
+            ),
+            unread_count=models.Window(
+                models.Sum(models.Case(models.When(recipient=user, read=False, then=1), default=0)),
+                partition_by=[other_user_id]
+            )
+        ).filter(chat_position=1).select_related('sender', 'recipient', 'attachment').defer('content', 'compressed_content').order_by('-timestamp')
 
-        chats = {}
-        for message in user_messages:
-            if message.sender == user:
-                other_user = message.recipient
-                is_unread = False
-            else:
-                other_user = message.sender
-                is_unread = not message.read
-
-            serialized_message = message.serialize()
-
-            if other_user.id not in chats:
-                chats[other_user.id] = {
-                    'other_user': other_user,
-                    'last_message': serialized_message,
-                    'last_timestamp': message.timestamp,
-                    'unread_count': 0
-                }
-            elif chats[other_user.id]['last_timestamp'] < message.timestamp:
-                chats[other_user.id].update({
-                    'last_message': serialized_message,
-                    'last_timestamp': message.timestamp
-                })
-
-            if is_unread:
-                chats[other_user.id]['unread_count'] += 1
-        
-        recent_chats = sorted(chats.values(), key=lambda msg: msg['last_timestamp'], reverse=True)
-        return recent_chats
+    @staticmethod
+    def _get_recent_chat(user, last_message):
+        return {
+            'other_user': last_message.recipient if last_message.sender_id == user.id else last_message.sender,
+            'last_message': last_message.serialize(include_full_content=False),
+            'last_timestamp': last_message.timestamp,
+            'unread_count': last_message.unread_count
+        }
+
+    @classmethod
+    def get_recent_chats(cls, user):
+        '''Returns chat info for each of a user's chats, ordered by most recent activity'''
+        return [cls._get_recent_chat(user, message) for message in cls._get_last_messages(user)]
+
+    @classmethod
+    async def aget_recent_chats(cls, user):
+        return [cls._get_recent_chat(user, message) async for message in cls._get_last_messages(user)]
+
+    @staticmethod
+    def _get_chat_deletion_progress_event(deleted, total):
+        return {
+            'type': 'chat_deletion_progress',
+            'deleted': deleted,
+            'total': total
+        }
+
+    @staticmethod
+    def _get_chat_deleted_event():
+        return {
+            'type': 'chat_deleted'
+        }
+
+    @classmethod
+    def delete_chat(cls, user, other_user, before):
+        '''
+        Deletes the messages and archived messages sent between two users up to a time, and their attachments, in batches.
+        Both users are sent the progress after each batch, and an event once the chat has been deleted.
+        Attachment files are stored under the hash of their content and may be shared with other attachments, so they are kept.
+        '''
+        batch_size = settings.CHAT_DELETION_BATCH_SIZE
+        user_1_id, user_2_id = ArchivedMessages.get_user_ids(user.id, other_user.id)
+        querysets = [
+            # Each direction of the chat is deleted separately, so each batch is read from the sender and recipient index
+            cls.objects.filter(sender=user, recipient=other_user, timestamp__lte=before),
+            cls.objects.filter(sender=other_user, recipient=user, timestamp__lte=before),
+            ArchivedMessages.objects.filter(user_1_id=user_1_id, user_2_id=user_2_id, last_timestamp__lte=before)
+        ]
+        total = sum(queryset.count() for queryset in querysets)
+
+        deleted = 0
+        for queryset in querysets:
+            for batch_deleted in delete_in_batches(queryset, batch_size):
+                deleted += batch_deleted
+                event = cls._get_chat_deletion_progress_event(deleted, total)
+                send_both_users_ws_message(user, other_user, event=event)
+
+        # The attachments of the deleted messages, and uploads which were never completed
+        attachments = Attachment.objects.filter(cls.get_chat_filter(user, other_user), message__isnull=True, created__lte=before)
+        for _ in delete_in_batches(attachments, batch_size):
+            pass
+
+        send_both_users_ws_message(user, other_user, event=cls._get_chat_deleted_event())
 
     @classmethod
     def remove_redundant_messages(cls):
         '''Remove all messages from the database where both the sender and recipient have deleted their accounts'''
-        cls.objects.filter(sender__is_active=False, recipient__is_active=False).delete()
\ No newline at end of file
+        cls.objects.filter(sender__is_active=False, recipient__is_active=False).delete()
+        ArchivedMessages.objects.filter(user_1__is_active=False, user_2__is_active=False).delete()
+
+
+class ArchivedMessages(models.Model):
+    '''
+    The messages sent between two users in one period, moved out of the Message table once they are old enough and stored compressed.
+    Only read messages without attachments are archived, and the last message of each chat is always kept in the Message table.
+    '''
+    user_1 = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    user_2 = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    period_start = models.DateTimeField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_1', 'user_2', 'period_start'], name='archived_messages_period_unique')
+        ]
+        indexes = [
+            models.Index(fields=['user_1', 'user_2', 'first_timestamp'], name='archived_messages_chat_idx')
+        ]
+
+    def __str__(self):
+        return f'{self.user_1} - {self.user_2} ({self.get_period()})'
+
+    def get_period(self):
+        return self.period_start.strftime("%Y-%m")
+
+    @staticmethod
+    def get_period_start(timestamp):
+        '''Returns the start of the calendar month (UTC) containing a timestamp'''
+        return timestamp.astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def get_next_period_start(cls, period_start):
+        return cls.get_period_start(period_start + timedelta(days=32))
+
+    @staticmethod
+    def get_user_ids(user_id, other_user_id):
+        return min(user_id, other_user_id), max(user_id, other_user_id)
+
+    @staticmethod
+    def compress(rows):
+        return zlib.compress(json.dumps(rows, separators=(',', ':')).encode())
+
+    @staticmethod
+    def decompress(data):
+        return json.loads(zlib.decompress(data))
+
+    @staticmethod
+    def _message_to_row(message):
+        uuid, sender_id, timestamp, content, compressed_content, read = message
+        return [str(uuid), sender_id, timestamp.isoformat(), get_stored_text(content, compressed_content), read]
+
+    def get_rows(self):
+        return self.decompress(self.data)
+
+    def set_rows(self, rows):
+        rows.sort(key=lambda row: (datetime.fromisoformat(row[2]), row[0]))
+        self.data = self.compress(rows)
+        self.message_count = len(rows)
+        self.first_timestamp = datetime.fromisoformat(rows[0][2])
+        self.last_timestamp = datetime.fromisoformat(rows[-1][2])
+
+    def to_messages(self, users):
+        '''
+        Returns the archived messages as unsaved Message instances
+        - users: a dict of user id -> user, containing both users
+        '''
+        messages = []
+        for uuid, sender_id, timestamp, content, read in self.get_rows():
+            recipient_id = self.user_2_id if sender_id == self.user_1_id else self.user_1_id
+            messages.append(Message(
+                uuid=UUID(uuid),
+                sender=users[sender_id],
+                recipient=users[recipient_id],
+                content=content,
+                timestamp=datetime.fromisoformat(timestamp),
+                read=read
+            ))
+        return messages
+
+    @classmethod
+    def _get_archives(cls, user, other_user, before, newer_than):
+        user_1_id, user_2_id = cls.get_user_ids(user.id, other_user.id)
+        archives = cls.objects.filter(user_1_id=user_1_id, user_2_id=user_2_id)
+        if before is not None:
+            archives = archives.filter(first_timestamp__lte=before[0])
+        if newer_than is not None:
+            archives = archives.filter(last_timestamp__gte=newer_than.timestamp)
+        return archives.order_by('-period_start')
+
+    def _add_messages(self, messages, users, before, limit, newer_than):
+        '''Adds the archive's messages to the list of messages, newest first, and returns whether the limit has been reached'''
+        for message in reversed(self.to_messages(users)):
+            if before is not None and (message.timestamp, message.uuid) >= before:
+                continue
+            if newer_than is not None and (message.timestamp, message.uuid) <= (newer_than.timestamp, newer_than.uuid):
+                break
+            messages.append(message)
+            if len(messages) == limit:
+                return True
+        return False
+
+    @classmethod
+    def get_messages(cls, user, other_user, before, limit, newer_than=None):
+        '''
+        Returns up to limit of the most recent archived messages sent between two users, as unsaved Message instances ordered newest first
+        - before: (timestamp, uuid) which the messages must be older than, or None
+        - newer_than: a message which the messages must be newer than, or None
+        '''
+        archives = cls._get_archives(user, other_user, before, newer_than)
+        users = {user.id: user, other_user.id: other_user}
+
+        # The archives are read in one query, a chunk at a time, so the archives older than the page are never loaded
+        messages = []
+        for archive in archives.iterator(chunk_size=settings.ARCHIVE_FETCH_CHUNK_SIZE):
+            if archive._add_messages(messages, users, before, limit, newer_than):
+                break
+        return messages
+
+    @classmethod
+    async def aget_messages(cls, user, other_user, before, limit, newer_than=None):
+        archives = cls._get_archives(user, other_user, before, newer_than)
+        users = {user.id: user, other_user.id: other_user}
+
+        messages = []
+        async for archive in archives.aiterator(chunk_size=settings.ARCHIVE_FETCH_CHUNK_SIZE):
+            if archive._add_messages(messages, users, before, limit, newer_than):
+                break
+        return messages
+
+    @classmethod
+    def archive_messages(cls, before):
+        '''
+        Moves the messages sent in whole periods before a timestamp into the archive, and returns the number of messages archived
+        '''
+        cutoff = cls.get_period_start(before)
+        newer_chat_messages = Message.objects.filter(
+            models.Q(sender=models.OuterRef('sender'), recipient=models.OuterRef('recipient')) |
+            models.Q(sender=models.OuterRef('recipient'), recipient=models.OuterRef('sender')),
+            timestamp__gt=models.OuterRef('timestamp')
+        )
+        archivable_messages = Message.objects.filter(timestamp__lt=cutoff, read=True, attachment__isnull=True).filter(models.Exists(newer_chat_messages))
+
+        oldest_message = archivable_messages.order_by('timestamp').first()
+        if oldest_message is None:
+            return 0
+
+        archived_count = 0
+        period_start = cls.get_period_start(oldest_message.timestamp)
+        while period_start < cutoff:
+            next_period_start = cls.get_next_period_start(period_start)
+            period_messages = archivable_messages.filter(timestamp__gte=period_start, timestamp__lt=next_period_start)
+
+            # Only one chat's messages for the period are loaded at a time, so memory use doesn't grow with the number of chats
+            chats = period_messages.annotate(
+                user_1_id=Least('sender_id', 'recipient_id'),
+                user_2_id=Greatest('sender_id', 'recipient_id')
+            ).values_list('user_1_id', 'user_2_id').order_by().distinct()
+
+            for user_1_id, user_2_id in list(chats):
+                rows = [
+                    cls._message_to_row(message)
+                    for message in period_messages.filter(Message.get_chat_filter(user_1_id, user_2_id)).values_list('uuid', 'sender_id', 'timestamp', 'content', 'compressed_content', 'read')
+                ]
+                archived_count += cls._archive_chat_period(user_1_id, user_2_id, period_start, rows)
+
+            period_start = next_period_start
+
+        return archived_count
+
+    @classmethod
+    def _archive_chat_period(cls, user_1_id, user_2_id, period_start, rows):
+        message_uuids = [row[0] for row in rows]
+
+        with transaction.atomic():
+            archive = cls.objects.select_for_update().filter(
+                user_1_id=user_1_id, user_2_id=user_2_id, period_start=period_start
+            ).first()
+            if archive is None:
+                archive = cls(user_1_id=user_1_id, user_2_id=user_2_id, period_start=period_start)
+            else:
+                rows = archive.get_rows() + rows
+
+            archive.set_rows(rows)
+            archive.save()
+            # Only the archived messages are deleted, a bounded number at a time so no query has to list the whole period
+            batch_size = settings.CHAT_DELETION_BATCH_SIZE
+            for start in range(0, len(message_uuids), batch_size):
+                for _ in delete_in_batches(Message.objects.filter(uuid__in=message_uuids[start:start + batch_size]), batch_size):
+                    pass
+
+        return len(message_uuids)
+
+class Conversation(models.Model):
+    '''
+    A group chat. Messages are sent to everyone in the group through a single channel layer group, and each member keeps their own
+    read cursor and unread count, so the work done to send a message does not grow with the number of members.
+    '''
+    uuid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name='created_conversations'
+    )
+    created = models.DateTimeField(default=timezone.now)
+    last_message = models.ForeignKey(
+        'GroupMessage',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='+'
+    )
+    last_message_at = models.DateTimeField(default=timezone.now)
+    members = models.ManyToManyField(
+        settings.AUTH_USER_MODEL,
+        through='Membership',
+        related_name='conversations'
+    )
+
+    def __str__(self):
+        return self.name
+
+    def serialize(self):
+        return {
+            'uuid': str(self.uuid),
+            'name': self.name
+        }
+
+    def get_group(self):
+        return get_conversation_group(self.uuid)
+
+    @classmethod
+    def get_groups(cls, user):
+        '''Returns the user's conversations, with the most recently active first, along with their last message and unread count'''
+        memberships = Membership.objects.filter(user=user).select_related(
+            'conversation__last_message__sender'
+        ).defer('conversation__last_message__content', 'conversation__last_message__compressed_content').order_by('-conversation__last_message_at')
+
+        return [
+            {
+                'conversation': membership.conversation.serialize(),
+                'last_message': last_message.serialize(include_full_content=False) if (last_message := membership.conversation.last_message) else None,
+                'unread_count': membership.unread_count
+            }
+            for membership in memberships
+        ]
+
+    @staticmethod
+    def _get_conversation_joined_event(conversation):
+        return {
+            'type': 'conversation_joined',
+            'conversation': conversation.serialize()
+        }
+
+    @staticmethod
+    def _get_conversation_left_event(conversation):
+        return {
+            'type': 'conversation_left',
+            'conversation': conversation.serialize()
+        }
+
+    @classmethod
+    def create_conversation(cls, user, name, members):
+        with transaction.atomic():
+            conversation = cls.objects.create(name=name, created_by=user)
+            conversation.add_members([user, *members])
+        return conversation
+
+    def add_members(self, users):
+        '''Adds users to the conversation, and returns the users who were not already members'''
+        existing_user_ids = set(self.memberships.filter(user__in=users).values_list('user_id', flat=True))
+        new_users = {user.id: user for user in users if user.id not in existing_user_ids}.values()
+
+        # Members start with everything sent before they joined already read
+        now = timezone.now()
+        Membership.objects.bulk_create([
+            Membership(conversation=self, user=user, joined=now, last_read_at=now)
+            for user in new_users
+        ], ignore_conflicts=True)
+
+        # The connections of each new member join the conversation's channel layer group
+        event = self._get_conversation_joined_event(self)
+
+        def send_events():
+            for user in new_users:
+                send_user_ws_message(user, event=event)
+
+        transaction.on_commit(send_events)
+        return list(new_users)
+
+    def remove_member(self, user):
+        deleted_count, _ = self.memberships.filter(user=user).delete()
+        if deleted_count == 0:
+            return
+
+        send_user_ws_message(user, event=self._get_conversation_left_event(self))
+
+        if not self.memberships.exists():
+            self.delete()
+
+    @classmethod
+    def leave_all(cls, user):
+        for conversation in cls.objects.filter(memberships__user=user):
+            conversation.remove_member(user)
+
+
+class Membership(models.Model):
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='memberships'
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='memberships'
+    )
+    joined = models.DateTimeField(default=timezone.now)
+    # Everything in the conversation up to this time has been read by the member
+    last_read_at = models.DateTimeField(default=timezone.now)
+    # Kept up to date as messages are sent and read, rather than counting the unread messages each time
+    unread_count = models.PositiveIntegerField(default=0)
+
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='membership_unique')
+        ]
+        indexes = [
+            models.Index(fields=['user'], name='membership_user_idx')
+        ]
+
+    def __str__(self):
+        return f'{self.user} in {self.conversation}'
+
+    @staticmethod
+    def _get_unread_count_after(timestamp):
+        '''Returns an expression counting the messages sent to a membership's conversation by other members after the timestamp'''
+        unread_messages = GroupMessage.objects.filter(
+            conversation=models.OuterRef('conversation'),
+            timestamp__gt=timestamp
+        ).exclude(sender=models.OuterRef('user')).order_by().values('conversation').annotate(count=models.Count('*')).values('count')
+        return Coalesce(models.Subquery(unread_messages), 0)
+
+    def mark_as_read(self, timestamp):
+        '''
+        Moves the member's read cursor forward to the timestamp, and recounts their unread messages, so messages sent after the
+        timestamp (e.g. while the page was loading) stay unread
+        '''
+        Membership.objects.filter(pk=self.pk, last_read_at__lt=timestamp).update(last_read_at=timestamp, unread_count=self._get_unread_count_after(timestamp))
+
+    async def amark_as_read(self, timestamp):
+        await Membership.objects.filter(pk=self.pk, last_read_at__lt=timestamp).aupdate(last_read_at=timestamp, unread_count=self._get_unread_count_after(timestamp))
+
+
+class GroupMessage(models.Model):
+    uuid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='messages'
+    )
+    sender = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='sent_group_messages'
+    )
+    content = CompressedTextField(compressed_field='compressed_content')
+    compressed_content = models.BinaryField(null=True, editable=False)
+    preview = PreviewField(source='content', visible_characters=PREVIEW_CHARACTERS)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'timestamp'], name='group_message_timestamp_idx')
+        ]
+
+    def __str__(self):
+        return self.content
+
+    def get_preview(self):
+        if self._state.adding:
+            return get_preview(self.content, PREVIEW_CHARACTERS)
+        return self.preview
+
+    def serialize(self, include_full_content=True):
+        content = {'limited': self.get_preview()}
+        if include_full_content:
+            content['full'] = self.content
+
+        return {
+            'uuid': str(self.uuid),
+            'conversation': str(self.conversation_id),
+            'sender': self.sender.serialize(),
+            'content': content,
+            'timestamp': self.timestamp.isoformat()
+        }
+
+    @classmethod
+    def get_messages(cls, membership):
+        '''Returns the latest page of messages in a conversation, oldest first, and marks them as read by the member'''
+        messages = list(
+            cls.objects.filter(conversation_id=membership.conversation_id).select_related('sender').order_by('-timestamp', '-uuid')[:settings.CHAT_HISTORY_PAGE_SIZE]
+        )
+        messages.reverse()
+
+        if messages:
+            membership.mark_as_read(messages[-1].timestamp)
+        return messages
+
+    @staticmethod
+    def _get_group_message_event(serialized_message, conversation):
+        return {
+            'type': 'group_message',
+            'serialized_message': serialized_message,
+            'conversation': conversation.serialize()
+        }
+
+    @classmethod
+    def create_message(cls, sender, conversation, content):
+        '''
+        Creates a message, and updates the conversation and its members.
+        The unread count of every other member is incremented in a single query, so this does not get slower as the group grows.
+        '''
+        with transaction.atomic():
+            message = cls.objects.create(conversation=conversation, sender=sender, content=content)
+            Conversation.objects.filter(uuid=conversation.uuid).update(last_message=message, last_message_at=message.timestamp)
+            Membership.objects.filter(conversation=conversation).exclude(user=sender).update(unread_count=models.F('unread_count') + 1)
+            Membership.objects.filter(conversation=conversation, user=sender).update(last_read_at=message.timestamp)
+        return message
+
+    @classmethod
+    def send(cls, sender, conversation, content):
+        '''Creates a message, and sends it to everyone in the conversation through a single channel layer group'''
+        message = cls.create_message(sender, conversation, content)
+        event = cls._get_group_message_event(message.serialize(), conversation)
+        send_conversation_ws_message(conversation.uuid, event=event)
+        return message
+
+
+class Task(models.Model):
+    '''
+    A call of a background task, stored until it succeeds so it survives restarts. Claiming a task moves its run_after forward by
+    a lease, which the worker renews while the task runs, so a task whose worker stopped while running it is run again once the
+    lease expires.
+    '''
+    name = models.CharField(max_length=255)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    run_after = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    # Set once every attempt has failed, after which the task is kept without its arguments but not run again
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['failed', 'run_after'], name='task_due_idx')
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.id})'
@@ -0,0 +1,154 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from functools import wraps
+from uuid import uuid4
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .metrics import current_query_log
+
+# Only one handler is profiled at a time in each thread, since a thread can only have one active profiler
+_active = threading.local()
+
+
+class Capture:
+    '''
+    Profiles a request or WebSocket handler, along with the SQL queries it makes.
+    The profile is only saved if it took longer than the threshold.
+    Used with async with, the thread running the synchronous code of the request is also profiled, such as a sync view or the
+    database queries made through sync_to_async, since the event loop thread only runs the async code.
+    '''
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.profiler = cProfile.Profile()
+        self.thread_profiler = None
+        self.queries = []
+
+    @staticmethod
+    def should_profile():
+        return settings.PROFILING_ENABLED and not getattr(_active, 'profiling', False) and random.random() < settings.PROFILING_SAMPLE_RATE
+
+    def __enter__(self):
+        _active.profiling = True
+        self.query_log_token = current_query_log.set(self.queries)
+        self.start = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        duration = time.perf_counter() - self.start
+        current_query_log.reset(self.query_log_token)
+        _active.profiling = False
+
+        if duration * 1000 >= settings.PROFILING_THRESHOLD_MS:
+            save_capture(self, duration)
+
+    def _enable_thread_profiler(self):
+        # The thread may already be profiled by another capture, if it isn't dedicated to this request
+        if getattr(_active, 'profiling', False):
+            return
+        _active.profiling = True
+        self.thread_profiler = cProfile.Profile()
+        self.thread_profiler.enable()
+
+    def _disable_thread_profiler(self):
+        if self.thread_profiler is not None:
+            self.thread_profiler.disable()
+            _active.profiling = False
+
+    async def __aenter__(self):
+        self.__enter__()
+        await sync_to_async(self._enable_thread_profiler)()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await sync_to_async(self._disable_thread_profiler)()
+        self.__exit__(*exc_info)
+
+    def get_stats(self, stream=None):
+        stats = pstats.Stats(self.profiler, stream=stream)
+        if self.thread_profiler is not None:
+            stats.add(self.thread_profiler)
+        return stats
+
+
+def _get_stats_text(capture):
+    stream = io.StringIO()
+    capture.get_stats(stream).sort_stats('cumulative').print_stats(settings.PROFILING_STATS_LINES)
+    return stream.getvalue()
+
+
+def save_capture(capture, duration):
+    '''Writes the profile to the profiling directory, as a .prof file and a .json file, and removes the oldest captures'''
+    os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+    capture_id = f'{int(time.time() * 1000)}_{uuid4().hex[:8]}'
+    capture.get_stats().dump_stats(os.path.join(settings.PROFILING_DIR, f'{capture_id}.prof'))
+
+    with open(os.path.join(settings.PROFILING_DIR, f'{capture_id}.json'), 'w') as capture_file:
+        json.dump({
+            'id': capture_id,
+            'kind': capture.kind,
+            'name': capture.name,
+            'timestamp': time.time(),
+            'duration': duration,
+            'queries': capture.queries,
+            'stats': _get_stats_text(capture)
+        }, capture_file)
+
+    remove_old_captures()
+
+
+def get_capture_ids():
+    '''Returns the ids of the saved captures, oldest first'''
+    if not os.path.isdir(settings.PROFILING_DIR):
+        return []
+    return sorted(filename[:-len('.json')] for filename in os.listdir(settings.PROFILING_DIR) if filename.endswith('.json'))
+
+
+def remove_old_captures():
+    capture_ids = get_capture_ids()
+    for capture_id in capture_ids[:max(0, len(capture_ids) - settings.PROFILING_MAX_CAPTURES)]:
+        for extension in ('json', 'prof'):
+            path = os.path.join(settings.PROFILING_DIR, f'{capture_id}.{extension}')
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def load_captures():
+    captures = []
+    for capture_id in get_capture_ids():
+        try:
+            with open(os.path.join(settings.PROFILING_DIR, f'{capture_id}.json')) as capture_file:
+                captures.append(json.load(capture_file))
+        except (OSError, ValueError):
+            # The capture may have been removed, or may still be being written
+            continue
+    return captures
+
+
+def profile_consumer_handler(handler):
+    '''
+    Profiles a sample of calls to an async consumer method which take longer than the threshold.
+    Other coroutines running on the event loop while the handler awaits are included in the profile.
+    '''
+    @wraps(handler)
+    async def wrapper(self, *args, **kwargs):
+        if not Capture.should_profile():
+            return await handler(self, *args, **kwargs)
+
+        name = f'{type(self).__name__}.{handler.__name__}'
+        if args and isinstance(args[0], dict) and 'type' in args[0]:
+            name = f'{name}:{args[0]["type"]}'
+
+        with Capture('consumer', name):
+            return await handler(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,80 @@
+import random
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Reads are only sent to a replica while handling a request or WebSocket message, so management commands and tasks always read
+# from the primary database
+current_routing = ContextVar('current_routing', default=None)
+
+
+def get_primary_pin_cache_key(session_group):
+    return f'primary_pin:{session_group}'
+
+
+def pin_to_primary(session_group):
+    '''Sends the reads of the session to the primary database for a while, so the session sees its own writes despite replication lag'''
+    cache.set(get_primary_pin_cache_key(session_group), True, settings.REPLICA_PIN_SECONDS)
+
+
+async def apin_to_primary(session_group):
+    await cache.aset(get_primary_pin_cache_key(session_group), True, settings.REPLICA_PIN_SECONDS)
+
+
+def use_primary():
+    '''Sends the remaining reads of the current request or WebSocket message to the primary database'''
+    routing = current_routing.get()
+    if routing is not None:
+        routing.pinned = True
+
+
+class ReplicaRouting:
+    '''
+    The database reads are sent to while handling a request or WebSocket message. Reads are sent to the same replica, unless the session
+    was recently pinned to the primary database, or a write has been made.
+    '''
+
+    def __init__(self, session_group=None, use_primary=False):
+        self.session_group = session_group
+        self.replica = random.choice(settings.DATABASE_REPLICAS)
+        self.wrote = False
+        # Only checked once a read is made, since many messages are handled without reading from the database
+        self.pinned = True if use_primary else None
+
+    def get_read_alias(self):
+        if self.pinned is None:
+            self.pinned = self.session_group is not None and cache.get(get_primary_pin_cache_key(self.session_group)) is not None
+        return DEFAULT_DB_ALIAS if self.pinned else self.replica
+
+    def record_write(self):
+        self.wrote = True
+        self.pinned = True
+
+    def __enter__(self):
+        self.token = current_routing.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        current_routing.reset(self.token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = current_routing.get()
+        if routing is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        # Sessions are read on every request and changed often, so a lagging replica could log the user out
+        if model._meta.app_label == 'sessions':
+            return DEFAULT_DB_ALIAS
+        return routing.get_read_alias()
+
+    def db_for_write(self, model, **hints):
+        routing = current_routing.get()
+        if routing is not None:
+            routing.record_write()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas contain the same data as the primary database
+        return True
@@ -0,0 +1,10 @@
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from .metrics import record_query
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # Count the queries made by each view, on every database connection
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
@@ -0,0 +1,91 @@
+import logging
+import traceback
+from datetime import timedelta
+from functools import partial
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(name, *args, **kwargs):
+    '''Stores a call of a task to be run by the task worker. The arguments must be JSON serializable.'''
+    return Task.objects.create(name=name, args=list(args), kwargs=kwargs)
+
+
+def task(func):
+    '''Registers a module level function as a task, which is queued with func.enqueue(*args, **kwargs)'''
+    func.task_name = f'{func.__module__}.{func.__qualname__}'
+    func.enqueue = partial(enqueue, func.task_name)
+    return func
+
+
+def get_task_function(name):
+    func = import_string(name)
+    # Only functions registered as tasks are run, whatever name is stored
+    if getattr(func, 'task_name', None) != name:
+        raise ImportError(f'{name} is not a task')
+    return func
+
+
+def get_retry_delay(attempts):
+    '''Returns the delay before retrying a task which has failed a number of times, doubling with each attempt'''
+    return timedelta(seconds=min(settings.TASK_RETRY_MAX_DELAY, settings.TASK_RETRY_DELAY * 2 ** (attempts - 1)))
+
+
+def claim_tasks(limit):
+    '''
+    Claims up to limit of the tasks which are due, oldest first. Tasks locked by another worker's claim are skipped, so workers
+    never wait for each other.
+    '''
+    now = timezone.now()
+    with transaction.atomic():
+        tasks = list(Task.objects.select_for_update(skip_locked=True).filter(failed=False, run_after__lte=now).order_by('run_after')[:limit])
+        lease_end = now + timedelta(seconds=settings.TASK_LEASE_SECONDS)
+        Task.objects.filter(id__in=[claimed_task.id for claimed_task in tasks]).update(run_after=lease_end, attempts=F('attempts') + 1)
+
+    for claimed_task in tasks:
+        claimed_task.run_after = lease_end
+        claimed_task.attempts += 1
+    return tasks
+
+
+def renew_lease(claimed_task):
+    '''
+    Extends the lease of a running task, so it isn't claimed by another worker while it is still running, and returns whether it
+    was extended. A lease which has already ended, such as by the task being retried or claimed again, isn't extended.
+    '''
+    lease_end = timezone.now() + timedelta(seconds=settings.TASK_LEASE_SECONDS)
+    renewed = Task.objects.filter(id=claimed_task.id, run_after=claimed_task.run_after).update(run_after=lease_end)
+    if renewed:
+        claimed_task.run_after = lease_end
+    return bool(renewed)
+
+
+def run_task(claimed_task):
+    '''Runs a claimed task, and deletes it once it succeeds. A failed task is retried later, until it has used all its attempts.'''
+    try:
+        get_task_function(claimed_task.name)(*claimed_task.args, **claimed_task.kwargs)
+    except Exception:
+        logger.exception('Task %s failed on attempt %s', claimed_task, claimed_task.attempts)
+        error = traceback.format_exc()
+        if claimed_task.attempts >= settings.TASK_MAX_ATTEMPTS:
+            # The arguments can contain private data, such as the password reset links in emails, which isn't kept once failed
+            Task.objects.filter(id=claimed_task.id).update(failed=True, last_error=error, args=[], kwargs={})
+        else:
+            Task.objects.filter(id=claimed_task.id).update(run_after=timezone.now() + get_retry_delay(claimed_task.attempts), last_error=error)
+    else:
+        Task.objects.filter(id=claimed_task.id).delete()
+
+
+def run_due_tasks():
+    '''Runs the tasks which are due one at a time, until there are none left, and returns the number run'''
+    count = 0
+    while claimed_tasks := claim_tasks(1):
+        run_task(claimed_tasks[0])
+        count += 1
+    return count
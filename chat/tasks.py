@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from .models import Attachment, Message
+from .task_queue import task
+
+User = get_user_model()
+
+
+@task
+def delete_chat(user_id, other_user_id, before):
+    '''Deletes the messages sent between two users up to a time, given as an ISO 8601 string'''
+    users = User.objects.in_bulk([user_id, other_user_id])
+    # Either user may have been removed since the deletion was requested
+    if len(users) < 2:
+        return
+
+    Message.delete_chat(users[user_id], users[other_user_id], before=datetime.fromisoformat(before))
+    # The files of the chat's attachments are removed unless another chat sent the same content
+    clean_up_attachments.enqueue()
+
+
+@task
+def clean_up_attachments(older_than_hours=None):
+    '''
+    Deletes the attachment uploads which were never completed, and removes the stored files no attachment refers to.
+    Returns the number of partial uploads and the number of stored files removed.
+    '''
+    if older_than_hours is None:
+        older_than_hours = settings.ATTACHMENT_UPLOAD_EXPIRY_HOURS
+    before = timezone.now() - timedelta(hours=older_than_hours)
+    return Attachment.remove_stale_uploads(before), Attachment.remove_unreferenced_files(before)
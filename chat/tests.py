@@ -1,3 +1,1137 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from unittest import mock
+from urllib.parse import urlencode
+from uuid import UUID, uuid4
+from contextvars import ContextVar
+import brotli
+from asgiref.sync import sync_to_async
+from channels.exceptions import ChannelFull
+from channels.testing import WebsocketCommunicator
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connections, router
+from django.db.models.sql import compiler
+from django.templatetags.static import static
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from fakeredis import TcpFakeServer
+from config.asgi import application
+from config.storage import CompressedManifestStaticFilesStorage
+from users.user_cache import user_cache
+from .attachments import get_file_path, get_upload_path, store_upload
+from .consumers import ChatConsumer
+from .fragments import FragmentCache
+from .management.commands import runworkers
+from .layers import HybridChannelLayer
+from . import fragments, metrics, profiling
+from .models import Message, Attachment, ArchivedMessages, Conversation, GroupMessage, Membership, Task
+from .replicas import ReplicaRouting, get_primary_pin_cache_key, pin_to_primary, use_primary
+from .task_queue import claim_tasks, get_retry_delay, renew_lease, run_due_tasks, run_task, task
+from .throttling import OutboundQueue
+from .utils import channel_layer, get_user_group
 
-# Create your tests here.
+User = get_user_model()
+
+
+@task
+def failing_task(*args, **kwargs):
+    raise ValueError('The task failed')
+
+
+class QueryCounter:
+    '''
+    Counts the queries made on every database connection, and the number of rows fetched by them. The query log is made
+    the default for every context, since the application run by a WebsocketCommunicator starts with an empty context.
+    '''
+
+    def __enter__(self):
+        self.queries = []
+        self.rows = 0
+        self.query_log_patcher = mock.patch.object(metrics, 'current_query_log', ContextVar('current_query_log', default=self.queries))
+        self.query_log_patcher.start()
+
+        original_cursor_iter = compiler.cursor_iter
+
+        def cursor_iter(*args, **kwargs):
+            for rows in original_cursor_iter(*args, **kwargs):
+                self.rows += len(rows)
+                yield rows
+
+        self.patcher = mock.patch.object(compiler, 'cursor_iter', cursor_iter)
+        self.patcher.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.patcher.stop()
+        self.query_log_patcher.stop()
+
+    def snapshot(self):
+        return len(self.queries), self.rows
+
+
+class QueryBudgetTestCase(TransactionTestCase):
+    '''
+    Checks that each code path stays within a fixed number of queries and rows fetched, both with the seeded data and after
+    grow_data() has added many more messages, friendships and users, so that code paths which scale with the data fail
+    '''
+    GROWTH = 3
+
+    def setUp(self):
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.carol = self.create_user('carol')
+        self.dave = self.create_user('dave')
+        self.erin = self.create_user('erin')
+
+        self.make_friends(self.alice, self.bob)
+        self.make_friends(self.alice, self.carol)
+        # A friend who isn't in the group, so the form for adding members is always shown
+        self.make_friends(self.alice, self.create_user('frank'))
+        self.dave.friends.add(self.alice)
+        self.alice.friends.add(self.erin)
+
+        self.create_messages(self.alice, self.bob, 5)
+        self.create_messages(self.alice, self.carol, 3)
+
+        self.conversation = Conversation.create_conversation(self.alice, 'Group', [self.bob, self.carol])
+        for sender in (self.alice, self.bob, self.carol):
+            GroupMessage.create_message(sender, self.conversation, f'Hello from {sender}')
+
+        self.client.force_login(self.alice)
+        self.grown = False
+
+        # Users looked up by uuid are only kept in memory, which is cleared before each measurement so it is made with a cold cache
+        shared_cache_patcher = mock.patch.object(user_cache, 'shared_cache_alias', None)
+        shared_cache_patcher.start()
+        self.addCleanup(shared_cache_patcher.stop)
+
+    @staticmethod
+    def create_user(username):
+        return User.objects.create(username=username, email=f'{username}@example.com', password='!')
+
+    @staticmethod
+    def make_friends(user_1, user_2):
+        user_1.friends.add(user_2)
+        user_2.friends.add(user_1)
+
+    @staticmethod
+    def create_messages(user_1, user_2, count, start=None):
+        start = start or timezone.now() - timedelta(days=1)
+        Message.objects.bulk_create([
+            Message(
+                sender=user_1 if i % 2 else user_2,
+                recipient=user_2 if i % 2 else user_1,
+                content=f'Message {i}',
+                timestamp=start + timedelta(seconds=i),
+                read=i < count - 2
+            )
+            for i in range(count)
+        ])
+
+    def grow_data(self):
+        '''Adds more messages to every existing chat, more users who are friends with and send messages to each other, and more friends and friend requests'''
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        for other_user in (self.bob, self.carol):
+            self.create_messages(self.alice, other_user, page_size * self.GROWTH, start=timezone.now() - timedelta(hours=12))
+
+        others = User.objects.bulk_create([
+            User(username=f'other_{i}', email=f'other_{i}@example.com', password='!')
+            for i in range(10 * self.GROWTH)
+        ])
+        for user, other_user in zip(others, others[1:] + [self.bob]):
+            self.make_friends(user, other_user)
+            self.create_messages(user, other_user, page_size)
+        for user in others[:self.GROWTH]:
+            self.make_friends(self.alice, user)
+        for user in others[self.GROWTH:2 * self.GROWTH]:
+            user.friends.add(self.alice)
+        for user in others[2 * self.GROWTH:3 * self.GROWTH]:
+            self.alice.friends.add(user)
+
+        GroupMessage.objects.bulk_create([
+            GroupMessage(conversation=self.conversation, sender=self.bob, content=f'Group message {i}')
+            for i in range(page_size * self.GROWTH)
+        ])
+        self.grown = True
+
+    def assertWithinBudget(self, counter, start, max_queries, max_rows, label):
+        queries, rows = counter.snapshot()
+        queries -= start[0]
+        rows -= start[1]
+        sql = '\n'.join(query['sql'] for query in counter.queries[start[0]:])
+
+        self.assertLessEqual(queries, max_queries, f'{label} made {queries} queries:\n{sql}')
+        self.assertLessEqual(rows, max_rows, f'{label} fetched {rows} rows:\n{sql}')
+        return queries
+
+    def assertQueryBudget(self, make_request, max_queries, max_rows):
+        '''Makes the request before and after growing the data, checking both stay within the budget and make the same number of queries'''
+        query_counts = []
+        for grow in (False, True):
+            if grow:
+                self.grow_data()
+            user_cache.clear()
+            with QueryCounter() as counter:
+                make_request()
+            label = 'After growing the data, the request' if grow else 'The request'
+            query_counts.append(self.assertWithinBudget(counter, (0, 0), max_queries, max_rows, label))
+
+        self.assertEqual(query_counts[0], query_counts[1], 'The number of queries changed with the amount of data')
+
+
+class ViewQueryBudgetTests(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.attachment_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.attachment_root)
+        self.settings_override = override_settings(ATTACHMENT_ROOT=self.attachment_root, ATTACHMENT_X_ACCEL_REDIRECT='')
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def get(self, url, htmx=False):
+        headers = {'HX-Request': 'true'} if htmx else {}
+        response = self.client.get(url, headers=headers)
+        self.assertIn(response.status_code, (200, 302))
+        return response
+
+    def test_home(self):
+        self.assertQueryBudget(lambda: self.get('/'), max_queries=4, max_rows=2)
+
+    def test_direct_message(self):
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        self.assertQueryBudget(lambda: self.get(f'/{self.bob.uuid}/'), max_queries=10, max_rows=page_size + 10)
+
+    def test_direct_message_partial(self):
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        self.assertQueryBudget(lambda: self.get(f'/{self.bob.uuid}/', htmx=True), max_queries=8, max_rows=page_size + 5)
+
+    def test_direct_message_post(self):
+        self.assertQueryBudget(lambda: self.client.post(f'/{self.bob.uuid}/', {'content': 'Hello'}), max_queries=6, max_rows=3)
+
+    def test_message_history(self):
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        query_string = urlencode({'before': timezone.now().isoformat(), 'before_uuid': 'ffffffff-ffff-ffff-ffff-ffffffffffff'})
+        url = f'/{self.bob.uuid}/history/?{query_string}'
+        self.assertQueryBudget(lambda: self.get(url, htmx=True), max_queries=5, max_rows=page_size + 5)
+
+    def test_delete_chat(self):
+        self.assertQueryBudget(lambda: self.client.post(f'/{self.bob.uuid}/delete/'), max_queries=4, max_rows=3)
+
+    def test_create_attachment_upload(self):
+        data = {'filename': 'file.txt', 'content_type': 'text/plain', 'size': 5}
+        self.assertQueryBudget(lambda: self.client.post(f'/{self.bob.uuid}/attachments/', data), max_queries=5, max_rows=3)
+
+    def test_attachment_upload(self):
+        def upload():
+            attachment = Attachment.objects.create(sender=self.alice, recipient=self.bob, filename='file.txt', size=5)
+            with QueryCounter() as counter:
+                response = self.client.put(
+                    f'/attachments/uploads/{attachment.uuid}/', b'hello',
+                    content_type='application/offset+octet-stream', headers={'Upload-Offset': '0'}
+                )
+                self.assertEqual(response.status_code, 200)
+            return counter
+
+        query_counts = []
+        for grow in (False, True):
+            if grow:
+                self.grow_data()
+            counter = upload()
+            query_counts.append(self.assertWithinBudget(counter, (0, 0), 11, 7, 'The chunk upload'))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_download_attachment(self):
+        upload_path = get_upload_path('download')
+        os.makedirs(os.path.dirname(upload_path), exist_ok=True)
+        with open(upload_path, 'wb') as upload_file:
+            upload_file.write(b'hello')
+        attachment = Attachment.objects.create(
+            sender=self.alice, recipient=self.bob, filename='file.txt', size=5, uploaded_size=5, file_hash=store_upload(upload_path)
+        )
+        self.assertQueryBudget(lambda: b''.join(self.get(f'/attachments/{attachment.uuid}/').streaming_content), max_queries=3, max_rows=3)
+
+    def test_groups_list(self):
+        self.assertQueryBudget(lambda: self.get('/groups/'), max_queries=6, max_rows=20)
+
+    def test_group_chat(self):
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        self.assertQueryBudget(lambda: self.get(f'/groups/{self.conversation.uuid}/', htmx=True), max_queries=8, max_rows=page_size + 15)
+
+    def test_group_chat_post(self):
+        url = f'/groups/{self.conversation.uuid}/'
+        self.assertQueryBudget(lambda: self.client.post(url, {'content': 'Hello'}), max_queries=8, max_rows=3)
+
+    def test_add_group_members(self):
+        new_friends = [self.create_user('grace'), self.create_user('heidi')]
+        for new_friend in new_friends:
+            self.make_friends(self.alice, new_friend)
+
+        url = f'/groups/{self.conversation.uuid}/members/'
+        self.assertQueryBudget(lambda: self.client.post(url, {'members': [new_friends.pop().id]}), max_queries=7, max_rows=4)
+
+    def test_metrics(self):
+        self.assertQueryBudget(lambda: self.get('/internal/metrics/'), max_queries=2, max_rows=2)
+
+
+class ConsumerQueryBudgetTests(QueryBudgetTestCase):
+    @staticmethod
+    async def login(user):
+        client = Client()
+        await sync_to_async(client.force_login)(user)
+        return client
+
+    async def connect(self, client, path='/ws/chat/'):
+        communicator = WebsocketCommunicator(application, path, headers=[
+            (b'cookie', f'sessionid={client.cookies[settings.SESSION_COOKIE_NAME].value}'.encode()),
+            (b'origin', b'http://testserver'),
+            (b'host', b'testserver')
+        ])
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    @staticmethod
+    async def drain(communicators):
+        '''Waits until every connection has finished handling its events'''
+        for communicator in communicators:
+            # Receiving with a timeout would cancel the application when it times out
+            while not await communicator.receive_nothing(timeout=0.2):
+                await communicator.receive_from()
+
+    async def run_handlers(self):
+        '''Runs each handler, and returns the number of queries made by it'''
+        query_counts = {}
+        communicators = []
+
+        with QueryCounter() as counter:
+            async def measure(label, action, max_queries, max_rows):
+                user_cache.clear()
+                start = counter.snapshot()
+                await action()
+                await self.drain(communicators)
+                query_counts[label] = self.assertWithinBudget(counter, start, max_queries, max_rows, label)
+
+            # Logging in is not part of the WebSocket handshake, so it isn't measured
+            clients = [await self.login(self.alice), await self.login(self.bob)]
+
+            async def connect_both():
+                communicators.extend([await self.connect(client) for client in clients])
+
+            async def send(communicator_index, data):
+                await communicators[communicator_index].send_to(text_data=json.dumps(data))
+
+            async def send_event(user, event):
+                await channel_layer.group_send(get_user_group(user), event)
+
+            await measure('connect', connect_both, max_queries=8, max_rows=6)
+
+            await measure('page_load direct_message', lambda: send(0, {'type': 'page_load', 'path': f'/{self.bob.uuid}/'}), max_queries=2, max_rows=1)
+            await measure('page_load direct_message (other user)', lambda: send(1, {'type': 'page_load', 'path': f'/{self.alice.uuid}/'}), max_queries=2, max_rows=1)
+            await measure('chat_send and chat_message', lambda: send(0, {'type': 'chat_send', 'content': 'Hello'}), max_queries=2, max_rows=1)
+
+            serialized_message = (await Message.objects.select_related('sender', 'recipient').alatest('timestamp')).serialize()
+            await measure('message_read', lambda: send_event(self.alice, {
+                'type': 'message_read', 'serialized_message': serialized_message, 'other_user': self.bob.serialize()
+            }), max_queries=0, max_rows=0)
+            await measure('all_messages_read', lambda: send_event(self.alice, Message._get_all_messages_read_event(self.bob, self.alice, 1) | {
+                'other_user': self.bob.serialize()
+            }), max_queries=0, max_rows=0)
+
+            await measure('page_load group_chat', lambda: send(1, {'type': 'page_load', 'path': f'/groups/{self.conversation.uuid}/'}), max_queries=1, max_rows=1)
+            await measure('page_load groups_list', lambda: send(0, {'type': 'page_load', 'path': '/groups/'}), max_queries=0, max_rows=0)
+            await measure('group_send and group_message', lambda: send(1, {'type': 'group_send', 'content': 'Hello'}), max_queries=5, max_rows=1)
+
+            await measure('conversation_joined', lambda: send_event(self.alice, Conversation._get_conversation_joined_event(self.conversation)), max_queries=0, max_rows=0)
+            await measure('conversation_left', lambda: send_event(self.alice, Conversation._get_conversation_left_event(self.conversation)), max_queries=0, max_rows=0)
+
+            await measure('page_load friends_list', lambda: send(0, {'type': 'page_load', 'path': '/friends/all/'}), max_queries=0, max_rows=0)
+            for event_type in ('friend_request_sent', 'friend_request_rejected', 'friend_request_cancelled', 'friend_request_accepted', 'friend_removed'):
+                event = {
+                    'type': event_type,
+                    'request': {'sender': self.dave.serialize(), 'recipient': self.alice.serialize()},
+                    'other_user': self.dave.serialize()
+                }
+                await measure(event_type, lambda: send_event(self.alice, event), max_queries=0, max_rows=0)
+
+            await measure('update_account', lambda: send_event(self.alice, {'type': 'update_account', 'other_user': self.bob.serialize()}), max_queries=0, max_rows=0)
+
+            await measure('block_updated', lambda: send_event(self.alice, User._get_block_updated_event(blocked=False) | {
+                'other_user': self.dave.serialize()
+            }), max_queries=0, max_rows=0)
+
+            await measure('chat_deletion_progress', lambda: send_event(self.alice, Message._get_chat_deletion_progress_event(1, 2) | {
+                'other_user': self.bob.serialize()
+            }), max_queries=0, max_rows=0)
+            await measure('chat_deleted', lambda: send_event(self.alice, Message._get_chat_deleted_event() | {
+                'other_user': self.bob.serialize()
+            }), max_queries=0, max_rows=0)
+
+            for communicator in communicators:
+                await communicator.disconnect()
+
+        return query_counts
+
+    @override_settings(WS_DELTA_EVENTS=True)
+    async def test_delta_events(self):
+        clients = [await self.login(self.alice), await self.login(self.bob)]
+        alice, bob = [await self.connect(client, '/ws/chat/?events=delta') for client in clients]
+        await alice.send_json_to({'type': 'page_load', 'path': '/friends/all/'})
+        await bob.send_json_to({'type': 'page_load', 'path': f'/{self.alice.uuid}/'})
+        await self.drain([alice, bob])
+
+        received = []
+        for content in ('Hello', 'Hello again'):
+            await bob.send_json_to({'type': 'chat_send', 'content': content})
+            received.append(await alice.receive_from())
+            await self.drain([alice, bob])
+
+        # The entry is sent in full the first time, after which only the changed fields are sent
+        first, second = [json.loads(data) for data in received]
+        self.assertEqual(first['type'], 'recent_chat_html')
+        self.assertEqual(second['type'], 'sidebar_entry_delta')
+        self.assertEqual(second['id'], f'chat-{self.bob.uuid}')
+        self.assertEqual(second['unreadCount'], 'increment')
+        self.assertEqual(second['lastMessage'], {'senderUsername': 'bob', 'text': 'Hello again', 'read': None})
+        self.assertLess(len(received[1]), len(received[0]))
+
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+    @override_settings(WS_DELTA_EVENTS=True)
+    async def test_delta_events_for_rendered_entries(self):
+        clients = [await self.login(self.alice), await self.login(self.bob)]
+        alice, bob = [await self.connect(client, '/ws/chat/?events=delta') for client in clients]
+        await alice.send_json_to({'type': 'page_load', 'path': '/friends/all/', 'sidebarEntries': [f'chat-{self.bob.uuid}']})
+        await bob.send_json_to({'type': 'page_load', 'path': f'/{self.alice.uuid}/'})
+        await self.drain([alice, bob])
+
+        # The page was rendered with the entry, so even the first update to it is a delta
+        await bob.send_json_to({'type': 'chat_send', 'content': 'Hello'})
+        received = json.loads(await alice.receive_from())
+        self.assertEqual(received['type'], 'sidebar_entry_delta')
+        self.assertEqual(received['id'], f'chat-{self.bob.uuid}')
+
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+    async def get_ws_token(self, client):
+        response = await sync_to_async(client.get)('/ws-token/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'max-age=0, no-cache, no-store, must-revalidate, private')
+        return response.json()['token']
+
+    async def test_token_handshake(self):
+        client = await self.login(self.alice)
+        token = await self.get_ws_token(client)
+
+        # Only the handshake is measured, not the sets loaded once it has been accepted
+        with mock.patch.object(User, 'aget_blocked_uuids', mock.AsyncMock(return_value=set())), \
+                mock.patch.object(ChatConsumer, '_add_to_conversation_groups', mock.AsyncMock()), QueryCounter() as counter:
+            alice = await self.connect(client, f"/ws/chat/?{urlencode({'token': token})}")
+            await self.drain([alice])
+        self.assertEqual(counter.queries, [])
+        await alice.disconnect()
+
+    async def test_ws_token_requires_login(self):
+        response = await sync_to_async(Client().get)('/ws-token/')
+        self.assertEqual(response.status_code, 204)
+
+    async def test_update_account_refreshes_own_user(self):
+        clients = [await self.login(self.alice), await self.login(self.bob)]
+        token = await self.get_ws_token(clients[0])
+        alice = await self.connect(clients[0], f"/ws/chat/?{urlencode({'token': token})}")
+        bob = await self.connect(clients[1])
+        await alice.send_json_to({'type': 'page_load', 'path': f'/{self.bob.uuid}/'})
+        await bob.send_json_to({'type': 'page_load', 'path': '/friends/all/'})
+        await self.drain([alice, bob])
+
+        # The username loaded from the token is replaced, so messages sent afterwards use the new one
+        self.alice.username = 'alicia'
+        await self.alice.asave(update_fields=['username'])
+        await channel_layer.group_send(get_user_group(self.alice), {'type': 'update_account', 'other_user': self.alice.serialize()})
+        await self.drain([alice])
+
+        await alice.send_json_to({'type': 'chat_send', 'content': 'Hello'})
+        received = await bob.receive_from()
+        self.assertIn('alicia', received)
+        await self.drain([alice, bob])
+
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+    async def test_handshake_does_not_wait_for_blocked_users(self):
+        loaded = asyncio.Event()
+
+        async def get_blocked_uuids(user):
+            await loaded.wait()
+            return set()
+
+        with mock.patch.object(User, 'aget_blocked_uuids', get_blocked_uuids):
+            # The connection is accepted while the set is still being loaded
+            alice = await asyncio.wait_for(self.connect(await self.login(self.alice)), timeout=5)
+            loaded.set()
+            await self.drain([alice])
+        await alice.disconnect()
+
+    async def test_blocked_chat_send(self):
+        # The block is only known from the set loaded when connecting, since the users are still friends
+        await self.bob.blocked_users.aadd(self.alice)
+        alice = await self.connect(await self.login(self.alice))
+        await alice.send_json_to({'type': 'page_load', 'path': f'/{self.bob.uuid}/'})
+        await self.drain([alice])
+
+        message_count = await Message.objects.acount()
+        with QueryCounter() as counter:
+            await alice.send_json_to({'type': 'chat_send', 'content': 'Hello'})
+            await self.drain([alice])
+
+        self.assertEqual(await Message.objects.acount(), message_count)
+        self.assertEqual(len(counter.queries), 0)
+        await alice.disconnect()
+
+    @override_settings(WS_RATE_LIMITS={'chat_send': (0.001, 1)})
+    async def test_rate_limited_chat_send(self):
+        alice = await self.connect(await self.login(self.alice))
+        await alice.send_json_to({'type': 'page_load', 'path': f'/{self.bob.uuid}/'})
+        await self.drain([alice])
+
+        await alice.send_json_to({'type': 'chat_send', 'content': 'First'})
+        await alice.send_json_to({'type': 'chat_send', 'content': 'Second'})
+        responses = []
+        while not await alice.receive_nothing(timeout=0.2):
+            responses.append(await alice.receive_json_from())
+
+        self.assertIn({'type': 'send_rate_limited', 'content': 'Second'}, responses)
+        self.assertEqual(await Message.objects.filter(content='Second').acount(), 0)
+        await alice.disconnect()
+
+    async def test_handlers(self):
+        query_counts = await self.run_handlers()
+        await sync_to_async(self.grow_data)()
+        grown_query_counts = await self.run_handlers()
+
+        self.assertEqual(query_counts, grown_query_counts, 'The number of queries made by a handler changed with the amount of data')
+
+
+class FragmentCacheTests(SimpleTestCase):
+    def test_evict(self):
+        cache = FragmentCache(3)
+        cache.set(('a.html', 'alice', 1), 'a')
+        cache.set(('b.html', 'alice', 1), 'b')
+        cache.set(('a.html', 'bob', 1), 'c')
+        cache.evict('alice', ['a.html'])
+        self.assertIsNone(cache.get(('a.html', 'alice', 1)))
+        self.assertEqual(cache.get(('b.html', 'alice', 1)), 'b')
+
+        # Fragments removed as the least recently used are also removed from the index of each entity's fragments
+        for template_name in ('b.html', 'c.html', 'd.html'):
+            cache.set((template_name, 'bob', 1), template_name)
+        self.assertNotIn('alice', cache._keys_by_entity)
+        cache.evict('bob')
+        self.assertEqual(len(cache._fragments), 0)
+
+    def test_user_fragments_are_shared_between_sessions(self):
+        friend = User(username='bob').serialize()
+        with mock.patch.object(fragments, 'fragment_cache', FragmentCache(10)), \
+                mock.patch.object(fragments, 'render_to_string', wraps=fragments.render_to_string) as render_to_string:
+            first = fragments.render_friend(friend, 'token_a')
+            second = fragments.render_friend(friend, 'token_b')
+
+        self.assertEqual(render_to_string.call_count, 1)
+        self.assertIn('value="token_a"', first)
+        self.assertIn('value="token_b"', second)
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def test_coalesces_with_last_message(self):
+        outbound_queue = OutboundQueue(2)
+        outbound_queue.put({'type': 'chat_message_html', 'html': ''})
+        outbound_queue.put({'type': 'decrement_unread_count', 'otherUserUuid': 'a'})
+        self.assertTrue(outbound_queue.put({'type': 'decrement_unread_count', 'otherUserUuid': 'a'}))
+        self.assertEqual(outbound_queue._messages[-1]['count'], 2)
+
+    def test_does_not_coalesce_past_later_messages(self):
+        # The read status would be applied to the older entry, then replaced by the re-rendered one
+        outbound_queue = OutboundQueue(2)
+        outbound_queue.put({'type': 'update_recent_chat_read_status', 'otherUserUuid': 'a'})
+        outbound_queue.put({'type': 'recent_chat_html', 'html': ''})
+        self.assertFalse(outbound_queue.put({'type': 'update_recent_chat_read_status', 'otherUserUuid': 'a'}))
+
+        outbound_queue = OutboundQueue(2)
+        outbound_queue.put({'type': 'update_section_count', 'page': 'friends', 'section': 'all', 'action': 'increment'})
+        outbound_queue.put({'type': 'update_section_count', 'page': 'friends', 'section': 'all', 'action': 'decrement'})
+        self.assertFalse(outbound_queue.put({'type': 'update_section_count', 'page': 'friends', 'section': 'all', 'action': 'increment'}))
+
+
+class MetricsTests(SimpleTestCase):
+    def create_metric(self, metric_class, *args):
+        metric = metric_class(*args)
+        self.addCleanup(metrics._registry.remove, metric)
+        return metric
+
+    def test_concurrent_updates(self):
+        counter = self.create_metric(metrics.Counter, 'test_total', 'Test counter')
+        histogram = self.create_metric(metrics.Histogram, 'test_seconds', 'Test histogram')
+
+        # Switching threads as often as possible makes lost updates likely without the lock
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        def record():
+            for _ in range(10000):
+                counter.inc()
+                histogram.observe(0.01)
+
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIn(f'test_total{{worker="{os.getpid()}"}} 80000', counter.expose())
+        self.assertIn(f'test_seconds_count{{worker="{os.getpid()}"}} 80000', histogram.expose())
+
+
+class ProfilingMiddlewareTests(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profiling_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profiling_dir)
+        self.settings_override = override_settings(
+            PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=1, PROFILING_THRESHOLD_MS=0, PROFILING_DIR=self.profiling_dir
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    async def test_async_view_is_profiled(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(f'/{self.bob.uuid}/')
+        self.assertEqual(response.status_code, 200)
+
+        [capture] = await sync_to_async(profiling.load_captures)()
+        self.assertEqual(capture['name'], f'direct_message (GET /{self.bob.uuid}/)')
+        # Both the view, which runs on the event loop, and the queries it makes through sync_to_async are in the profile
+        stats = pstats.Stats(os.path.join(self.profiling_dir, f'{capture["id"]}.prof'))
+        functions = {function for _, _, function in stats.stats}
+        self.assertIn('direct_message', functions)
+        self.assertIn('execute_sql', functions)
+        self.assertTrue(capture['queries'])
+
+
+class ChatDeletionTests(QueryBudgetTestCase):
+    @override_settings(CHAT_DELETION_BATCH_SIZE=10)
+    def test_delete_chat(self):
+        self.grow_data()
+        attachment = Attachment.objects.create(sender=self.alice, recipient=self.bob, filename='file.txt', size=5, uploaded_size=5, file_hash='0' * 64)
+        Message.create_attachment_message(attachment)
+
+        chat_filter = Message.get_chat_filter(self.alice, self.bob)
+        total = Message.objects.filter(chat_filter).count()
+        other_count = Message.objects.exclude(chat_filter).count()
+
+        events = []
+        with mock.patch('chat.models.send_both_users_ws_message', lambda user_1, user_2, event: events.append(event)), QueryCounter() as counter:
+            Message.delete_chat(self.alice, self.bob, before=timezone.now())
+
+        self.assertFalse(Message.objects.filter(chat_filter).exists())
+        self.assertFalse(Attachment.objects.exists())
+        self.assertEqual(Message.objects.count(), other_count)
+        self.assertEqual(events[-2], {'type': 'chat_deletion_progress', 'deleted': total, 'total': total})
+        self.assertEqual(events[-1], {'type': 'chat_deleted'})
+        # Only the primary keys of the deleted rows are fetched, along with the counts
+        self.assertLessEqual(counter.rows, total + 1 + 3)
+
+
+class AttachmentCleanupTests(TestCase):
+    def setUp(self):
+        self.attachment_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.attachment_root)
+        self.settings_override = override_settings(ATTACHMENT_ROOT=self.attachment_root)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        self.alice = User.objects.create(username='alice', email='alice@example.com', password='!')
+        self.bob = User.objects.create(username='bob', email='bob@example.com', password='!')
+        self.old = timezone.now() - timedelta(hours=settings.ATTACHMENT_UPLOAD_EXPIRY_HOURS + 1)
+
+    def create_upload(self, content, created=None):
+        attachment = Attachment.objects.create(sender=self.alice, recipient=self.bob, filename='file.txt', size=10, created=created or timezone.now())
+        upload_path = get_upload_path(attachment.uuid)
+        os.makedirs(os.path.dirname(upload_path), exist_ok=True)
+        with open(upload_path, 'wb') as upload_file:
+            upload_file.write(content)
+        return attachment, upload_path
+
+    def store_file(self, content, modified):
+        _, upload_path = self.create_upload(content)
+        file_path = get_file_path(store_upload(upload_path))
+        os.utime(file_path, (modified.timestamp(), modified.timestamp()))
+        return file_path
+
+    def test_stale_uploads_are_removed(self):
+        stale_attachment, stale_path = self.create_upload(b'stale', created=self.old)
+        attachment, upload_path = self.create_upload(b'current')
+        # Left behind by an upload which was deleted along with its chat
+        orphan_path = get_upload_path(uuid4())
+        shutil.copy(upload_path, orphan_path)
+
+        call_command('cleanupattachments', stdout=io.StringIO())
+        self.assertFalse(Attachment.objects.filter(uuid=stale_attachment.uuid).exists())
+        self.assertFalse(os.path.exists(stale_path))
+        self.assertFalse(os.path.exists(orphan_path))
+        self.assertTrue(os.path.exists(upload_path))
+
+    def test_unreferenced_files_are_removed(self):
+        referenced_path = self.store_file(b'referenced', self.old)
+        Attachment.objects.update(file_hash=os.path.basename(referenced_path))
+        unreferenced_path = self.store_file(b'unreferenced', self.old)
+        # May be about to be saved to the attachment it was uploaded for
+        recent_path = self.store_file(b'recent', timezone.now())
+
+        call_command('cleanupattachments', stdout=io.StringIO())
+        self.assertTrue(os.path.exists(referenced_path))
+        self.assertFalse(os.path.exists(unreferenced_path))
+        self.assertTrue(os.path.exists(recent_path))
+
+
+class MembershipTests(TestCase):
+    def test_messages_after_read_cursor_stay_unread(self):
+        alice = User.objects.create(username='alice', email='alice@example.com', password='!')
+        bob = User.objects.create(username='bob', email='bob@example.com', password='!')
+        conversation = Conversation.create_conversation(alice, 'Group', [bob])
+        GroupMessage.create_message(bob, conversation, 'Sent by the member')
+        read_message = GroupMessage.create_message(alice, conversation, 'Read')
+        # Sent while the page showing the message before it was loading
+        GroupMessage.create_message(alice, conversation, 'Unread')
+
+        membership = Membership.objects.get(conversation=conversation, user=bob)
+        self.assertEqual(membership.unread_count, 2)
+        membership.mark_as_read(read_message.timestamp)
+        membership.refresh_from_db()
+        self.assertEqual(membership.unread_count, 1)
+        self.assertEqual(membership.last_read_at, read_message.timestamp)
+
+
+class CompressedTextFieldTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', email='alice@example.com', password='!')
+        self.bob = User.objects.create(username='bob', email='bob@example.com', password='!')
+        self.long_content = 'INFO worker-1 request took 20ms\n' * 100
+
+    def test_long_content_is_stored_as_binary(self):
+        message = Message.objects.create(sender=self.alice, recipient=self.bob, content=self.long_content)
+        text, compressed = Message.objects.values_list('content', 'compressed_content').get(pk=message.pk)
+        self.assertEqual(text, '')
+        self.assertLess(len(compressed), len(self.long_content) / 10)
+
+        self.assertEqual(Message.objects.get(pk=message.pk).content, self.long_content)
+        self.assertEqual(Message.objects.defer('content', 'compressed_content').get(pk=message.pk).content, self.long_content)
+
+    def test_short_content_is_stored_unchanged(self):
+        message = Message.objects.create(sender=self.alice, recipient=self.bob, content='Hello')
+        self.assertEqual(Message.objects.values_list('content', 'compressed_content').get(pk=message.pk), ('Hello', None))
+
+        # Replacing long content with short content leaves nothing compressed
+        message = Message.objects.create(sender=self.alice, recipient=self.bob, content=self.long_content)
+        message.content = 'Hello'
+        message.save()
+        self.assertEqual(Message.objects.values_list('content', 'compressed_content').get(pk=message.pk), ('Hello', None))
+
+
+class CompressMessagesCommandTests(TestCase):
+    def test_long_messages_are_compressed(self):
+        alice = User.objects.create(username='alice', email='alice@example.com', password='!')
+        bob = User.objects.create(username='bob', email='bob@example.com', password='!')
+        content = 'INFO worker-1 request took 20ms\n' * 100
+        message = Message.objects.create(sender=alice, recipient=bob, content='')
+        # Stored the way messages were before compression was added
+        Message.objects.filter(pk=message.pk).update(content=content, preview='')
+
+        call_command('compressmessages', stdout=io.StringIO())
+        message = Message.objects.get(pk=message.pk)
+        self.assertIsNotNone(message.compressed_content)
+        self.assertEqual(message.content, content)
+        self.assertEqual(Message.objects.filter(content='').count(), 1)
+
+    def test_messages_without_content_are_updated_once(self):
+        alice = User.objects.create(username='alice', email='alice@example.com', password='!')
+        bob = User.objects.create(username='bob', email='bob@example.com', password='!')
+        # An attachment message has no content, so its preview stays empty after updating
+        Message.objects.create(sender=alice, recipient=bob, content='')
+        Message.objects.bulk_create([Message(sender=alice, recipient=bob, content=f'Message {i}') for i in range(3)])
+        Message.objects.update(preview='')
+
+        stdout = io.StringIO()
+        call_command('compressmessages', batch_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'Updated 4 messages')
+        self.assertEqual(Message.objects.filter(preview='').count(), 1)
+
+
+class MessageArchiveTests(QueryBudgetTestCase):
+    def create_archived_messages(self, months):
+        start = timezone.now() - timedelta(days=400)
+        for month in range(months):
+            self.create_messages(self.alice, self.bob, 10, start=start + timedelta(days=31 * month))
+        # Only read messages are archived, and the chats with other users are archived one at a time
+        Message.objects.filter(timestamp__lt=start + timedelta(days=31 * months)).update(read=True)
+        self.create_messages(self.alice, self.carol, 10, start=start)
+        ArchivedMessages.archive_messages(timezone.now() - timedelta(days=1))
+
+    def get_all_pages(self):
+        messages, has_older_messages = Message.get_messages(self.alice, self.bob)
+        uuids = [message['uuid'] for message in messages]
+        while has_older_messages:
+            before = (datetime.fromisoformat(messages[0]['timestamp']), UUID(messages[0]['uuid']))
+            with QueryCounter() as counter:
+                messages, has_older_messages = Message.get_messages(self.alice, self.bob, before=before)
+            # The archives are read by a single query, however many the page spans
+            self.assertLessEqual(len(counter.queries), 2)
+            uuids = [message['uuid'] for message in messages] + uuids
+        return uuids
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=15)
+    def test_history_spans_archives(self):
+        self.create_archived_messages(months=6)
+        self.assertGreater(ArchivedMessages.objects.count(), 5)
+
+        expected = [row[0] for archive in ArchivedMessages.objects.filter(user_1__in=[self.alice, self.bob], user_2__in=[self.alice, self.bob]).order_by('period_start') for row in archive.get_rows()]
+        expected += [str(uuid) for uuid in Message.objects.filter(Message.get_chat_filter(self.alice, self.bob)).order_by('timestamp', 'uuid').values_list('uuid', flat=True)]
+        self.assertEqual(self.get_all_pages(), expected)
+        self.assertEqual(ArchivedMessages.objects.filter(user_1__in=[self.alice, self.carol], user_2__in=[self.alice, self.carol]).count(), 1)
+
+    @override_settings(CHAT_DELETION_BATCH_SIZE=4)
+    def test_archived_messages_are_deleted_in_batches(self):
+        with QueryCounter() as counter:
+            self.create_archived_messages(months=1)
+        self.assertFalse(Message.objects.filter(timestamp__lt=timezone.now() - timedelta(days=300), read=True).exists())
+
+        deletes = [query for query in counter.queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 5)
+
+    def test_cursor_without_timezone(self):
+        self.create_archived_messages(months=1)
+        self.client.force_login(self.alice)
+        response = self.client.get(f'/{self.bob.uuid}/history/', {'before': '2030-01-01T00:00:00', 'before_uuid': str(uuid4())})
+        self.assertEqual(response.status_code, 400)
+
+
+class RunWorkersTests(SimpleTestCase):
+    def test_restart_delay(self):
+        self.assertEqual([runworkers.get_restart_delay(failures) for failures in range(4)], [1, 2, 4, 8])
+        self.assertEqual(runworkers.get_restart_delay(20), runworkers.RESTART_MAX_DELAY)
+
+    def test_drain_window_is_shared_by_workers(self):
+        self.assertEqual(runworkers.get_worker_drain_window({'drain_window': 30, 'workers': 4}), 7.5)
+
+
+class ChatExportTests(QueryBudgetTestCase):
+    async def export(self, **params):
+        response = await self.async_client.get(f'/{self.bob.uuid}/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    @override_settings(CHAT_EXPORT_CHUNK_SIZE=10)
+    async def test_export_chat(self):
+        await sync_to_async(self.grow_data)()
+        # Old messages which have been read are archived, while the unread ones are kept in the Message table
+        await sync_to_async(self.create_messages)(self.alice, self.bob, 20, start=timezone.now() - timedelta(days=400))
+        await sync_to_async(ArchivedMessages.archive_messages)(timezone.now())
+
+        chat_messages = Message.objects.filter(Message.get_chat_filter(self.alice, self.bob))
+        archived_uuids = [row[0] async for archive in ArchivedMessages.objects.filter(user_1__in=[self.alice, self.bob], user_2__in=[self.alice, self.bob]) for row in archive.get_rows()]
+        message_uuids = [str(uuid) async for uuid in chat_messages.values_list('uuid', flat=True)]
+        unread_count = await chat_messages.filter(read=False).acount()
+        self.assertTrue(archived_uuids)
+
+        await self.async_client.aforce_login(self.alice)
+        with QueryCounter() as counter:
+            records = [json.loads(line) for line in (await self.export()).decode().splitlines()]
+
+        self.assertCountEqual([record['uuid'] for record in records], archived_uuids + message_uuids)
+        self.assertEqual(records, sorted(records, key=lambda record: (record['timestamp'], record['uuid'])))
+        # The messages are read in chunks from a cursor, rather than with a query for each chunk
+        self.assertLessEqual(len(counter.queries), 5)
+        # Exporting the chat doesn't mark any messages as read
+        self.assertEqual(await chat_messages.filter(read=False).acount(), unread_count)
+
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(await self.export(format='csv', compress='gzip')).decode())))
+        self.assertEqual([row['uuid'] for row in rows], [record['uuid'] for record in records])
+
+
+class TaskQueueTests(TestCase):
+    def test_task_is_retried_with_backoff(self):
+        queued_task = failing_task.enqueue()
+
+        for attempts in range(1, settings.TASK_MAX_ATTEMPTS + 1):
+            Task.objects.filter(id=queued_task.id).update(run_after=timezone.now())
+            start = timezone.now()
+            self.assertEqual(run_due_tasks(), 1)
+
+            queued_task.refresh_from_db()
+            self.assertEqual(queued_task.attempts, attempts)
+            self.assertIn('The task failed', queued_task.last_error)
+            if attempts < settings.TASK_MAX_ATTEMPTS:
+                self.assertGreaterEqual(queued_task.run_after, start + get_retry_delay(attempts))
+
+        self.assertTrue(queued_task.failed)
+        Task.objects.filter(id=queued_task.id).update(run_after=timezone.now())
+        self.assertEqual(run_due_tasks(), 0)
+
+    def test_failed_task_arguments_are_removed(self):
+        queued_task = failing_task.enqueue('https://example.com/reset/secret/', link='https://example.com/reset/secret/')
+        Task.objects.filter(id=queued_task.id).update(attempts=settings.TASK_MAX_ATTEMPTS - 1)
+        run_due_tasks()
+
+        queued_task.refresh_from_db()
+        self.assertTrue(queued_task.failed)
+        self.assertEqual(queued_task.args, [])
+        self.assertEqual(queued_task.kwargs, {})
+
+    def test_lease_is_renewed(self):
+        queued_task = failing_task.enqueue()
+        [claimed_task] = claim_tasks(1)
+        lease_end = claimed_task.run_after
+
+        self.assertTrue(renew_lease(claimed_task))
+        queued_task.refresh_from_db()
+        self.assertGreaterEqual(queued_task.run_after, lease_end)
+        self.assertEqual(queued_task.run_after, claimed_task.run_after)
+
+        # Once the task has been retried, the running worker no longer holds the lease
+        run_task(claimed_task)
+        self.assertFalse(renew_lease(claimed_task))
+
+    def test_only_tasks_are_run(self):
+        Task.objects.create(name='os.system', args=['true'])
+        run_due_tasks()
+        self.assertIn('is not a task', Task.objects.get().last_error)
+
+    @override_settings(EMAIL_BACKEND='chat.mail.QueuedEmailBackend', QUEUED_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_emails_are_queued(self):
+        mail.EmailMultiAlternatives('Subject', 'Body', 'from@example.com', ['to@example.com'], alternatives=[('<p>Body</p>', 'text/html')]).send()
+        self.assertEqual(len(mail.outbox), 0)
+
+        run_due_tasks()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Subject')
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>Body</p>', 'text/html')])
+        self.assertFalse(Task.objects.exists())
+
+
+class HybridChannelLayerTests(SimpleTestCase):
+    '''Runs the same sends through HybridChannelLayer and RedisChannelLayer, which must deliver the same messages'''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.redis_server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        threading.Thread(target=cls.redis_server.serve_forever, daemon=True).start()
+        cls.addClassCleanup(cls.redis_server.server_close)
+        cls.addClassCleanup(cls.redis_server.shutdown)
+
+    def create_layers(self, layer_class, **config):
+        '''Returns two layers sharing a Redis server, standing in for two processes'''
+        prefix = f'{layer_class.__name__}_{self._testMethodName}'
+        return [layer_class(hosts=[self.redis_server.server_address], prefix=prefix, **config) for _ in range(2)]
+
+    @staticmethod
+    async def receive_all(layer, channel, sender):
+        '''
+        Returns the numbers of the messages waiting for a channel. A final message is sent through another process, so it arrives after
+        every message sent before it. Receiving isn't cancelled with a timeout, since the Redis layer can lose messages after that.
+        '''
+        await sender.send(channel, {'type': 'test', 'number': None})
+        numbers = []
+        while (number := (await layer.receive(channel))['number']) is not None:
+            numbers.append(number)
+        return numbers
+
+    async def run_group_sends(self, layer_class, **config):
+        '''
+        Sends messages to groups with two channels in the first process and one in the second, and returns the messages each
+        channel received after each step. Each step uses its own group, so earlier steps don't count towards its expiry.
+        '''
+        local_layer, remote_layer = self.create_layers(layer_class, **config)
+        channels = [(local_layer, await local_layer.new_channel()), (local_layer, await local_layer.new_channel()), (remote_layer, await remote_layer.new_channel())]
+
+        async def add_all(group):
+            for layer, channel in channels:
+                await layer.group_add(group, channel)
+
+        async def receive_step(same_process=False):
+            # Messages from different processes have no order relative to each other
+            return [
+                sorted(await self.receive_all(layer, channel, layer if same_process else local_layer if layer is remote_layer else remote_layer))
+                for layer, channel in channels
+            ]
+
+        steps = {}
+        await add_all('sent')
+        await local_layer.group_send('sent', {'type': 'test', 'number': 1})
+        await remote_layer.group_send('sent', {'type': 'test', 'number': 2})
+        steps['local and remote'] = await receive_step()
+
+        await add_all('discarded')
+        await local_layer.group_discard('discarded', channels[1][1])
+        await local_layer.group_send('discarded', {'type': 'test', 'number': 3})
+        steps['discard'] = await receive_step()
+
+        await add_all('expired')
+        await asyncio.sleep(local_layer.group_expiry + 0.1)
+        await local_layer.group_send('expired', {'type': 'test', 'number': 4})
+        steps['expiry'] = await receive_step()
+
+        await add_all('flushed')
+        await local_layer.flush()
+        await local_layer.group_send('flushed', {'type': 'test', 'number': 5})
+        # The fake Redis server keeps serving a blocking pop after its connection is closed by flushing, so the message which ends the
+        # step is sent from the same process
+        steps['flush'] = await receive_step(same_process=True)
+
+        await remote_layer.flush()
+        return steps
+
+    async def test_group_send_matches_redis_layer(self):
+        steps = await self.run_group_sends(HybridChannelLayer, group_expiry=1)
+        self.assertEqual(steps, await self.run_group_sends(RedisChannelLayer, group_expiry=1))
+        self.assertEqual(steps['local and remote'], [[1, 2], [1, 2], [1, 2]])
+        self.assertEqual(steps['discard'], [[3], [], [3]])
+        self.assertEqual(steps['expiry'], [[], [], []])
+        self.assertEqual(steps['flush'], [[], [], []])
+
+    async def test_capacity_matches_redis_layer(self):
+        for layer_class in (HybridChannelLayer, RedisChannelLayer):
+            with self.subTest(layer_class=layer_class.__name__):
+                layer, other_layer = self.create_layers(layer_class, capacity=2)
+                channel = await layer.new_channel()
+                await layer.group_add('group', channel)
+
+                for number in range(2):
+                    await layer.send(channel, {'type': 'test', 'number': number})
+                with self.assertRaises(ChannelFull):
+                    await layer.send(channel, {'type': 'test', 'number': 2})
+                # Full channels are skipped by group sends
+                await layer.group_send('group', {'type': 'test', 'number': 3})
+
+                self.assertEqual([(await layer.receive(channel))['number'] for _ in range(2)], [0, 1])
+                self.assertEqual(await self.receive_all(layer, channel, other_layer), [])
+                await layer.flush()
+
+
+    async def test_message_expiry_matches_redis_layer(self):
+        for layer_class in (HybridChannelLayer, RedisChannelLayer):
+            with self.subTest(layer_class=layer_class.__name__):
+                layer, other_layer = self.create_layers(layer_class, expiry=1)
+                channel = await layer.new_channel()
+                await layer.send(channel, {'type': 'test', 'number': 0})
+                await asyncio.sleep(1.1)
+                await layer.send(channel, {'type': 'test', 'number': 1})
+
+                self.assertEqual(await self.receive_all(layer, channel, other_layer), [1])
+                await layer.flush()
+
+    async def test_stopped_channel_is_dropped(self):
+        layer, _ = self.create_layers(HybridChannelLayer)
+        channel = await layer.new_channel()
+        await layer.group_add('group', channel)
+
+        receive = asyncio.create_task(layer.receive(channel))
+        await asyncio.sleep(0)
+        receive.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await receive
+
+        # The consumer stopped without discarding its membership, which no longer buffers messages for it
+        await layer.group_send('group', {'type': 'test', 'number': 0})
+        self.assertNotIn(channel, layer.receive_buffer)
+        self.assertNotIn('group', layer.local_groups)
+        await layer.flush()
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        cache.delete(get_primary_pin_cache_key('session_a'))
+
+    def test_reads_outside_handlers_use_primary(self):
+        self.assertEqual(Message.objects.all().db, 'default')
+
+    def test_reads_use_replica(self):
+        with ReplicaRouting('session_a'):
+            self.assertEqual(Message.objects.all().db, 'replica')
+
+    def test_reads_after_write_use_primary(self):
+        with ReplicaRouting('session_a') as routing:
+            self.assertEqual(router.db_for_write(Message), 'default')
+            self.assertEqual(Message.objects.all().db, 'default')
+        self.assertTrue(routing.wrote)
+
+    def test_reads_in_transaction_use_primary(self):
+        with ReplicaRouting('session_a'), mock.patch.object(connections['default'], 'in_atomic_block', True):
+            self.assertEqual(Message.objects.all().db, 'default')
+
+    def test_pinned_session_reads_from_primary(self):
+        pin_to_primary('session_a')
+        with ReplicaRouting('session_a'):
+            self.assertEqual(Message.objects.all().db, 'default')
+        with ReplicaRouting('session_b'):
+            self.assertEqual(Message.objects.all().db, 'replica')
+
+    def test_unsafe_requests_read_from_primary(self):
+        with ReplicaRouting('session_a', use_primary=True):
+            self.assertEqual(Message.objects.all().db, 'default')
+
+    def test_use_primary(self):
+        with ReplicaRouting('session_a'):
+            use_primary()
+            self.assertEqual(Message.objects.all().db, 'default')
+
+
+class StaticFilesStorageTests(SimpleTestCase):
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root)
+        self.settings_override = override_settings(STATIC_ROOT=self.static_root)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_collected_files_are_hashed_and_compressed(self):
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+        self.assertRegex(static('css/main.css'), r'^/static/css/main\.[0-9a-f]{12}\.css$')
+        path = staticfiles_storage.path(staticfiles_storage.stored_name('css/main.css'))
+        with open(path, 'rb') as file:
+            content = file.read()
+        with open(f'{path}.gz', 'rb') as file:
+            self.assertEqual(gzip.decompress(file.read()), content)
+        with open(f'{path}.br', 'rb') as file:
+            self.assertEqual(brotli.decompress(file.read()), content)
+
+        # Images which are already compressed have no variants
+        png_path = staticfiles_storage.path(staticfiles_storage.stored_name('images/favicon.png'))
+        self.assertTrue(os.path.exists(png_path))
+        self.assertFalse(os.path.exists(f'{png_path}.gz'))
+
+    def test_uncollected_files_keep_their_names(self):
+        self.assertEqual(static('css/main.css'), '/static/css/main.css')
+
+    def test_strict_manifest_raises_for_missing_files(self):
+        storage = CompressedManifestStaticFilesStorage()
+        with self.assertRaises(ValueError):
+            storage.stored_name('css/main.css')
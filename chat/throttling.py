@@ -0,0 +1,122 @@
+import asyncio
+import time
+from collections import deque
+from weakref import WeakSet
+from .metrics import Gauge, throttling_actions
+
+# Every outbound queue of the open connections in this process
+outbound_queues = WeakSet()
+
+Gauge(
+    'chat_outbound_queued_messages', 'Number of messages waiting to be sent to WebSocket clients',
+    function=lambda: sum(len(outbound_queue) for outbound_queue in outbound_queues)
+)
+Gauge(
+    'chat_outbound_queue_max_messages', 'Largest number of messages waiting to be sent to a single WebSocket client',
+    function=lambda: max(map(len, outbound_queues), default=0)
+)
+
+
+class TokenBucket:
+    '''Allows up to `capacity` messages in a burst, refilled at `rate` messages per second'''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def consume(self):
+        '''Returns True if a token was available and consumed, False otherwise'''
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+def _merge_count(queued_message, message):
+    queued_message['count'] = queued_message.get('count', 1) + message.get('count', 1)
+
+
+def _keep_queued(queued_message, message):
+    # The queued message already has the same effect on the client side
+    pass
+
+
+# Message type -> (fields identifying messages which can be merged, merge function)
+COALESCIBLE_MESSAGES = {
+    'update_section_count': (('page', 'section', 'action'), _merge_count),
+    'decrement_unread_count': (('otherUserUuid',), _merge_count),
+    'update_recent_chat_read_status': (('otherUserUuid',), _keep_queued),
+    'update_message_read_status': (('messageUuid',), _keep_queued),
+    'update_all_messages_read_status': (('senderUuid',), _keep_queued),
+}
+
+
+class OutboundQueue:
+    '''A bounded queue of messages waiting to be sent to a WebSocket client'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._messages = deque()
+        self._not_empty = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._unfinished = 0
+        outbound_queues.add(self)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, message):
+        '''Returns False if the queue is full and the message could not be merged with a queued message'''
+        if len(self._messages) >= self.maxsize:
+            if not self._coalesce(message):
+                throttling_actions.inc('outbound_overflowed')
+                return False
+
+            throttling_actions.inc('outbound_coalesced')
+            return True
+
+        self._messages.append(message)
+        self._unfinished += 1
+        self._not_empty.set()
+        self._drained.clear()
+        return True
+
+    def _coalesce(self, message):
+        '''
+        Merges the message into the last queued message if they have the same type and fields. Earlier messages aren't merged into,
+        since a later message, such as a re-rendered sidebar entry, could have changed what they apply to.
+        '''
+        if message['type'] not in COALESCIBLE_MESSAGES or not self._messages:
+            return False
+
+        fields, merge = COALESCIBLE_MESSAGES[message['type']]
+        queued_message = self._messages[-1]
+        if queued_message['type'] == message['type'] and all(queued_message.get(field) == message.get(field) for field in fields):
+            merge(queued_message, message)
+            return True
+
+        return False
+
+    async def get(self):
+        while not self._messages:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        return self._messages.popleft()
+
+    def task_done(self):
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._drained.set()
+
+    async def join(self):
+        '''Wait until every queued message has been sent'''
+        await self._drained.wait()
@@ -1,9 +1,21 @@
 from django.urls import path
 from . import views
 
-CHAT_URLS = ['chat_home', 'direct_message']
+CHAT_URLS = ['chat_home', 'direct_message', 'groups_list', 'group_chat']
 
 urlpatterns = [
     path('', views.home, name='chat_home'),
     path('<uuid:uuid>/', views.direct_message, name='direct_message'),
+    path('<uuid:uuid>/history/', views.message_history, name='message_history'),
+    path('<uuid:uuid>/delete/', views.delete_chat, name='delete_chat'),
+    path('<uuid:uuid>/export/', views.export_chat, name='export_chat'),
+    path('<uuid:uuid>/attachments/', views.create_attachment_upload, name='create_attachment_upload'),
+    path('attachments/uploads/<uuid:uuid>/', views.attachment_upload, name='attachment_upload'),
+    path('attachments/<uuid:uuid>/', views.download_attachment, name='download_attachment'),
+    path('groups/', views.groups_list, name='groups_list'),
+    path('groups/<uuid:uuid>/', views.group_chat, name='group_chat'),
+    path('groups/<uuid:uuid>/members/', views.add_group_members, name='add_group_members'),
+    path('groups/<uuid:uuid>/leave/', views.leave_group, name='leave_group'),
+    path('ws-token/', views.ws_token, name='ws_token'),
+    path('internal/metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
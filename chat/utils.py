@@ -1,17 +1,25 @@
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core import signing
+from django.utils.crypto import salted_hmac
+from .metrics import group_send_seconds
+from .versions import bump_user_versions, bump_user_versions_async
 
 channel_layer = get_channel_layer()
 
 
 async def _group_send(group_name, event):
-    await channel_layer.group_send(
-        group_name, event
-    )
+    with group_send_seconds.time():
+        await channel_layer.group_send(
+            group_name, event
+        )
 
 
 def get_session_group(session):
-    return f'session_{session.session_key}'
+    # The session key is hashed so the group name can be shared with the client in a WebSocket token without exposing the session key
+    session_hash = salted_hmac('chat.session_group', session.session_key).hexdigest()
+    return f'session_{session_hash}'
 
 
 def send_session_ws_message(session, event):
@@ -24,11 +32,13 @@ def get_user_group(user):
 
 
 def send_user_ws_message(user, event):
+    bump_user_versions(user, event['type'])
     group_name = get_user_group(user)
     async_to_sync(_group_send)(group_name, event)
 
 
 async def send_user_ws_message_async(user, event):
+    await bump_user_versions_async(user, event['type'])
     group_name = get_user_group(user)
     await _group_send(group_name, event)
 
@@ -48,4 +58,44 @@ async def send_both_users_ws_message_async(user_1, user_2, event):
         (user_2, user_1)
     ]:
         event['other_user'] = other_user.serialize()
-        await send_user_ws_message_async(user, event=event)
\ No newline at end of file
+        await send_user_ws_message_async(user, event=event)
+
+
+def get_conversation_group(conversation_uuid):
+    return f'conversation_{conversation_uuid}'
+
+
+def send_conversation_ws_message(conversation_uuid, event):
+    group_name = get_conversation_group(conversation_uuid)
+    async_to_sync(_group_send)(group_name, event)
+
+
+async def send_conversation_ws_message_async(conversation_uuid, event):
+    group_name = get_conversation_group(conversation_uuid)
+    await _group_send(group_name, event)
+
+
+WS_TOKEN_SALT = 'chat.ws_token'
+
+
+def get_revoked_ws_token_cache_key(session_group):
+    return f'ws_token_revoked_{session_group}'
+
+
+def create_ws_token(session, user):
+    '''Returns a signed token containing everything needed to authenticate a WebSocket connection without accessing the database'''
+    return signing.dumps({
+        'session_group': get_session_group(session),
+        'user_id': user.id,
+        'uuid': str(user.uuid),
+        'username': user.username,
+        'avatar_hash': user.avatar_hash
+    }, salt=WS_TOKEN_SALT)
+
+
+def load_ws_token(token):
+    '''Returns the data contained in a WebSocket token, or None if the token is invalid or has expired'''
+    try:
+        return signing.loads(token, salt=WS_TOKEN_SALT, max_age=settings.WS_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
\ No newline at end of file
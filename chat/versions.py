@@ -0,0 +1,160 @@
+import time
+from functools import wraps
+from hashlib import md5
+from asgiref.sync import iscoroutinefunction
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
+from django.views.decorators.http import condition
+from .replicas import use_primary
+
+CHATS = 'chats'
+FRIENDS = 'friends'
+
+# WebSocket event type -> the scopes of a user's state which are changed by the event
+EVENT_VERSION_SCOPES = {
+    'chat_message': (CHATS,),
+    'message_read': (CHATS,),
+    'all_messages_read': (CHATS,),
+    'chat_deletion_progress': (CHATS,),
+    'chat_deleted': (CHATS,),
+    'friend_request_sent': (FRIENDS,),
+    'friend_request_accepted': (FRIENDS,),
+    'friend_request_rejected': (FRIENDS,),
+    'friend_request_cancelled': (FRIENDS,),
+    'friend_removed': (FRIENDS,),
+    'update_account': (CHATS, FRIENDS),
+    'account_deleted': (CHATS, FRIENDS),
+}
+
+HTMX_REQUEST_HEADERS = ['HX-Request', 'HX-History-Restore-Request', 'HX-Full-Page-Request']
+
+
+def _get_version_key(user_id, scope):
+    return f'user_version_{user_id}_{scope}'
+
+
+def _get_initial_version():
+    # Start from the current time, so a version which has been evicted from the cache never repeats an older value
+    return time.time_ns()
+
+
+def get_user_versions(user, scopes):
+    '''Returns the current version of each of the specified scopes of a user's state'''
+    keys = [_get_version_key(user.id, scope) for scope in scopes]
+    versions = cache.get_many(keys)
+
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _get_initial_version(), timeout=None)
+            versions[key] = cache.get(key)
+
+    return [versions[key] for key in keys]
+
+
+async def get_user_versions_async(user, scopes):
+    keys = [_get_version_key(user.id, scope) for scope in scopes]
+    versions = await cache.aget_many(keys)
+
+    for key in keys:
+        if key not in versions:
+            await cache.aadd(key, _get_initial_version(), timeout=None)
+            versions[key] = await cache.aget(key)
+
+    return [versions[key] for key in keys]
+
+
+def bump_user_versions(user, event_type):
+    '''Increments the versions of the scopes of a user's state which are changed by an event'''
+    for scope in EVENT_VERSION_SCOPES.get(event_type, ()):
+        key = _get_version_key(user.id, scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _get_initial_version(), timeout=None)
+
+
+async def bump_user_versions_async(user, event_type):
+    for scope in EVENT_VERSION_SCOPES.get(event_type, ()):
+        key = _get_version_key(user.id, scope)
+        try:
+            await cache.aincr(key)
+        except ValueError:
+            await cache.aadd(key, _get_initial_version(), timeout=None)
+
+
+def _get_etag(request, user, versions):
+    etag_parts = [
+        request.resolver_match.view_name,
+        user.id,
+        request.session.session_key,
+        request.COOKIES.get('csrftoken'),
+        *[request.headers.get(header) for header in HTMX_REQUEST_HEADERS],
+        *versions
+    ]
+    return md5(repr(etag_parts).encode(), usedforsecurity=False).hexdigest()
+
+
+def _patch_conditional_response(response):
+    if response.has_header('ETag'):
+        # Allow the browser to store the response, but revalidate it with the server on every request
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, HTMX_REQUEST_HEADERS)
+    return response
+
+
+def user_version_condition(get_scopes):
+    '''
+    Decorator for GET views whose responses only change when the requesting user's state changes. Both sync and async views can be decorated.
+    Versions are bumped by the event sent when the state changes, which can be before a replica has the change, so cached responses are
+    read from the primary database. Otherwise a response rendered from a lagging replica would be answered with 304 until the next bump.
+    - get_scopes: a function taking the request, and returning the scopes the response depends on, or None if the response should not be cached
+    '''
+    def etag_func(request, *args, **kwargs):
+        if request.method != 'GET':
+            return None
+
+        scopes = get_scopes(request)
+        if scopes is None:
+            return None
+
+        use_primary()
+        return _get_etag(request, request.user, get_user_versions(request.user, scopes))
+
+    async def aetag_func(request):
+        if request.method != 'GET':
+            return None
+
+        scopes = get_scopes(request)
+        if scopes is None:
+            return None
+
+        use_primary()
+        user = await request.auser()
+        return quote_etag(_get_etag(request, user, await get_user_versions_async(user, scopes)))
+
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            # Django's condition decorator would call the ETag function synchronously, blocking the event loop on the cache
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                etag = await aetag_func(request)
+                response = get_conditional_response(request, etag=etag) if etag is not None else None
+                if response is None:
+                    response = await view_func(request, *args, **kwargs)
+                if etag is not None:
+                    response.headers.setdefault('ETag', etag)
+
+                return _patch_conditional_response(response)
+
+            return async_wrapper
+
+        conditional_view_func = condition(etag_func=etag_func)(view_func)
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            return _patch_conditional_response(conditional_view_func(request, *args, **kwargs))
+
+        return wrapper
+
+    return decorator
@@ -1,8 +1,28 @@
-from django.shortcuts import redirect, render, get_object_or_404
+import ipaddress
+import os
+from uuid import UUID
+from django.conf import settings
+from django.shortcuts import redirect, render, get_object_or_404, aget_object_or_404
 from django.contrib.auth import get_user_model
-from django.contrib.auth.decorators import login_required
-from .forms import MessageForm
-from .models import Message
+from django.contrib.auth.decorators import login_required, login_not_required
+from django.core.exceptions import BadRequest
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import content_disposition_header
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_http_methods, require_POST
+from users.user_cache import get_user_or_404, aget_user_or_404
+from .attachments import get_upload_path, get_file_path, get_file_relative_path, write_chunk, store_upload, parse_range, read_file_range
+from .exports import EXPORT_CONTENT_TYPES, aiter_chat_export
+from .metrics import expose_metrics
+from .forms import MessageForm, AttachmentUploadForm, ConversationForm, AddMembersForm, GroupMessageForm
+from .models import Message, Attachment, Conversation, Membership, GroupMessage
+from .utils import create_ws_token
+from . import tasks
 
 User = get_user_model()
 
@@ -14,6 +34,14 @@ def get_home_context(user):
     }
 
 
+async def aget_home_context(user):
+    # Querysets are evaluated here, since templates are rendered synchronously and can't use the async ORM
+    return {
+        'recent_chats': await Message.aget_recent_chats(user),
+        'incoming_requests': [request_sender async for request_sender in user.get_incoming_requests()]
+    }
+
+
 @login_required(redirect_field_name=None)
 def home(request):
     request.session['from_home'] = True
@@ -21,29 +49,307 @@ def home(request):
 
 
 @login_required(redirect_field_name=None)
-def direct_message(request, uuid):
-    user = request.user
-    current_other_user = get_object_or_404(User, uuid=uuid)
-    are_friends = user.has_friend_mutual(current_other_user)
+async def direct_message(request, uuid):
+    user = await request.auser()
+    current_other_user = await aget_user_or_404(uuid)
+    are_friends = await user.ahas_friend_mutual(current_other_user)
+    blocker_ids = await user.aget_blocker_ids(current_other_user)
     
     # A POST request is only made when a websocket message could not be sent
     if request.method == 'POST':
-        form = MessageForm(request.POST, initial={'sender': user, 'recipient': current_other_user, 'are_friends': are_friends})
+        form = MessageForm(request.POST, initial={
+            'sender': user,
+            'recipient': current_other_user,
+            'are_friends': are_friends,
+            'is_blocked': bool(blocker_ids)
+        })
         if form.is_valid():
-            form.save()
+            await form.instance.asave()
             return redirect('direct_message', current_other_user.uuid)
     else:
         form = MessageForm()
 
-    chat_messages = Message.get_messages(user, current_other_user)
+    chat_messages, has_older_messages = await Message.aget_messages(user, current_other_user)
 
     context = {
         'title': f'Chat - {current_other_user.username}',
         'current_other_user': current_other_user,
         'are_friends': are_friends,
+        'has_blocked': user.id in blocker_ids,
         'form': form,
-        'chat_messages': chat_messages
+        'chat_messages': chat_messages,
+        'has_older_messages': has_older_messages
     }
     if request.headers.get('HX-Request') and not (request.headers.get('HX-History-Restore-Request') or request.headers.get('HX-Full-Page-Request')):
         return render(request, 'chat/partials/direct_message.html', context)
-    return render(request, 'chat/direct_message.html', context | get_home_context(user))
\ No newline at end of file
+    return render(request, 'chat/direct_message.html', context | await aget_home_context(user))
+
+def get_before_cursor(request):
+    try:
+        timestamp = parse_datetime(request.GET.get('before', ''))
+        uuid = UUID(request.GET.get('before_uuid', ''))
+    except ValueError:
+        timestamp = None
+
+    # Messages are compared by aware timestamps, so a cursor without a timezone can't be placed among them
+    if timestamp is None or timezone.is_naive(timestamp):
+        raise BadRequest('Invalid message history cursor')
+    return timestamp, uuid
+
+
+@login_required(redirect_field_name=None)
+def message_history(request, uuid):
+    current_other_user = get_user_or_404(uuid)
+    chat_messages, has_older_messages = Message.get_messages(request.user, current_other_user, before=get_before_cursor(request))
+
+    context = {
+        'current_other_user': current_other_user,
+        'chat_messages': chat_messages,
+        'has_older_messages': has_older_messages
+    }
+    return render(request, 'chat/partials/message_history.html', context)
+
+
+@login_required(redirect_field_name=None)
+@require_POST
+def delete_chat(request, uuid):
+    # Only the messages sent so far are deleted, in case either user sends another while the chat is being deleted
+    tasks.delete_chat.enqueue(request.user.id, get_user_or_404(uuid).id, timezone.now().isoformat())
+    return redirect('chat_home')
+
+
+@login_required(redirect_field_name=None)
+async def export_chat(request, uuid):
+    user = await request.auser()
+    current_other_user = await aget_user_or_404(uuid)
+
+    export_format = request.GET.get('format', 'jsonl')
+    if export_format not in EXPORT_CONTENT_TYPES:
+        raise BadRequest('Invalid export format')
+    compress = request.GET.get('compress') == 'gzip'
+
+    filename = f'chat-{current_other_user.username}.{export_format}' + ('.gz' if compress else '')
+    content_type = 'application/gzip' if compress else EXPORT_CONTENT_TYPES[export_format]
+    response = StreamingHttpResponse(aiter_chat_export(user, current_other_user, export_format, compress), content_type=content_type)
+    response['Content-Disposition'] = content_disposition_header(as_attachment=True, filename=filename)
+    return response
+
+
+def get_attachment_upload_response(attachment, status=200):
+    response = HttpResponse(status=status)
+    response['Upload-Offset'] = attachment.uploaded_size
+    response['Upload-Length'] = attachment.size
+    response['Upload-Chunk-Size'] = settings.ATTACHMENT_CHUNK_SIZE
+    return response
+
+
+@login_required(redirect_field_name=None)
+@require_POST
+def create_attachment_upload(request, uuid):
+    user = request.user
+    current_other_user = get_user_or_404(uuid)
+
+    form = AttachmentUploadForm(request.POST, initial={'are_friends': user.has_friend_mutual(current_other_user)})
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    attachment = form.save(commit=False)
+    attachment.sender = user
+    attachment.recipient = current_other_user
+    attachment.save()
+
+    return JsonResponse({
+        'url': reverse('attachment_upload', args=[attachment.uuid]),
+        'offset': attachment.uploaded_size,
+        'chunk_size': settings.ATTACHMENT_CHUNK_SIZE
+    }, status=201)
+
+
+@login_required(redirect_field_name=None)
+@require_http_methods(['HEAD', 'PUT'])
+def attachment_upload(request, uuid):
+    '''
+    HEAD returns the number of bytes uploaded so far, so an interrupted upload can be resumed.
+    PUT appends a chunk, which must start at the offset given in the Upload-Offset header.
+    '''
+    attachment = get_object_or_404(Attachment, uuid=uuid, sender=request.user)
+
+    if request.method == 'HEAD':
+        return get_attachment_upload_response(attachment)
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+        content_length = int(request.headers.get('Content-Length', ''))
+    except ValueError:
+        raise BadRequest('Missing Upload-Offset or Content-Length header')
+
+    if content_length > settings.ATTACHMENT_CHUNK_SIZE:
+        return get_attachment_upload_response(attachment, status=413)
+
+    if not request.user.has_friend_mutual(attachment.recipient):
+        return get_attachment_upload_response(attachment, status=403)
+
+    with transaction.atomic():
+        # Lock the attachment, so chunks of the same upload are written one at a time
+        attachment = Attachment.objects.select_for_update().get(uuid=attachment.uuid)
+        if attachment.is_complete() or offset != attachment.uploaded_size:
+            return get_attachment_upload_response(attachment, status=409)
+
+        upload_path = get_upload_path(attachment.uuid)
+        max_size = min(content_length, attachment.size - offset)
+        attachment.uploaded_size = write_chunk(upload_path, offset, request, max_size)
+
+        if attachment.uploaded_size == attachment.size:
+            attachment.file_hash = store_upload(upload_path)
+        attachment.save(update_fields=['uploaded_size', 'file_hash'])
+
+    if attachment.is_complete():
+        Message.create_attachment_message(attachment)
+
+    return get_attachment_upload_response(attachment)
+
+
+@login_required(redirect_field_name=None)
+def download_attachment(request, uuid):
+    attachment = get_object_or_404(Attachment, uuid=uuid)
+    if not attachment.is_complete() or not attachment.can_access(request.user):
+        raise Http404
+
+    content_disposition = content_disposition_header(as_attachment=True, filename=attachment.filename)
+
+    if settings.ATTACHMENT_X_ACCEL_REDIRECT:
+        # nginx sends the file, including any range requested, so the ASGI worker doesn't have to
+        response = HttpResponse(content_type=attachment.content_type)
+        response['X-Accel-Redirect'] = settings.ATTACHMENT_X_ACCEL_REDIRECT + get_file_relative_path(attachment.file_hash)
+        response['Content-Disposition'] = content_disposition
+        return response
+
+    file_path = get_file_path(attachment.file_hash)
+    size = os.path.getsize(file_path)
+    try:
+        byte_range = parse_range(request.headers.get('Range', ''), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    start, end = byte_range or (0, size - 1)
+    response = StreamingHttpResponse(read_file_range(file_path, start, end), content_type=attachment.content_type, status=206 if byte_range else 200)
+    response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return response
+
+
+@login_required(redirect_field_name=None)
+def groups_list(request):
+    user = request.user
+
+    if request.method == 'POST':
+        form = ConversationForm(request.POST, initial={'user': user})
+        if form.is_valid():
+            conversation = Conversation.create_conversation(user, form.cleaned_data['name'], form.cleaned_data['members'])
+            return redirect('group_chat', conversation.uuid)
+    else:
+        form = ConversationForm(initial={'user': user})
+
+    context = {
+        'title': 'Groups',
+        'groups': Conversation.get_groups(user),
+        'form': form
+    }
+    if request.headers.get('HX-Request') and not (request.headers.get('HX-History-Restore-Request') or request.headers.get('HX-Full-Page-Request')):
+        return render(request, 'chat/partials/groups_list.html', context)
+    return render(request, 'chat/groups_list.html', context | get_home_context(user))
+
+
+def get_membership(user, uuid):
+    return get_object_or_404(Membership.objects.select_related('conversation'), conversation__uuid=uuid, user=user)
+
+
+@login_required(redirect_field_name=None)
+def group_chat(request, uuid):
+    user = request.user
+    membership = get_membership(user, uuid)
+    conversation = membership.conversation
+
+    # A POST request is only made when a websocket message could not be sent
+    if request.method == 'POST':
+        form = GroupMessageForm(request.POST)
+        if form.is_valid():
+            GroupMessage.send(user, conversation, form.cleaned_data['content'])
+            return redirect('group_chat', conversation.uuid)
+    else:
+        form = GroupMessageForm()
+
+    # The read cursor is read before the messages are marked as read, so the first unread message can be shown
+    last_read_at = membership.last_read_at
+    chat_messages = []
+    for message in GroupMessage.get_messages(membership):
+        serialized_message = message.serialize()
+        serialized_message['unread'] = str(message.sender_id != user.id and message.timestamp > last_read_at)
+        chat_messages.append(serialized_message)
+
+    context = {
+        'title': f'Group - {conversation}',
+        'conversation': conversation,
+        'members': User.objects.filter(memberships__conversation=conversation).order_by(Lower('username')),
+        'add_members_form': AddMembersForm(initial={'user': user, 'conversation': conversation}),
+        'form': form,
+        'chat_messages': chat_messages
+    }
+    if request.headers.get('HX-Request') and not (request.headers.get('HX-History-Restore-Request') or request.headers.get('HX-Full-Page-Request')):
+        return render(request, 'chat/partials/group_chat.html', context)
+    return render(request, 'chat/group_chat.html', context | get_home_context(user))
+
+
+@login_required(redirect_field_name=None)
+@require_POST
+def add_group_members(request, uuid):
+    user = request.user
+    conversation = get_membership(user, uuid).conversation
+
+    form = AddMembersForm(request.POST, initial={'user': user, 'conversation': conversation})
+    if form.is_valid():
+        conversation.add_members(list(form.cleaned_data['members']))
+
+    return redirect('group_chat', conversation.uuid)
+
+
+@login_required(redirect_field_name=None)
+@require_POST
+def leave_group(request, uuid):
+    get_membership(request.user, uuid).conversation.remove_member(request.user)
+    return redirect('groups_list')
+
+
+def is_internal_request(request):
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in settings.METRICS_ALLOWED_NETWORKS)
+
+
+@login_not_required
+@never_cache
+@require_http_methods(['GET'])
+def ws_token(request):
+    '''
+    Returns a fresh WebSocket token, requested when the connection closes so reconnecting doesn't fall back to loading the session
+    from the database once the token embedded in the page has expired
+    '''
+    # The client keeps its token after logging out, since the page is replaced once the logout event is received
+    if not request.user.is_authenticated:
+        return HttpResponse(status=204)
+    return JsonResponse({'token': create_ws_token(request.session, request.user)})
+
+
+@login_not_required
+async def metrics(request):
+    '''Exposes the metrics of this process in the Prometheus text format, only to internal addresses'''
+    if not is_internal_request(request):
+        raise Http404
+    return HttpResponse(expose_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
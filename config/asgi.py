@@ -9,7 +9,6 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
@@ -20,12 +19,13 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 django_asgi_app = get_asgi_application()
 
 from chat.routing import websocket_urlpatterns
+from middleware.ws_token_auth_middleware import WsTokenAuthMiddlewareStack
 
 application = ProtocolTypeRouter(
     {
         'http': django_asgi_app,
         'websocket': AllowedHostsOriginValidator(
-            AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+            WsTokenAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
         ),
     }
 )
\ No newline at end of file
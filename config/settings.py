@@ -48,11 +48,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'middleware.metrics_middleware.metrics_middleware',
+    'middleware.profiling_middleware.profiling_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'middleware.replica_middleware.replica_middleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'middleware.user_middleware.user_middleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
@@ -64,7 +68,7 @@ ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'chat.metrics.InstrumentedDjangoTemplates',
         'DIRS': [
             BASE_DIR / 'templates',
         ],
@@ -75,9 +79,11 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'chat.context_processors.ws_token',
             ],
             'libraries': {
                 'startswith': 'templates.templatetags.startswith',
+                'fragments': 'templates.templatetags.fragments',
             },
         },
     },
@@ -102,6 +108,39 @@ DATABASES = {
     }
 }
 
+# Connections are pooled in each worker process. The connections allowed by Postgres are shared between the workers started by
+# runworkers, which sets ASGI_WORKER_COUNT.
+DB_POOL_ENABLED = os.environ.get('DB_POOL_ENABLED', 'True') == 'True'
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 80))
+DB_POOL_OPTIONS = {
+    'min_size': 2,
+    'max_size': max(2, DB_MAX_CONNECTIONS // int(os.environ.get('ASGI_WORKER_COUNT', 1))),
+    # Seconds to wait for a free connection before the query fails
+    'timeout': 10,
+    # Connections are replaced once they are 30 minutes old, and closed after 5 idle minutes (down to min_size)
+    'max_lifetime': 30 * 60,
+    'max_idle': 5 * 60,
+}
+
+if DB_POOL_ENABLED:
+    from psycopg_pool import ConnectionPool
+
+    # Connections are checked when taken from the pool, so those closed by Postgres or the network are replaced
+    DB_POOL_OPTIONS['check'] = ConnectionPool.check_connection
+    DATABASES['default']['OPTIONS'] = {'pool': DB_POOL_OPTIONS}
+
+# Read replicas of the primary database, e.g. POSTGRES_REPLICA_HOSTS=replica-1,replica-2. Reads made while handling a request or
+# WebSocket message are sent to a replica, except inside transactions and for a while after the session writes.
+DATABASE_REPLICAS = []
+for index, host in enumerate(filter(None, os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(',')), start=1):
+    DATABASES[f'replica_{index}'] = DATABASES['default'] | {'HOST': host, 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica_{index}')
+
+DATABASE_ROUTERS = ['chat.replicas.ReplicaRouter']
+
+# Seconds a session reads from the primary database after writing, which should be longer than the replication lag
+REPLICA_PIN_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -145,6 +184,19 @@ STATICFILES_DIRS = [
     BASE_DIR / 'static',
 ]
 
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    # Static files are collected under hashed names with precompressed variants, which nginx serves with immutable caching
+    'staticfiles': {
+        'BACKEND': 'config.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+
+# Runs the tests with a static files manifest which isn't strict, since they run without collectstatic
+TEST_RUNNER = 'config.test_runner.TestRunner'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -178,7 +230,36 @@ LOGIN_REDIRECT_URL = 'chat_home'
 LOGIN_URL = 'account_login'
 
 
-EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+# Emails are queued, and sent by the task worker with QUEUED_EMAIL_BACKEND, so requests don't wait for the mail server
+EMAIL_BACKEND = 'chat.mail.QueuedEmailBackend'
+QUEUED_EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# Number of tasks each task worker (python manage.py runtasks) runs at a time
+TASK_CONCURRENCY = 4
+
+# Seconds a task worker waits before checking for due tasks again, when there were none
+TASK_POLL_INTERVAL = 1
+
+# Seconds a task is claimed for, after which it is run again in case its worker stopped while running it
+TASK_LEASE_SECONDS = 600
+
+# Seconds between renewals of the lease of a running task, well within the lease so a slow renewal doesn't let it expire
+TASK_LEASE_RENEWAL_INTERVAL = 60
+
+# Number of times a task is attempted before it is marked as failed
+TASK_MAX_ATTEMPTS = 5
+
+# Seconds before a failed task is retried, doubled after each attempt up to the maximum
+TASK_RETRY_DELAY = 10
+TASK_RETRY_MAX_DELAY = 3600
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://redis:6379/1',
+    }
+}
 
 
 ASGI_APPLICATION = 'config.asgi.application'
@@ -186,9 +267,115 @@ ASGI_APPLICATION = 'config.asgi.application'
 CHANNEL_LAYERS = {
     'default': {
         # 'BACKEND': 'channels.layers.InMemoryChannelLayer',
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # 'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.layers.HybridChannelLayer',
         'CONFIG': {
             'hosts': [('redis', 6379)],
         },
     }
-}
\ No newline at end of file
+}
+
+# Inbound WebSocket message type -> (tokens refilled per second, bucket capacity)
+WS_RATE_LIMITS = {
+    'chat_send': (5, 20),
+    'group_send': (5, 20),
+    'page_load': (5, 20),
+}
+
+# Maximum number of messages waiting to be sent to a WebSocket client before the connection is dropped
+WS_OUTBOUND_QUEUE_SIZE = 256
+
+# Number of seconds a WebSocket token embedded in a page can be used to connect for
+WS_TOKEN_MAX_AGE = 60
+
+# Whether clients which support them are sent only the changed fields of sidebar entries they already have, rather than the
+# re-rendered entry
+WS_DELTA_EVENTS = os.environ.get('WS_DELTA_EVENTS', 'False') == 'True'
+
+# Maximum number of sidebar entry ids a client can send with a page load, as the entries the page was rendered with
+WS_MAX_SIDEBAR_ENTRIES = 1000
+
+# Maximum number of rendered template fragments kept in memory by each process
+FRAGMENT_CACHE_SIZE = 10000
+
+# Alias of a cache shared between processes to also store rendered template fragments in, or None to only keep them in memory
+FRAGMENT_CACHE_SHARED_ALIAS = None
+
+# Maximum number of users looked up by uuid which are kept in memory by each process, and the seconds they are kept for
+USER_CACHE_SIZE = 10000
+USER_CACHE_LOCAL_TIMEOUT = 60
+
+# Alias of a cache shared between processes to also store users looked up by uuid in, or None to only keep them in memory
+USER_CACHE_SHARED_ALIAS = 'default'
+USER_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Number of messages loaded at a time when scrolling through a chat's history
+CHAT_HISTORY_PAGE_SIZE = 50
+
+# Number of messages read from the database and encoded at a time when exporting a chat
+CHAT_EXPORT_CHUNK_SIZE = 2000
+
+# Number of rows deleted by each query when deleting a chat, each batch in its own transaction
+CHAT_DELETION_BATCH_SIZE = 1000
+
+# Number of days after which read messages are moved into the compressed archive by the archivemessages command
+MESSAGE_ARCHIVE_AFTER_DAYS = 365
+
+# Number of archived periods read from the database at a time when loading chat history, each holding a month of a chat's messages
+ARCHIVE_FETCH_CHUNK_SIZE = 2
+
+# Size in bytes from which message content is stored compressed
+MESSAGE_COMPRESSION_THRESHOLD = 1024
+
+# Directory where attachments are stored, shared with nginx
+ATTACHMENT_ROOT = BASE_DIR / 'attachments'
+
+# Internal nginx location serving ATTACHMENT_ROOT / 'files', or None to send attachments from Django
+ATTACHMENT_X_ACCEL_REDIRECT = '/protected-attachments/'
+
+# Maximum size in bytes of each chunk of an attachment upload
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+
+# Maximum size in bytes of an attachment
+ATTACHMENT_MAX_SIZE = 100 * 1024 * 1024
+
+# Number of hours after which an attachment upload which was never completed is deleted by the cleanupattachments command
+ATTACHMENT_UPLOAD_EXPIRY_HOURS = 24
+
+# Number of files checked against the database by each query when cleaning up attachments
+ATTACHMENT_CLEANUP_BATCH_SIZE = 1000
+
+MEDIA_URL = 'media/'
+
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Name -> width and height in pixels of each variant profile pictures are resized into
+AVATAR_SIZES = {
+    'small': 80,
+    'medium': 320,
+}
+
+# Maximum size in bytes of an uploaded profile picture
+AVATAR_MAX_UPLOAD_SIZE = 5 * 1024 * 1024
+
+# Number of worker processes in each server process used to resize profile pictures
+AVATAR_PROCESS_POOL_SIZE = 2
+
+# Networks allowed to read the metrics endpoint. The endpoint is also blocked by nginx, so it can only be reached from inside the deployment.
+METRICS_ALLOWED_NETWORKS = ['127.0.0.0/8', '::1/128', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16']
+
+# Profile a sample of requests and WebSocket handlers, saving those slower than the threshold. List them with the slowestprofiles command.
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0.1))
+PROFILING_THRESHOLD_MS = 200
+PROFILING_DIR = BASE_DIR / 'profiles'
+PROFILING_MAX_CAPTURES = 200
+PROFILING_STATS_LINES = 40
+
+# Benchmark mode, where passwords are hashed with a fast insecure hasher so that generated users can log in quickly. Never enable it in production.
+BENCH_MODE = os.environ.get('BENCH_MODE', 'False') == 'True'
+if BENCH_MODE:
+    PASSWORD_HASHERS = [
+        'django.contrib.auth.hashers.MD5PasswordHasher',
+        'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    ]
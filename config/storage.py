@@ -0,0 +1,61 @@
+import gzip
+import brotli
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+# The suffix of each precompressed variant, and how it is compressed. Files are collected once per deployment, so the slowest,
+# smallest settings are used.
+COMPRESSORS = {
+    '.gz': lambda content: gzip.compress(content, compresslevel=9, mtime=0),
+    '.br': lambda content: brotli.compress(content, quality=11),
+}
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg')
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    '''
+    Collects static files under names containing a hash of their content, so they can be cached indefinitely, and writes gzip and
+    brotli compressed variants of the hashed text files alongside them, which nginx serves to clients that accept them.
+    '''
+
+    def __init__(self, *args, manifest_strict=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manifest_strict = manifest_strict
+
+    def stored_name(self, name):
+        # Files missing from the manifest keep their names when it isn't strict, as in the tests, which run without collectstatic.
+        # Otherwise a broken reference raises, rather than being served under an unhashed name.
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            if self.manifest_strict:
+                raise
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and hashed_name.endswith(COMPRESSIBLE_EXTENSIONS):
+                hashed_names.add(hashed_name)
+            yield name, hashed_name, processed
+
+        if dry_run:
+            return
+
+        for hashed_name in hashed_names:
+            self._save_compressed_variants(hashed_name)
+
+    def _save_compressed_variants(self, name):
+        with self.open(name) as file:
+            content = file.read()
+
+        for suffix, compress in COMPRESSORS.items():
+            compressed_name = name + suffix
+            if self.exists(compressed_name):
+                self.delete(compressed_name)
+
+            compressed = compress(content)
+            # nginx falls back to the uncompressed file, so variants which aren't smaller are left out
+            if len(compressed) < len(content):
+                self._save(compressed_name, ContentFile(compressed))
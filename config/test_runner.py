@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    '''Runs the tests with a static files manifest which isn't strict, since collectstatic isn't run before them'''
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        staticfiles = settings.STORAGES['staticfiles'] | {'OPTIONS': {'manifest_strict': False}}
+        self.storages_override = override_settings(STORAGES=settings.STORAGES | {'staticfiles': staticfiles})
+        self.storages_override.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.storages_override.disable()
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,22 @@
+from django.utils.decorators import async_only_middleware
+from chat.metrics import QueryStats, current_query_stats, view_db_queries, view_db_seconds
+
+
+@async_only_middleware
+def metrics_middleware(get_response):
+    async def middleware_async(request):
+        query_stats = QueryStats()
+        token = current_query_stats.set(query_stats)
+        try:
+            response = await get_response(request)
+        finally:
+            current_query_stats.reset(token)
+
+        resolver_match = request.resolver_match
+        view_name = resolver_match.url_name if resolver_match else 'unresolved'
+
+        view_db_queries.observe(query_stats.count, view_name)
+        view_db_seconds.observe(query_stats.duration, view_name)
+        return response
+
+    return middleware_async
\ No newline at end of file
@@ -1,4 +1,3 @@
-from django.urls import resolve
 from django.utils.decorators import async_only_middleware
 
 EXCLUDED_URLS = []
@@ -9,7 +8,12 @@ def no_cache_middleware(get_response):
     async def middleware_async(request):
         response = await get_response(request)
 
-        current_url_name = resolve(request.path_info).url_name
+        # Keep the cache policy of views which have set their own (e.g. conditional responses which can be revalidated)
+        if response.has_header('Cache-Control'):
+            return response
+
+        resolver_match = request.resolver_match
+        current_url_name = resolver_match.url_name if resolver_match else None
         
         if current_url_name not in EXCLUDED_URLS:
             response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0, private'
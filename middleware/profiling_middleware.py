@@ -0,0 +1,45 @@
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import sync_and_async_middleware
+from chat.profiling import Capture
+
+
+def get_capture_name(request, capture):
+    resolver_match = request.resolver_match
+    if resolver_match:
+        return f'{resolver_match.url_name} ({capture.name})'
+    return capture.name
+
+
+@sync_and_async_middleware
+def profiling_middleware(get_response):
+    # Under ASGI, async views run on the event loop thread, where the capture is entered, and the rest of the request runs in the
+    # request's sync thread, which the capture also profiles
+    if not settings.PROFILING_ENABLED:
+        raise MiddlewareNotUsed
+
+    if iscoroutinefunction(get_response):
+        async def middleware_async(request):
+            if not Capture.should_profile():
+                return await get_response(request)
+
+            async with Capture('request', f'{request.method} {request.path}') as capture:
+                response = await get_response(request)
+                capture.name = get_capture_name(request, capture)
+
+            return response
+
+        return middleware_async
+
+    def middleware(request):
+        if not Capture.should_profile():
+            return get_response(request)
+
+        with Capture('request', f'{request.method} {request.path}') as capture:
+            response = get_response(request)
+            capture.name = get_capture_name(request, capture)
+
+        return response
+
+    return middleware
\ No newline at end of file
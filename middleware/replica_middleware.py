@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import async_only_middleware
+from chat.replicas import ReplicaRouting, apin_to_primary
+from chat.utils import get_session_group
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+@async_only_middleware
+def replica_middleware(get_response):
+    if not settings.DATABASE_REPLICAS:
+        raise MiddlewareNotUsed
+
+    async def middleware_async(request):
+        session = request.session
+        session_group = get_session_group(session) if session.session_key else None
+
+        # Requests which may write read from the primary database throughout, so they see the rows they are about to change
+        with ReplicaRouting(session_group, use_primary=request.method not in SAFE_METHODS) as routing:
+            response = await get_response(request)
+
+        # The session key is changed when logging in, so the key after the response is pinned
+        if routing.wrote and session.session_key:
+            await apin_to_primary(get_session_group(session))
+        return response
+
+    return middleware_async
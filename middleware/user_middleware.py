@@ -0,0 +1,12 @@
+from django.utils.decorators import async_only_middleware
+
+
+@async_only_middleware
+def user_middleware(get_response):
+    async def middleware_async(request):
+        # Load the user once with the async ORM, and share it between request.user and request.auser(), which would otherwise each
+        # query the database. request.user is read by synchronous middleware, and request.auser() by async views.
+        request.user = await request.auser()
+        return await get_response(request)
+
+    return middleware_async
@@ -0,0 +1,56 @@
+from urllib.parse import parse_qs
+from uuid import UUID
+from channels.auth import AuthMiddleware
+from channels.middleware import BaseMiddleware
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from chat.utils import load_ws_token, get_revoked_ws_token_cache_key
+
+User = get_user_model()
+
+
+class WsTokenAuthMiddleware(BaseMiddleware):
+    '''
+    Authenticates a WebSocket connection using the signed token in its query string, without loading the session or user from the database.
+    Connections without a valid token fall back to the database backed session and user lookup.
+    '''
+
+    def __init__(self, inner):
+        super().__init__(inner)
+        self.fallback = SessionMiddleware(AuthMiddleware(inner))
+
+    @staticmethod
+    def _get_token(scope):
+        query_string = parse_qs(scope.get('query_string', b'').decode())
+        tokens = query_string.get('token')
+        return tokens[0] if tokens else None
+
+    @staticmethod
+    def _get_user(token_data):
+        # Only the fields contained in the token are loaded, any other fields are deferred
+        return User.from_db(
+            DEFAULT_DB_ALIAS,
+            ['id', 'uuid', 'username', 'avatar_hash'],
+            [token_data['user_id'], UUID(token_data['uuid']), token_data['username'], token_data['avatar_hash']]
+        )
+
+    async def __call__(self, scope, receive, send):
+        token = self._get_token(scope)
+        token_data = load_ws_token(token) if token else None
+
+        if token_data is not None:
+            session_group = token_data['session_group']
+            if await cache.aget(get_revoked_ws_token_cache_key(session_group)):
+                token_data = None
+
+        if token_data is None:
+            return await self.fallback(scope, receive, send)
+
+        scope = dict(scope, session_group=session_group, user=self._get_user(token_data))
+        return await super().__call__(scope, receive, send)
+
+
+def WsTokenAuthMiddlewareStack(inner):
+    return CookieMiddleware(WsTokenAuthMiddleware(inner))
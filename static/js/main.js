@@ -10,6 +10,19 @@ function updateWebSocketConnectionStatus(newConnectionStatus) {
     }
 }
 
+// Authenticate the WebSocket connection using the token embedded in the page, so the server doesn't need to load the session from the database
+// Also ask for sidebar entries which have already been sent to be updated with deltas, which the server sends if they are enabled
+htmx.createWebSocket = (url) => {
+    const params = new URLSearchParams({ events: 'delta' });
+    const wsTokenElement = document.getElementById('ws-token');
+    if (wsTokenElement !== null && wsTokenElement.dataset.token) {
+        params.set('token', wsTokenElement.dataset.token);
+    }
+    const socket = new WebSocket(`${url}?${params}`, []);
+    socket.binaryType = htmx.config.wsBinaryType;
+    return socket;
+};
+
 document.body.addEventListener('htmx:wsOpen', (event) => {
     if (wsConnected === false) {
         htmx.ajax('GET', window.location.pathname, {
@@ -21,8 +34,21 @@ document.body.addEventListener('htmx:wsOpen', (event) => {
     updateWebSocketConnectionStatus(true);
 });
 
+// The token embedded in the page expires shortly after it is loaded, so a fresh one is fetched for reconnecting
+async function refreshWsToken() {
+    const wsTokenElement = document.getElementById('ws-token');
+    if (wsTokenElement === null) {
+        return;
+    }
+    const response = await fetch('/ws-token/');
+    if (response.status === 200) {
+        wsTokenElement.dataset.token = (await response.json()).token;
+    }
+}
+
 document.body.addEventListener('htmx:wsClose', (event) => {
     updateWebSocketConnectionStatus(false);
+    refreshWsToken();
 });
 
 function focusChatInput(event) {
@@ -33,7 +59,47 @@ function focusChatInput(event) {
     }
 }
 
+function insertDateTexts() {
+    let previousDate = null;
+
+    const messageElements = document.querySelectorAll('.message');
+    messageElements.forEach(messageElement => {
+        if (messageElement.dataset.date === undefined) {
+            insertLocalTimestamp(messageElement);
+        }
+        const currentDate = messageElement.dataset.date;
+        if (currentDate !== previousDate) {
+            const dateTextHtml = getDateTextHtml(currentDate);
+            const previousElement = messageElement.previousElementSibling;
+            const dateTextAnchor = previousElement !== null && previousElement.id === 'new-messages-text' ? previousElement : messageElement;
+            dateTextAnchor.insertAdjacentHTML('beforebegin', dateTextHtml);
+            previousDate = currentDate;
+        }
+    });
+}
+
+function handleChatKeyDown(event) {
+    const chatFormElement = document.getElementById('chat-form');
+
+    if (event.key === 'Enter' && !event.shiftKey) {
+        event.preventDefault();
+        chatFormElement.dispatchEvent(new Event('submit'));
+    }
+}
+
+function addInputEventListeners() {
+    document.addEventListener('keydown', focusChatInput);
+
+    const chatInputElement = document.getElementById('chat-input');
+    chatInputElement.addEventListener('keydown', handleChatKeyDown);
+}
+
 document.body.addEventListener('htmx:beforeSwap', (event) => {
+    // Loading older messages only adds to the current chat
+    if (event.detail.target.id === 'message-history-loader') {
+        return;
+    }
+
     currentAreFriends = null;
     isNewMessagesText = null;
     document.removeEventListener('keydown', focusChatInput);
@@ -94,6 +160,13 @@ function updateActiveLinkClasses() {
             friendsLink.classList.add('active');
         }
     }
+
+    if (requestPath.startsWith('/groups/')) {
+        const groupsLink = document.getElementById('groups-link');
+        if (groupsLink !== null) {
+            groupsLink.classList.add('active');
+        }
+    }
 }
 
 function handleSidebarToggle() {
@@ -118,18 +191,25 @@ document.body.addEventListener('htmx:afterSettle', (event) => {
 
 const jsonMessageHandlers = {
     'recent_chat_html': (jsonData) => updateRecentChats(jsonData.html),
+    'group_html': (jsonData) => updateRecentChats(jsonData.html, 'groups-list'),
+    'sidebar_entry_delta': (jsonData) => applySidebarEntryDelta(jsonData),
+    'remove_group': (jsonData) => removeGroup(jsonData.conversationUuid),
+    'chat_deletion_progress': (jsonData) => updateChatDeletionProgress(jsonData.otherUserUuid, jsonData.deleted, jsonData.total),
+    'remove_recent_chat': (jsonData) => removeRecentChat(jsonData.otherUserUuid),
+    'clear_messages': (jsonData) => clearMessages(),
     'message_html': (jsonData) => updateMessages(jsonData.html),
     'decrement_unread_count': (jsonData) => decrementUnreadCount(jsonData.otherUserUuid, jsonData.count),
     'update_recent_chat_read_status': (jsonData) => updateRecentChatReadStatus(jsonData.otherUserUuid),
     'update_message_read_status': (jsonData) => updateMessageReadStatus(jsonData.messageUuid),
     'update_all_messages_read_status': (jsonData) => updateAllMessagesReadStatus(jsonData.senderUuid),
-    'update_section_count': (jsonData) => updateSectionCount(jsonData.page, jsonData.section, jsonData.action),
+    'update_section_count': (jsonData) => updateSectionCount(jsonData.page, jsonData.section, jsonData.action, jsonData.count),
     'remove_user_from_section': (jsonData) => removeUserFromSection(jsonData.section, jsonData.otherUserUuid),
     'add_user_html_to_section': (jsonData) => addUserHtmlToSection(jsonData.section, jsonData.html),
     'update_friendship': (jsonData) => updateFriendship(jsonData.areFriends),
     'account_deleted': (jsonData) => handleAccountDeleted(),
     'session_logged_out': (jsonData) => handleSessionLoggedOut(),
-    'update_account': (jsonData) => updateAccount(jsonData.otherUser)
+    'update_account': (jsonData) => updateAccount(jsonData.otherUser),
+    'send_rate_limited': (jsonData) => handleSendRateLimited(jsonData.content)
 };
 
 function handleJsonMessage(jsonData) {
@@ -202,7 +282,12 @@ function setUnreadCount(recentChatElement, newUnreadCount) {
     recentChatElement.querySelector('.unread-count').textContent = newUnreadCount > 0 ? newUnreadCount : '';
 }
 
-function updateRecentChats(newRecentChatHtml) {
+function updateRecentChats(newRecentChatHtml, containerId = 'recent-chats') {
+    const recentChats = document.getElementById(containerId);
+    if (recentChats === null) {
+        return;
+    }
+
     const newRecentChatElement = htmlToElement(newRecentChatHtml);
     insertLocalTimestamp(newRecentChatElement);
 
@@ -217,12 +302,73 @@ function updateRecentChats(newRecentChatHtml) {
         setUnreadCount(newRecentChatElement, unreadCount);
     }
 
-    const recentChats = document.getElementById('recent-chats');
     recentChats.insertAdjacentElement('afterbegin', newRecentChatElement);
     // Process to ensure that HTMX behaviours are applied to the new element (e.g. when a link is clicked within the element, add a HX-Request header to the request)
     htmx.process(recentChats);
 }
 
+function setLastMessage(lastMessageElement, lastMessage) {
+    lastMessageElement.replaceChildren();
+
+    if (lastMessage.read !== null) {
+        const readStatusElement = document.createElement('span');
+        readStatusElement.className = 'read-status';
+        readStatusElement.textContent = lastMessage.read === 'True' ? 'Read' : 'Not Read';
+        lastMessageElement.append(readStatusElement, ' ');
+    }
+
+    const usernameElement = document.createElement('span');
+    usernameElement.className = 'username';
+    usernameElement.textContent = lastMessage.senderUsername;
+    lastMessageElement.append(usernameElement, `: ${lastMessage.text}`);
+}
+
+// Sent with each page load, so the server sends deltas for the entries the page was rendered with
+function getSidebarEntryIds() {
+    return Array.from(document.querySelectorAll('#recent-chats > .recent-chat, #groups-list > .recent-chat'), (entryElement) => entryElement.id);
+}
+
+function applySidebarEntryDelta(delta) {
+    // The server only sends a delta for an entry the page was rendered with or it has sent since
+    const entryElement = document.getElementById(delta.id);
+    if (entryElement === null) {
+        return;
+    }
+
+    entryElement.dataset.utcTimestamp = delta.timestamp;
+    insertLocalTimestamp(entryElement);
+
+    const unreadCount = delta.unreadCount === 'increment' ? parseInt(entryElement.dataset.unreadCount) + 1 : delta.unreadCount;
+    setUnreadCount(entryElement, unreadCount);
+    setLastMessage(entryElement.querySelector('.last-message'), delta.lastMessage);
+
+    // Entries are ordered by their most recent message
+    entryElement.parentElement.insertAdjacentElement('afterbegin', entryElement);
+}
+
+function updateChatDeletionProgress(otherUserUuid, deleted, total) {
+    const recentChatElement = document.getElementById(`chat-${otherUserUuid}`);
+    if (recentChatElement === null) {
+        return;
+    }
+
+    recentChatElement.querySelector('.last-message').textContent = `Deleting chat... ${deleted}/${total}`;
+}
+
+function removeRecentChat(otherUserUuid) {
+    const recentChatElement = document.getElementById(`chat-${otherUserUuid}`);
+    if (recentChatElement !== null) {
+        recentChatElement.remove();
+    }
+}
+
+function clearMessages() {
+    const messagesContainer = document.getElementById('messages');
+    if (messagesContainer !== null) {
+        messagesContainer.replaceChildren();
+    }
+}
+
 function updateElementReadStatus(element) {
     const readStatusElement = element.querySelector('.read-status');
     readStatusElement.textContent = 'Read';
@@ -240,11 +386,11 @@ function decrementUnreadCount(otherUserUuid, count) {
     setUnreadCount(recentChatElement, newUnreadCount);
 }
 
-function updateSectionCount(page, section, action) {
+function updateSectionCount(page, section, action, count = 1) {
     const suffix = page === 'home' ? '-home' : '';
     const sectionElement = document.getElementById(`${section}-count${suffix}`);
     let oldCount = sectionElement.textContent === '' ? 0 : parseInt(sectionElement.textContent);
-    let newCount = action === 'increment' ? oldCount + 1 : Math.max(0, oldCount - 1);
+    let newCount = action === 'increment' ? oldCount + count : Math.max(0, oldCount - count);
     if (page === 'home' && newCount === 0) {
         // Set newCount to blank so that the incoming count displayed on the home page can be hidden using CSS
         newCount = '';
@@ -258,8 +404,10 @@ document.body.addEventListener('htmx:wsConfigSend', (event) => {
         return;
     }
     // Cancel event and don't send message if the users don't have a mutual friendship, or if the message is blank
+    // Messages can always be sent to groups, since only members can load a group
     const content = event.detail.parameters.content;
-    if (!currentAreFriends || !content.trim()) {
+    const canSend = event.detail.parameters.type === 'group_send' || currentAreFriends;
+    if (!canSend || !content.trim()) {
         event.preventDefault();
     }
 });
@@ -271,8 +419,26 @@ document.body.addEventListener('htmx:wsAfterSend', (event) => {
     }
     const chatInputElement = document.getElementById('chat-input');
     chatInputElement.value = '';
+    setChatError('');
 });
 
+function setChatError(error) {
+    const chatErrorElement = document.getElementById('chat-error');
+    if (chatErrorElement !== null) {
+        chatErrorElement.textContent = error;
+    }
+}
+
+function handleSendRateLimited(content) {
+    setChatError('You are sending messages too quickly, wait a moment and try again');
+
+    // Put the message which wasn't sent back in the input, unless something else has been typed since
+    const chatInputElement = document.getElementById('chat-input');
+    if (chatInputElement !== null && typeof content === 'string' && !chatInputElement.value) {
+        chatInputElement.value = content;
+    }
+}
+
 function isNewUnreadMessage(messageElement, userUuid) {
     return messageElement.dataset.recipientUuid === userUuid && messageElement.dataset.read === 'False';
 }
@@ -303,6 +469,117 @@ function updateMessages(newMessageHtml) {
     }
 }
 
+function getCsrfToken() {
+    return document.querySelector('#chat-form [name=csrfmiddlewaretoken]').value;
+}
+
+function setAttachmentStatus(status) {
+    document.getElementById('attachment-status').textContent = status;
+}
+
+function getAttachmentUploadKey(file, createUrl) {
+    return `attachment-upload:${createUrl}:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+function getUploadOffset(response) {
+    return parseInt(response.headers.get('Upload-Offset'));
+}
+
+async function getAttachmentUpload(file, createUrl) {
+    // Resume an earlier upload of the same file if there is one, e.g. if the page was reloaded during the upload
+    const uploadKey = getAttachmentUploadKey(file, createUrl);
+    const savedUploadUrl = localStorage.getItem(uploadKey);
+    if (savedUploadUrl !== null) {
+        const response = await fetch(savedUploadUrl, { method: 'HEAD' });
+        if (response.ok && getUploadOffset(response) < file.size) {
+            return {
+                url: savedUploadUrl,
+                offset: getUploadOffset(response),
+                chunkSize: parseInt(response.headers.get('Upload-Chunk-Size'))
+            };
+        }
+        localStorage.removeItem(uploadKey);
+    }
+
+    const formData = new FormData();
+    formData.append('filename', file.name);
+    formData.append('content_type', file.type);
+    formData.append('size', file.size);
+
+    const response = await fetch(createUrl, {
+        method: 'POST',
+        headers: { 'X-CSRFToken': getCsrfToken() },
+        body: formData
+    });
+    const jsonData = await response.json();
+    if (!response.ok) {
+        throw new Error(Object.values(jsonData.errors).flat()[0]);
+    }
+
+    localStorage.setItem(uploadKey, jsonData.url);
+    return { url: jsonData.url, offset: jsonData.offset, chunkSize: jsonData.chunk_size };
+}
+
+async function putAttachmentChunk(upload, chunk, offset) {
+    try {
+        return await fetch(upload.url, {
+            method: 'PUT',
+            headers: {
+                'X-CSRFToken': getCsrfToken(),
+                'Upload-Offset': offset,
+                'Content-Type': 'application/offset+octet-stream'
+            },
+            body: chunk
+        });
+    } catch (error) {
+        return null;
+    }
+}
+
+async function uploadAttachment(file, createUrl) {
+    const maxRetries = 5;
+    const upload = await getAttachmentUpload(file, createUrl);
+    let offset = upload.offset;
+    let retries = 0;
+
+    while (offset < file.size) {
+        setAttachmentStatus(`Uploading ${Math.floor(offset / file.size * 100)}%`);
+        const chunk = file.slice(offset, offset + upload.chunkSize);
+        const response = await putAttachmentChunk(upload, chunk, offset);
+
+        // A 409 response means the server has a different offset, so continue from there
+        if (response !== null && (response.ok || response.status === 409)) {
+            offset = getUploadOffset(response);
+            retries = 0;
+        } else if (response !== null && response.status < 500) {
+            throw new Error('The file could not be sent');
+        } else if (retries < maxRetries) {
+            retries++;
+            await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+        } else {
+            throw new Error('The upload was interrupted, select the file again to resume it');
+        }
+    }
+
+    localStorage.removeItem(getAttachmentUploadKey(file, createUrl));
+}
+
+document.body.addEventListener('change', async (event) => {
+    const attachmentInputElement = event.target;
+    if (attachmentInputElement.id !== 'attachment-input' || attachmentInputElement.files.length === 0) {
+        return;
+    }
+
+    const file = attachmentInputElement.files[0];
+    attachmentInputElement.value = '';
+    try {
+        await uploadAttachment(file, attachmentInputElement.dataset.uploadUrl);
+        setAttachmentStatus('');
+    } catch (error) {
+        setAttachmentStatus(error.message);
+    }
+});
+
 function updateMessageElementReadStatus(messageElement) {
     messageElement.dataset.read = 'True';
     updateElementReadStatus(messageElement);
@@ -381,9 +658,26 @@ function handleSessionLoggedOut() {
     window.location.reload();
 }
 
+function removeGroup(conversationUuid) {
+    const groupElement = document.getElementById(`group-${conversationUuid}`);
+    if (groupElement !== null) {
+        groupElement.remove();
+    }
+}
+
+function updateAvatars(otherUser) {
+    const avatarElements = document.querySelectorAll(`.avatar[data-user-uuid='${otherUser.uuid}']`);
+    avatarElements.forEach(avatarElement => {
+        avatarElement.src = otherUser.avatar ? otherUser.avatar.small : avatarElement.dataset.defaultSrc;
+    });
+}
+
 function updateAccount(otherUser) {
     const otherUserRecentChat = document.getElementById(`chat-${otherUser.uuid}`);
-    otherUserRecentChat.querySelector('.chat-heading-username').textContent = otherUser.username;
+    if (otherUserRecentChat !== null) {
+        otherUserRecentChat.querySelector('.chat-heading-username').textContent = otherUser.username;
+    }
+    updateAvatars(otherUser);
 }
 
 // Prevent a POST resubmit on refresh or back button
@@ -0,0 +1,25 @@
+from django import template
+from django.utils.safestring import mark_safe
+from chat.fragments import render_recent_chat, render_friend, render_incoming_request, render_outgoing_request
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def recent_chat(context, chat):
+    return mark_safe(render_recent_chat(context['user'], chat['other_user'], chat['last_message'], chat['unread_count'], context['request'].path))
+
+
+@register.simple_tag(takes_context=True)
+def friend(context, friend):
+    return mark_safe(render_friend(friend, context['csrf_token']))
+
+
+@register.simple_tag(takes_context=True)
+def incoming_request(context, sender):
+    return mark_safe(render_incoming_request(sender, context['csrf_token']))
+
+
+@register.simple_tag(takes_context=True)
+def outgoing_request(context, recipient):
+    return mark_safe(render_outgoing_request(recipient, context['csrf_token']))
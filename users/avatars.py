@@ -0,0 +1,99 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from uuid import uuid4
+from django.conf import settings
+from django.db import close_old_connections
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_avatar_dir():
+    return os.path.join(settings.MEDIA_ROOT, 'avatars')
+
+
+def get_avatar_filename(avatar_hash, size):
+    return f'{avatar_hash}_{size}.webp'
+
+
+def get_avatar_urls(avatar_hash):
+    '''Returns the URL of each variant of a profile picture. The URLs never change content, so they can be cached indefinitely.'''
+    return {
+        name: f'{settings.MEDIA_URL}avatars/{get_avatar_filename(avatar_hash, size)}'
+        for name, size in settings.AVATAR_SIZES.items()
+    }
+
+
+def create_avatar_variants(upload_path, avatar_dir, sizes):
+    '''
+    Resizes an uploaded picture into a square WebP image for each size, named by the hash of the upload, and returns the hash.
+    Runs in a worker process, so it must not use the database.
+    '''
+    with open(upload_path, 'rb') as upload_file:
+        data = upload_file.read()
+    avatar_hash = hashlib.sha256(data).hexdigest()[:32]
+
+    with Image.open(BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image).convert('RGBA')
+
+        for size in sizes:
+            avatar_path = os.path.join(avatar_dir, get_avatar_filename(avatar_hash, size))
+            if os.path.exists(avatar_path):
+                continue
+
+            variant = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+            temp_path = f'{avatar_path}.{uuid4().hex}.tmp'
+            variant.save(temp_path, 'WEBP', quality=85)
+            os.replace(temp_path, avatar_path)
+
+    return avatar_hash
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Worker processes are spawned rather than forked, since forking a process running an event loop and threads is unsafe
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.AVATAR_PROCESS_POOL_SIZE,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+
+def _handle_avatar_created(user_id, upload_path, future):
+    from .models import User
+
+    try:
+        avatar_hash = future.result()
+        user = User.objects.get(id=user_id, is_active=True)
+        user.update_avatar(avatar_hash)
+    except Exception:
+        logger.exception('Failed to update the profile picture of user %s', user_id)
+    finally:
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+        close_old_connections()
+
+
+def process_avatar_upload(user, uploaded_file):
+    '''Saves an uploaded picture, and resizes it in a worker process. The user's profile picture is updated once resizing finishes.'''
+    avatar_dir = get_avatar_dir()
+    upload_dir = os.path.join(avatar_dir, 'uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+
+    upload_path = os.path.join(upload_dir, uuid4().hex)
+    with open(upload_path, 'wb') as upload_file:
+        for chunk in uploaded_file.chunks():
+            upload_file.write(chunk)
+
+    future = get_executor().submit(create_avatar_variants, upload_path, avatar_dir, list(settings.AVATAR_SIZES.values()))
+    future.add_done_callback(lambda future: _handle_avatar_created(user.id, upload_path, future))
@@ -1,5 +1,6 @@
 import re
 from django import forms
+from django.conf import settings
 from django.contrib.auth import authenticate
 from allauth.account.forms import SignupForm
 from .models import User
@@ -17,15 +18,28 @@ class UserSignupForm(SignupForm):
         
         return username
 
+class ProfilePictureForm(forms.Form):
+    picture = forms.ImageField()
+
+    def clean_picture(self):
+        picture = self.cleaned_data['picture']
+
+        if picture.size > settings.AVATAR_MAX_UPLOAD_SIZE:
+            raise forms.ValidationError('This picture is too large')
+
+        return picture
+
+
 class AddFriendForm(forms.Form):
+    '''Validated with ais_valid(), since checking the entered user is done with the async ORM'''
     username = forms.CharField()
 
-    def clean_username(self):
+    async def _aclean_username(self):
         entered_username = self.cleaned_data['username']
         self.user = self.initial.get('user')
 
         try:
-            self.friend = User.objects.get(username__iexact=entered_username) # __iexact => case insensitive match
+            self.friend = await User.objects.aget(username__iexact=entered_username) # __iexact => case insensitive match
         except User.DoesNotExist:
             raise forms.ValidationError(f'User with the username \'{entered_username}\' does not exist')
         
@@ -34,17 +48,34 @@ class AddFriendForm(forms.Form):
 
         if self.user == self.friend:
             raise forms.ValidationError('You cannot add yourself as a friend')
+
+        blocker_ids = await self.user.aget_blocker_ids(self.friend)
+        if self.user.id in blocker_ids:
+            raise forms.ValidationError('You have blocked this user')
+
+        if blocker_ids:
+            raise forms.ValidationError('You cannot add this user')
         
-        if self.user.has_friend_mutual(self.friend):
+        if await self.user.ahas_friend_mutual(self.friend):
             raise forms.ValidationError('You are already friends with this user')
         
-        if self.user.has_outgoing_request_to(self.friend):
+        if await self.user.ahas_outgoing_request_to(self.friend):
             raise forms.ValidationError('You have already sent a friend request to this user')
 
-        return self.friend.username
+        self.cleaned_data['username'] = self.friend.username
+
+    async def ais_valid(self):
+        if not self.is_valid():
+            return False
+
+        try:
+            await self._aclean_username()
+        except forms.ValidationError as error:
+            self.add_error('username', error)
+        return not self.errors
     
-    def save(self):
-        self.user.add_friend(self.friend)
+    async def asave(self):
+        await self.user.aadd_friend(self.friend)
 
 
 class DeleteAccountForm(forms.Form):
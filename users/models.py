@@ -4,8 +4,9 @@ from django.contrib.auth.models import AbstractUser
 from django.utils.functional import cached_property
 from uuid import uuid4
 from allauth.account.models import EmailAddress
-from chat.models import Message
-from chat.utils import send_user_ws_message, send_both_users_ws_message
+from chat.models import Message, ArchivedMessages, Conversation, GroupMessage
+from chat.utils import send_user_ws_message, send_both_users_ws_message, send_both_users_ws_message_async
+from .avatars import get_avatar_urls
 
 
 class User(AbstractUser):
@@ -14,6 +15,8 @@ class User(AbstractUser):
     uuid = models.UUIDField(default=uuid4, editable=False, unique=True)
     username = models.CharField(max_length=150, unique=True)
     friends = models.ManyToManyField('self', blank=True, symmetrical=False)
+    blocked_users = models.ManyToManyField('self', blank=True, symmetrical=False, related_name='blocked_by')
+    avatar_hash = models.CharField(max_length=32, blank=True)
 
     
     class Meta:
@@ -22,10 +25,16 @@ class User(AbstractUser):
             models.Index(fields=['uuid'], name='uuid_idx')
         ]
 
+    def serialize_avatar(self):
+        if not self.avatar_hash:
+            return None
+        return {'version': self.avatar_hash} | get_avatar_urls(self.avatar_hash)
+
     def serialize(self):
         return {
             'uuid': str(self.uuid),
-            'username': self.username
+            'username': self.username,
+            'avatar': self.serialize_avatar()
         }
 
     # NOTE: Using @cached_property here provides limited benefit since the method returns a queryset object, rather than
@@ -54,6 +63,15 @@ class User(AbstractUser):
     def has_outgoing_request_to(self, user):
         '''Check if this user has sent a friend request to the specified user'''
         return self.get_outgoing_requests().contains(user)
+
+    async def ahas_friend_mutual(self, user):
+        return await self.friends_mutual.acontains(user)
+
+    async def ahas_incoming_request_from(self, user):
+        return await self.get_incoming_requests().acontains(user)
+
+    async def ahas_outgoing_request_to(self, user):
+        return await self.get_outgoing_requests().acontains(user)
     
     @staticmethod
     def _get_serialized_request(sender, recipient):
@@ -87,6 +105,16 @@ class User(AbstractUser):
         
         send_both_users_ws_message(self, friend, event=event)
 
+    async def aadd_friend(self, friend):
+        await self.friends.aadd(friend)
+
+        if await self.ahas_friend_mutual(friend):
+            event = self._get_friend_request_accepted_event(sender=friend, recipient=self)
+        else:
+            event = self._get_friend_request_sent_event(sender=self, recipient=friend)
+
+        await send_both_users_ws_message_async(self, friend, event=event)
+
     @staticmethod
     def _get_friend_removed_event():
         return {
@@ -105,6 +133,18 @@ class User(AbstractUser):
         send_both_users_ws_message(self, friend, event=event)
 
         return True, 'Friend successfully removed'
+
+    async def aremove_friend(self, friend):
+        if not await self.ahas_friend_mutual(friend):
+            return False, 'No such user in friends list'
+
+        await self.friends.aremove(friend)
+        await friend.friends.aremove(self)
+
+        event = self._get_friend_removed_event()
+        await send_both_users_ws_message_async(self, friend, event=event)
+
+        return True, 'Friend successfully removed'
     
     @classmethod
     def _get_friend_request_rejected_event(cls, sender, recipient):
@@ -119,6 +159,9 @@ class User(AbstractUser):
             return False, 'No such incoming friend request'
 
         if action == 'accept':
+            if self.get_blocker_ids(request_sender):
+                return False, 'You cannot accept a friend request from this user'
+
             self.friends.add(request_sender)
             message = 'Incoming friend request successfully accepted'
 
@@ -134,6 +177,30 @@ class User(AbstractUser):
         send_both_users_ws_message(self, request_sender, event=event)
         
         return True, message
+
+    async def ahandle_incoming_request(self, request_sender, action):
+        if not await self.ahas_incoming_request_from(request_sender):
+            return False, 'No such incoming friend request'
+
+        if action == 'accept':
+            if await self.aget_blocker_ids(request_sender):
+                return False, 'You cannot accept a friend request from this user'
+
+            await self.friends.aadd(request_sender)
+            message = 'Incoming friend request successfully accepted'
+
+            event = self._get_friend_request_accepted_event(sender=request_sender, recipient=self)
+        elif action == 'reject':
+            await request_sender.friends.aremove(self)
+            message = 'Incoming friend request successfully rejected'
+
+            event = self._get_friend_request_rejected_event(sender=request_sender, recipient=self)
+        else:
+            return False, 'Invalid action'
+
+        await send_both_users_ws_message_async(self, request_sender, event=event)
+
+        return True, message
     
     @classmethod
     def _get_friend_request_cancelled_event(cls, sender, recipient):
@@ -154,6 +221,94 @@ class User(AbstractUser):
 
         return True, 'Outgoing friend request successfully cancelled'
 
+    async def acancel_outgoing_request(self, request_recipient):
+        if not await self.ahas_outgoing_request_to(request_recipient):
+            return False, 'No such outgoing friend request'
+
+        await self.friends.aremove(request_recipient)
+
+        event = self._get_friend_request_cancelled_event(sender=self, recipient=request_recipient)
+        await send_both_users_ws_message_async(self, request_recipient, event=event)
+
+        return True, 'Outgoing friend request successfully cancelled'
+
+    def _get_blocks_with(self, user):
+        Block = User.blocked_users.through
+        return Block.objects.filter(
+            models.Q(from_user=self, to_user=user) |
+            models.Q(from_user=user, to_user=self)
+        ).values_list('from_user_id', flat=True)
+
+    def get_blocker_ids(self, user):
+        '''Returns the ids of whichever of this user and the specified user have blocked the other'''
+        return set(self._get_blocks_with(user))
+
+    async def aget_blocker_ids(self, user):
+        return {user_id async for user_id in self._get_blocks_with(user)}
+
+    def _get_blocked_users(self):
+        return User.objects.filter(
+            models.Q(blocked_by=self) |
+            models.Q(blocked_users=self)
+        )
+
+    def _get_blocked_uuids(self):
+        return self._get_blocked_users().values_list('uuid', flat=True)
+
+    def get_blocked_ids(self):
+        '''Returns the ids of the users who have been blocked by this user, or have blocked this user'''
+        return set(self._get_blocked_users().values_list('id', flat=True))
+
+    def get_blocked_uuids(self):
+        '''Returns the uuids of the users who have been blocked by this user, or have blocked this user'''
+        return {str(uuid) for uuid in self._get_blocked_uuids()}
+
+    async def aget_blocked_uuids(self):
+        return {str(uuid) async for uuid in self._get_blocked_uuids()}
+
+    @staticmethod
+    def _get_block_updated_event(blocked):
+        return {
+            'type': 'block_updated',
+            'blocked': blocked
+        }
+
+    def block_user(self, user):
+        '''
+        Returns a tuple containing a boolean success flag (True if the user is blocked successfully, False otherwise), and a message.
+        Any friendship or friend request between the users is also removed.
+        '''
+        if user == self:
+            return False, 'You cannot block yourself'
+
+        if self.blocked_users.contains(user):
+            return False, 'You have already blocked this user'
+
+        self.blocked_users.add(user)
+
+        # At most one of these applies, and the others do nothing
+        self.remove_friend(user)
+        self.cancel_outgoing_request(user)
+        self.handle_incoming_request(user, 'reject')
+
+        event = self._get_block_updated_event(blocked=True)
+        send_both_users_ws_message(self, user, event=event)
+
+        return True, 'User successfully blocked'
+
+    def unblock_user(self, user):
+        '''Returns a tuple containing a boolean success flag (True if the user is unblocked successfully, False otherwise), and a message'''
+        if not self.blocked_users.contains(user):
+            return False, 'You have not blocked this user'
+
+        self.blocked_users.remove(user)
+
+        # The other user may have also blocked this user
+        event = self._get_block_updated_event(blocked=bool(self.get_blocker_ids(user)))
+        send_both_users_ws_message(self, user, event=event)
+
+        return True, 'User successfully unblocked'
+
     @staticmethod
     def _get_account_deleted_event():
         return {
@@ -188,11 +343,40 @@ class User(AbstractUser):
             'other_user': other_user.serialize()
         }
 
+    def update_avatar(self, avatar_hash):
+        '''Set this user's profile picture, and queue a task notifying everyone who can see it'''
+        from .tasks import send_update_account_events
+
+        self.avatar_hash = avatar_hash
+        self.save(update_fields=['avatar_hash'])
+        send_update_account_events.enqueue(self.id)
+
+    def send_update_account_events(self):
+        '''Notifies this user's connections, friends and the users they have chatted with that their account has changed'''
+        # The user's own connections are also notified, so they use the new version in the messages they send
+        other_users = {self.id: self} | {friend.id: friend for friend in self.friends_mutual}
+        for chat in Message.get_recent_chats(self):
+            other_users[chat['other_user'].id] = chat['other_user']
+
+        # Blocked users aren't sent the event at all, rather than it being dropped by their connections
+        for blocked_id in self.get_blocked_ids():
+            other_users.pop(blocked_id, None)
+
+        update_account_event = self._get_update_account_event(self)
+        for other_user in other_users.values():
+            send_user_ws_message(other_user, event=update_account_event)
+
     def delete_account(self):
-        '''Delete a user's account data, but keep the old user id in the database'''
+        '''
+        Delete a user's account data, but keep the old user id in the database.
+        Removing the user's friendships and group memberships, and notifying other users, is done by a queued task.
+        '''
+        from .tasks import clean_up_deleted_account
+
         self.is_active = False
         self.username = f'{self.DELETED_USER_PREFIX}{self.uuid}'
         self.email = ''
+        self.avatar_hash = ''
         EmailAddress.objects.filter(user=self).delete()
         self.set_unusable_password()
         self.save()
@@ -200,15 +384,22 @@ class User(AbstractUser):
         account_deleted_event = self._get_account_deleted_event()
         send_user_ws_message(self, event=account_deleted_event)
 
+        clean_up_deleted_account.enqueue(self.id)
+
+    def clean_up_deleted_account(self):
+        '''Removes a deleted user's friendships, friend requests and group memberships, and notifies the users they have chatted with'''
         self._clear_friends_and_requests()
+        Conversation.leave_all(self)
 
         self.remove_redundant_users()
 
         old_recent_chats = Message.get_recent_chats(self)
+        blocked_ids = self.get_blocked_ids()
         update_account_event = self._get_update_account_event(self)
         for chat in old_recent_chats:
             other_user = chat['other_user']
-            send_user_ws_message(other_user, event=update_account_event)
+            if other_user.id not in blocked_ids:
+                send_user_ws_message(other_user, event=update_account_event)
 
     @classmethod
     def remove_redundant_users(cls):
@@ -219,7 +410,10 @@ class User(AbstractUser):
             if not Message.objects.filter(
                 models.Q(sender=user) |
                 models.Q(recipient=user)
-            ).exists():
+            ).exists() and not ArchivedMessages.objects.filter(
+                models.Q(user_1=user) |
+                models.Q(user_2=user)
+            ).exists() and not GroupMessage.objects.filter(sender=user).exists():
                 user.delete()
 
     @classmethod
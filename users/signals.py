@@ -1,6 +1,11 @@
 from allauth.account.signals import user_logged_out
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from chat.utils import send_session_ws_message
+from chat.utils import send_session_ws_message, get_session_group, get_revoked_ws_token_cache_key
+from .models import User
+from .user_cache import CACHED_FIELDS, user_cache
 
 
 def _get_session_logged_out_event():
@@ -12,5 +17,21 @@ def _get_session_logged_out_event():
 @receiver(user_logged_out)
 def user_logged_in_handler(sender, request, user, **kwargs):
     session = request.session
+
+    # Prevent any WebSocket tokens issued for the session being used to connect again
+    revoked_ws_token_cache_key = get_revoked_ws_token_cache_key(get_session_group(session))
+    cache.set(revoked_ws_token_cache_key, True, timeout=settings.WS_TOKEN_MAX_AGE)
+
     account_logged_out_event = _get_session_logged_out_event()
-    send_session_ws_message(session, event=account_logged_out_event)
\ No newline at end of file
+    send_session_ws_message(session, event=account_logged_out_event)
+
+@receiver(post_save, sender=User)
+def user_saved_handler(sender, instance, update_fields=None, **kwargs):
+    # Saves which only change other fields, such as last_login when logging in, leave the cached user unchanged
+    if update_fields is None or not update_fields.isdisjoint(CACHED_FIELDS):
+        user_cache.delete(instance.uuid)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted_handler(sender, instance, **kwargs):
+    user_cache.delete(instance.uuid)
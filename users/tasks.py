@@ -0,0 +1,17 @@
+from chat.task_queue import task
+from .models import User
+
+
+@task
+def clean_up_deleted_account(user_id):
+    user = User.objects.filter(id=user_id, is_active=False).first()
+    # The user may have been removed by an earlier attempt
+    if user is not None:
+        user.clean_up_deleted_account()
+
+
+@task
+def send_update_account_events(user_id):
+    user = User.objects.filter(id=user_id).first()
+    if user is not None:
+        user.send_update_account_events()
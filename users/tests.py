@@ -1,3 +1,208 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+from uuid import uuid4
+from asgiref.sync import async_to_sync
+from PIL import Image
 from django.test import TestCase
+from chat.tests import QueryBudgetTestCase
+from chat.models import Message, Task
+from chat.task_queue import run_due_tasks
+from .avatars import create_avatar_variants, get_avatar_filename
+from .forms import AddFriendForm
+from .models import User
+from .user_cache import aget_user_by_uuid, get_user_by_uuid, user_cache
 
-# Create your tests here.
+
+class ViewQueryBudgetTests(QueryBudgetTestCase):
+    def get(self, url, htmx=False):
+        headers = {'HX-Request': 'true'} if htmx else {}
+        response = self.client.get(url, headers=headers)
+        self.assertIn(response.status_code, (200, 302))
+        return response
+
+    def create_friends(self, count):
+        friends = [self.create_user(f'friend_{i}') for i in range(count)]
+        for friend in friends:
+            self.make_friends(self.alice, friend)
+        return friends
+
+    def test_manage_friends(self):
+        self.assertQueryBudget(lambda: self.get('/friends/'), max_queries=4, max_rows=2)
+
+    def test_friends_list(self):
+        self.assertQueryBudget(lambda: self.get('/friends/all/'), max_queries=6, max_rows=20)
+
+    def test_friends_list_partial(self):
+        self.assertQueryBudget(lambda: self.get('/friends/all/', htmx=True), max_queries=3, max_rows=10)
+
+    def test_friends_list_partial_not_modified(self):
+        response = self.get('/friends/all/', htmx=True)
+        response = self.client.get('/friends/all/', headers={'HX-Request': 'true', 'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # Full pages aren't cached, since the WebSocket token they contain expires
+        self.assertFalse(self.get('/friends/all/').has_header('ETag'))
+
+    def test_cached_partials_read_from_primary(self):
+        with mock.patch('chat.versions.use_primary') as use_primary:
+            self.get('/friends/all/', htmx=True)
+        use_primary.assert_called_once()
+
+    def test_remove_friend(self):
+        friends = self.create_friends(2)
+        self.assertQueryBudget(lambda: self.client.post('/friends/all/', {'uuid': friends.pop().uuid}), max_queries=8, max_rows=3)
+
+    def test_incoming_requests(self):
+        self.assertQueryBudget(lambda: self.get('/friends/incoming/', htmx=True), max_queries=3, max_rows=10)
+
+    def test_accept_incoming_request(self):
+        request_senders = [self.dave, self.create_user('grace')]
+        request_senders[1].friends.add(self.alice)
+        self.assertQueryBudget(
+            lambda: self.client.post('/friends/incoming/', {'uuid': request_senders.pop().uuid, 'action': 'accept'}), max_queries=7, max_rows=3
+        )
+
+    def test_outgoing_requests(self):
+        self.assertQueryBudget(lambda: self.get('/friends/outgoing/', htmx=True), max_queries=3, max_rows=10)
+
+    def test_cancel_outgoing_request(self):
+        request_recipients = [self.erin, self.create_user('grace')]
+        self.alice.friends.add(request_recipients[1])
+        self.assertQueryBudget(lambda: self.client.post('/friends/outgoing/', {'uuid': request_recipients.pop().uuid}), max_queries=6, max_rows=3)
+
+    def test_add_friend(self):
+        self.assertQueryBudget(lambda: self.get('/friends/add/'), max_queries=6, max_rows=20)
+
+    def test_send_friend_request(self):
+        usernames = [self.create_user(username).username for username in ('grace', 'heidi')]
+        self.assertQueryBudget(lambda: self.client.post('/friends/add/', {'username': usernames.pop()}), max_queries=9, max_rows=3)
+
+    def test_profile_picture(self):
+        self.assertQueryBudget(lambda: self.get('/settings/picture/'), max_queries=2, max_rows=2)
+
+    def test_delete_account(self):
+        self.assertQueryBudget(lambda: self.get('/settings/delete/'), max_queries=2, max_rows=2)
+
+
+class UserCacheTests(TestCase):
+    def setUp(self):
+        user_cache.clear()
+        self.user = User.objects.create(username='alice', email='alice@example.com', password='!')
+
+    def test_lookup_is_cached(self):
+        with self.assertNumQueries(1):
+            user = get_user_by_uuid(self.user.uuid)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_by_uuid(str(self.user.uuid)), user)
+        self.assertEqual((user.id, user.username, user.is_active), (self.user.id, 'alice', True))
+
+    def test_async_lookup_uses_shared_tier(self):
+        user = async_to_sync(aget_user_by_uuid)(self.user.uuid)
+        user_cache.evict(self.user.uuid)
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(aget_user_by_uuid)(self.user.uuid).username, user.username)
+
+    def test_unknown_uuids(self):
+        self.assertIsNone(get_user_by_uuid(uuid4()))
+        self.assertIsNone(get_user_by_uuid('not-a-uuid'))
+
+    def test_username_change_invalidates(self):
+        get_user_by_uuid(self.user.uuid)
+        self.user.username = 'alice_2'
+        self.user.save()
+        self.assertEqual(get_user_by_uuid(self.user.uuid).username, 'alice_2')
+
+    def test_delete_account_invalidates(self):
+        # Users with messages are kept after deleting their account
+        Message.objects.create(sender=self.user, recipient=User.objects.create(username='bob', email='bob@example.com'), content='Hello')
+        get_user_by_uuid(self.user.uuid)
+        self.user.delete_account()
+        self.assertFalse(get_user_by_uuid(self.user.uuid).is_active)
+
+    def test_delete_account_cleans_up_in_task(self):
+        bob = User.objects.create(username='bob', email='bob@example.com')
+        self.user.friends.add(bob)
+        bob.friends.add(self.user)
+        self.user.delete_account()
+        self.assertTrue(Task.objects.filter(name='users.tasks.clean_up_deleted_account').exists())
+
+        run_due_tasks()
+        self.assertFalse(bob.friends.exists())
+        self.assertFalse(User.objects.filter(id=self.user.id).exists())
+
+
+class ProfilePictureTests(TestCase):
+    def setUp(self):
+        self.avatar_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.avatar_dir)
+
+    def create_upload(self, size):
+        upload_path = os.path.join(self.avatar_dir, 'upload')
+        Image.new('RGB', size, 'red').save(upload_path, 'JPEG')
+        return upload_path
+
+    def test_variants_are_square_webp_images(self):
+        avatar_hash = create_avatar_variants(self.create_upload((1200, 800)), self.avatar_dir, [80, 320])
+        for size in (80, 320):
+            with Image.open(os.path.join(self.avatar_dir, get_avatar_filename(avatar_hash, size))) as image:
+                self.assertEqual((image.format, image.size), ('WEBP', (size, size)))
+
+        # The same upload is named by the same hash, so its existing variants are kept
+        avatar_path = os.path.join(self.avatar_dir, get_avatar_filename(avatar_hash, 80))
+        modified = os.stat(avatar_path).st_mtime_ns
+        self.assertEqual(create_avatar_variants(self.create_upload((1200, 800)), self.avatar_dir, [80]), avatar_hash)
+        self.assertEqual(os.stat(avatar_path).st_mtime_ns, modified)
+
+    def test_update_avatar_notifies_friends(self):
+        alice = User.objects.create(username='alice', email='alice@example.com', password='!')
+        bob = User.objects.create(username='bob', email='bob@example.com', password='!')
+        alice.friends.add(bob)
+        bob.friends.add(alice)
+
+        alice.update_avatar('0' * 32)
+        with mock.patch('users.models.send_user_ws_message') as send_user_ws_message:
+            run_due_tasks()
+
+        self.assertCountEqual([call.args[0] for call in send_user_ws_message.call_args_list], [alice, bob])
+        avatar = send_user_ws_message.call_args.kwargs['event']['other_user']['avatar']
+        self.assertEqual(avatar['version'], '0' * 32)
+        self.assertEqual(avatar['small'], f'/media/avatars/{"0" * 32}_80.webp')
+
+
+class BlockTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', email='alice@example.com', password='!')
+        self.bob = User.objects.create(username='bob', email='bob@example.com', password='!')
+        self.alice.friends.add(self.bob)
+        self.bob.friends.add(self.alice)
+
+    def test_block_removes_friendship(self):
+        success, _ = self.bob.block_user(self.alice)
+        self.assertTrue(success)
+        self.assertFalse(self.alice.has_friend_mutual(self.bob))
+        self.assertFalse(self.alice.has_outgoing_request_to(self.bob))
+        self.assertEqual(self.alice.get_blocked_uuids(), {str(self.bob.uuid)})
+        self.assertEqual(self.bob.get_blocked_uuids(), {str(self.alice.uuid)})
+
+        form = AddFriendForm({'username': 'bob'}, initial={'user': self.alice})
+        self.assertFalse(async_to_sync(form.ais_valid)())
+
+    def test_unblock_keeps_other_users_block(self):
+        self.alice.block_user(self.bob)
+        self.bob.block_user(self.alice)
+        self.alice.unblock_user(self.bob)
+        self.assertEqual(self.alice.get_blocker_ids(self.bob), {self.bob.id})
+
+        self.bob.unblock_user(self.alice)
+        self.assertEqual(self.alice.get_blocked_uuids(), set())
+
+    def test_blocked_users_are_not_sent_account_updates(self):
+        # The users have chatted, so bob would be notified of alice's account changes
+        Message.objects.create(sender=self.alice, recipient=self.bob, content='Hello')
+        self.bob.block_user(self.alice)
+
+        with mock.patch('users.models.send_user_ws_message') as send_user_ws_message:
+            self.alice.send_update_account_events()
+        self.assertEqual([call.args[0] for call in send_user_ws_message.call_args_list], [self.alice])
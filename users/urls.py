@@ -20,8 +20,10 @@ urlpatterns = [
     path('friends/incoming/', views.incoming_requests, name='incoming_requests'),
     path('friends/outgoing/', views.outgoing_requests, name='outgoing_requests'),
     path('friends/add/', views.add_friend, name='add_friend'),
+    path('users/<uuid:uuid>/block/', views.block_user, name='block_user'),
     path('settings/', views.settings, name='settings'),
     path('settings/email/', allauth_views.EmailView.as_view(extra_context={'title': 'Change email address'}), name='account_email'),
     path('settings/password/', allauth_views.PasswordChangeView.as_view(extra_context={'title': 'Change password'}), name='account_change_password'),
+    path('settings/picture/', views.profile_picture, name='profile_picture'),
     path('settings/delete/', views.delete_account, name='delete_account')
 ]
\ No newline at end of file
@@ -0,0 +1,173 @@
+import threading
+import time
+from collections import OrderedDict
+from uuid import UUID
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.http import Http404
+
+User = get_user_model()
+
+# The fields needed to find and show another user, any other fields are deferred. They are in the model's field order, which
+# Model.from_db() expects the values to be in.
+CACHED_FIELDS = [field.attname for field in User._meta.concrete_fields if field.attname in {'id', 'uuid', 'username', 'is_active', 'avatar_hash'}]
+
+
+class UserCache:
+    '''
+    Caches the fields of users which are looked up by uuid, in a local memory LRU tier and a shared cache tier.
+    A change to a user removes it from both tiers in the process making the change, but other processes only evict it from their
+    local tier when their connections receive the update_account event, so local entries also expire after a timeout.
+    '''
+
+    def __init__(self, maxsize, local_timeout, shared_cache_alias, shared_timeout):
+        self.maxsize = maxsize
+        self.local_timeout = local_timeout
+        self.shared_cache_alias = shared_cache_alias
+        self.shared_timeout = shared_timeout
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def shared_cache(self):
+        return caches[self.shared_cache_alias] if self.shared_cache_alias else None
+
+    @staticmethod
+    def _get_shared_key(uuid):
+        return f'user_{uuid}'
+
+    def _get_local(self, uuid):
+        with self._lock:
+            entry = self._users.get(uuid)
+            if entry is None:
+                return None
+
+            expires_at, values = entry
+            if expires_at < time.monotonic():
+                del self._users[uuid]
+                return None
+
+            self._users.move_to_end(uuid)
+            return values
+
+    def _set_local(self, uuid, values):
+        with self._lock:
+            self._users[uuid] = (time.monotonic() + self.local_timeout, values)
+            self._users.move_to_end(uuid)
+            if len(self._users) > self.maxsize:
+                self._users.popitem(last=False)
+
+    def get(self, uuid):
+        values = self._get_local(uuid)
+        if values is not None or self.shared_cache is None:
+            return values
+
+        values = self.shared_cache.get(self._get_shared_key(uuid))
+        if values is not None:
+            self._set_local(uuid, values)
+        return values
+
+    async def aget(self, uuid):
+        values = self._get_local(uuid)
+        if values is not None or self.shared_cache is None:
+            return values
+
+        values = await self.shared_cache.aget(self._get_shared_key(uuid))
+        if values is not None:
+            self._set_local(uuid, values)
+        return values
+
+    def set(self, uuid, values):
+        self._set_local(uuid, values)
+
+        if self.shared_cache is not None:
+            self.shared_cache.set(self._get_shared_key(uuid), values, self.shared_timeout)
+
+    async def aset(self, uuid, values):
+        self._set_local(uuid, values)
+
+        if self.shared_cache is not None:
+            await self.shared_cache.aset(self._get_shared_key(uuid), values, self.shared_timeout)
+
+    def evict(self, uuid):
+        '''Removes a user from the local tier'''
+        with self._lock:
+            self._users.pop(str(uuid), None)
+
+    def clear(self):
+        '''Removes every user from the local tier'''
+        with self._lock:
+            self._users.clear()
+
+    def delete(self, uuid):
+        '''Removes a user from both tiers, after it has been changed'''
+        self.evict(uuid)
+
+        if self.shared_cache is not None:
+            self.shared_cache.delete(self._get_shared_key(uuid))
+
+
+user_cache = UserCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_LOCAL_TIMEOUT, settings.USER_CACHE_SHARED_ALIAS, settings.USER_CACHE_TIMEOUT)
+
+
+def _parse_uuid(uuid):
+    try:
+        return str(UUID(str(uuid)))
+    except ValueError:
+        return None
+
+
+def _get_queryset(uuid):
+    # Read from the primary database, so a lagging replica can't put an outdated user back in the cache after it is changed
+    return User.objects.using(DEFAULT_DB_ALIAS).filter(uuid=uuid).values_list(*CACHED_FIELDS)
+
+
+def _load_user(values):
+    return User.from_db(DEFAULT_DB_ALIAS, CACHED_FIELDS, values)
+
+
+def get_user_by_uuid(uuid):
+    '''Returns the user with the uuid, with only the cached fields loaded, or None if there is no such user'''
+    uuid = _parse_uuid(uuid)
+    if uuid is None:
+        return None
+
+    values = user_cache.get(uuid)
+    if values is None:
+        values = _get_queryset(uuid).first()
+        if values is None:
+            return None
+        user_cache.set(uuid, values)
+
+    return _load_user(values)
+
+
+async def aget_user_by_uuid(uuid):
+    uuid = _parse_uuid(uuid)
+    if uuid is None:
+        return None
+
+    values = await user_cache.aget(uuid)
+    if values is None:
+        values = await _get_queryset(uuid).afirst()
+        if values is None:
+            return None
+        await user_cache.aset(uuid, values)
+
+    return _load_user(values)
+
+
+def get_user_or_404(uuid):
+    user = get_user_by_uuid(uuid)
+    if user is None:
+        raise Http404('No user matches the given query.')
+    return user
+
+
+async def aget_user_or_404(uuid):
+    user = await aget_user_by_uuid(uuid)
+    if user is None:
+        raise Http404('No user matches the given query.')
+    return user
@@ -1,21 +1,39 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
-from chat.views import get_home_context
-from .forms import AddFriendForm, DeleteAccountForm
-from .models import User
+from django.views.decorators.http import require_POST
+from chat.views import aget_home_context
+from chat.versions import user_version_condition, FRIENDS
+from .avatars import process_avatar_upload
+from .forms import AddFriendForm, DeleteAccountForm, ProfilePictureForm
+from .user_cache import get_user_or_404, aget_user_or_404
 
 
-def get_friends_context(user):
-    return get_home_context(user) | {
-        'friends_mutual': user.friends_mutual,
-        'outgoing_requests': user.get_outgoing_requests()
+async def alist(queryset):
+    return [obj async for obj in queryset]
+
+
+async def aget_friends_context(user):
+    return await aget_home_context(user) | {
+        'friends_mutual': await alist(user.friends_mutual),
+        'outgoing_requests': await alist(user.get_outgoing_requests())
     } 
 
 
 def get_csrf_token(request):
     return request.COOKIES.get('csrftoken')
+
+
+def get_friends_version_scopes(request):
+    # Responses depending on one-off navigation flags stored in the session are not cached
+    if request.session.get('from_home') or request.session.get('from_manage_friends'):
+        return None
+
+    # Full pages contain a WebSocket token, which expires soon after the page is rendered, so only partials are cached
+    if request.headers.get('HX-Request') and not (request.headers.get('HX-History-Restore-Request') or request.headers.get('HX-Full-Page-Request')):
+        return [FRIENDS]
+    return None
  
 
 @login_required(redirect_field_name=None)
@@ -25,14 +43,15 @@ def manage_friends(request):
 
 
 @login_required(redirect_field_name=None)
-def friends_list(request):
-    user = request.user
+@user_version_condition(get_friends_version_scopes)
+async def friends_list(request):
+    user = await request.auser()
 
     if request.method == 'POST':
         uuid = request.POST.get('uuid')
-        friend = get_object_or_404(User, uuid=uuid)
+        friend = await aget_user_or_404(uuid)
         
-        success, message = user.remove_friend(friend)
+        success, message = await user.aremove_friend(friend)
         if not success:
             messages.error(request, message)
 
@@ -46,38 +65,39 @@ def friends_list(request):
     is_htmx_request = request.headers.get('HX-Request') == 'true'
     is_history_restore_request = request.headers.get('HX-History-Restore-Request') == 'true'
     is_full_load_request = request.headers.get('HX-Full-Page-Request') == 'true'
-    from_home = request.session.pop('from_home', False)
-    from_manage_friends = request.session.pop('from_manage_friends', False)
+    from_home = await request.session.apop('from_home', False)
+    from_manage_friends = await request.session.apop('from_manage_friends', False)
 
     if not is_htmx_request or is_history_restore_request or is_full_load_request or from_home:
-        return render(request, 'users/friends_list.html', context | get_friends_context(user))
+        return render(request, 'users/friends_list.html', context | await aget_friends_context(user))
     
     if from_manage_friends:
         return render(request, 'users/friends_list.html',
             context | {
-                'friends_mutual': user.friends_mutual,
-                'incoming_requests': user.get_incoming_requests(),
-                'outgoing_requests': user.get_outgoing_requests()
+                'friends_mutual': await alist(user.friends_mutual),
+                'incoming_requests': await alist(user.get_incoming_requests()),
+                'outgoing_requests': await alist(user.get_outgoing_requests())
             }
         )
     
     return render(request, 'users/partials/friends_list.html',
         context | {
-            'friends_mutual': user.friends_mutual
+            'friends_mutual': await alist(user.friends_mutual)
         }
     )
 
 
 @login_required(redirect_field_name=None)
-def incoming_requests(request):
-    user = request.user
+@user_version_condition(get_friends_version_scopes)
+async def incoming_requests(request):
+    user = await request.auser()
 
     if request.method == 'POST':
         uuid = request.POST.get('uuid')
-        request_sender = get_object_or_404(User, uuid=uuid)
+        request_sender = await aget_user_or_404(uuid)
 
         action = request.POST.get('action')
-        success, message = user.handle_incoming_request(request_sender, action)
+        success, message = await user.ahandle_incoming_request(request_sender, action)
         if not success:
             messages.error(request, message)
         
@@ -90,21 +110,22 @@ def incoming_requests(request):
     if request.headers.get('HX-Request') and not (request.headers.get('HX-History-Restore-Request') or request.headers.get('HX-Full-Page-Request')):
         return render(request, 'users/partials/incoming_requests.html',
             context | {
-                'incoming_requests': user.get_incoming_requests()
+                'incoming_requests': await alist(user.get_incoming_requests())
             }
         )
-    return render(request, 'users/incoming_requests.html', context | get_friends_context(user))
+    return render(request, 'users/incoming_requests.html', context | await aget_friends_context(user))
 
 
 @login_required(redirect_field_name=None)
-def outgoing_requests(request):
-    user = request.user
+@user_version_condition(get_friends_version_scopes)
+async def outgoing_requests(request):
+    user = await request.auser()
 
     if request.method == 'POST':
         uuid = request.POST.get('uuid')
-        request_recipient = get_object_or_404(User, uuid=uuid)
+        request_recipient = await aget_user_or_404(uuid)
 
-        success, message = user.cancel_outgoing_request(request_recipient)
+        success, message = await user.acancel_outgoing_request(request_recipient)
         if not success:
             messages.error(request, message)
 
@@ -117,20 +138,20 @@ def outgoing_requests(request):
     if request.headers.get('HX-Request') and not (request.headers.get('HX-History-Restore-Request') or request.headers.get('HX-Full-Page-Request')):
         return render(request, 'users/partials/outgoing_requests.html',
             context | {
-                'outgoing_requests': user.get_outgoing_requests()
+                'outgoing_requests': await alist(user.get_outgoing_requests())
             }
         )
-    return render(request, 'users/outgoing_requests.html', context | get_friends_context(user))
+    return render(request, 'users/outgoing_requests.html', context | await aget_friends_context(user))
     
 
 @login_required(redirect_field_name=None)
-def add_friend(request):
-    user = request.user
+async def add_friend(request):
+    user = await request.auser()
 
     if request.method == 'POST':
         form = AddFriendForm(request.POST, initial={'user': user})
-        if form.is_valid():
-            form.save()
+        if await form.ais_valid():
+            await form.asave()
             username = form.cleaned_data['username']
             messages.success(request, f'You have successfully sent a friend request to {username}')
             return redirect('add_friend')
@@ -143,13 +164,48 @@ def add_friend(request):
     }
     if request.headers.get('HX-Request') and not (request.headers.get('HX-History-Restore-Request') or request.headers.get('HX-Full-Page-Request')):
         return render(request, 'users/partials/add_friend.html', context)
-    return render(request, 'users/add_friend.html', context | get_friends_context(user))
+    return render(request, 'users/add_friend.html', context | await aget_friends_context(user))
+
+
+@login_required(redirect_field_name=None)
+@require_POST
+def block_user(request, uuid):
+    other_user = get_user_or_404(uuid)
+
+    action = request.POST.get('action')
+    if action == 'block':
+        success, message = request.user.block_user(other_user)
+    elif action == 'unblock':
+        success, message = request.user.unblock_user(other_user)
+    else:
+        success, message = False, 'Invalid action'
+    if not success:
+        messages.error(request, message)
+
+    return redirect('direct_message', other_user.uuid)
 
 
 def settings(request):
     return redirect('account_email')
 
 
+@login_required(redirect_field_name=None)
+def profile_picture(request):
+    if request.method == 'POST':
+        form = ProfilePictureForm(request.POST, request.FILES)
+        if form.is_valid():
+            process_avatar_upload(request.user, form.cleaned_data['picture'])
+            messages.success(request, 'Your profile picture is being updated')
+            return redirect('profile_picture')
+    else:
+        form = ProfilePictureForm()
+
+    return render(request, 'users/profile_picture.html', {
+        'title': 'Change profile picture',
+        'form': form
+    })
+
+
 @login_required(redirect_field_name=None)
 def delete_account(request):
     if request.method == 'POST':